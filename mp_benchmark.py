@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+MPラーニング 自動受講ツールのベンチマーク
+ローカル検証用サーバー（mp_fixture_server.py）を立て、本物のツールとChromeで
+予約した講座を連続受講させて、遷移の所要時間・WebDriverコマンド数/分・CPU使用率を測る
+
+使い方:
+    python mp_benchmark.py --lessons 3 --duration 10 --latency 100 --background
+    python mp_benchmark.py --output result.json
+    python mp_benchmark.py --startup 5            # 起動時間（モジュールの読み込み）だけ測る
+    python mp_benchmark.py --stall-at 4           # 再生の停滞（バッファリング）からの復旧を測る
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import mp_fixture_server
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# 進捗の確認とCPU使用率の計測間隔（ミリ秒）
+SAMPLE_INTERVAL_MS = 1000
+
+# 起動時間の計測で表示する、読み込みの遅いモジュールの数
+STARTUP_TOP_MODULES = 10
+
+# 起動時間の計測: ツールを読み込み（ウィンドウを出す前に必要な分）、続けてSeleniumを読み込む
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import mp_learning_selenium as tool
+imported = time.perf_counter()
+tool.load_selenium()
+loaded = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "selenium_ms": (loaded - imported) * 1000}))
+"""
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="検証用サーバーに対して連続受講を実行して性能を測る")
+    parser.add_argument("--lessons", type=int, default=3, help="受講する講座の数")
+    parser.add_argument("--new-count", type=int, default=None, help="新着（直接リンクあり）の講座の数（既定: 全部の半分）")
+    parser.add_argument("--parts", type=int, default=2, help="1講座あたりの動画の本数")
+    parser.add_argument("--duration", type=float, default=10.0, help="動画1本の長さ（秒）")
+    parser.add_argument("--player-delay", type=int, default=500, help="プレイヤーが使えるまでの時間（ミリ秒）")
+    parser.add_argument("--latency", type=int, default=0, help="サーバーの応答遅延（ミリ秒）")
+    parser.add_argument("--jitter", type=int, default=0, help="応答遅延の揺らぎ（ミリ秒）")
+    parser.add_argument("--stall-at", type=float, default=None, help="各動画で再生が止まる位置（秒、バッファリングの復旧を測る）")
+    parser.add_argument("--stall-for", type=float, default=0.0, help="止まっている秒数（0ならシークされるまで）")
+    parser.add_argument("--cdp", action="store_true", help="CDPイベント監視を有効にする")
+    parser.add_argument("--background", action="store_true", help="バックグラウンド起動で測る")
+    parser.add_argument("--headless", action="store_true", help="ヘッドレスで測る（バックグラウンド起動・プロファイル保持も有効になる）")
+    parser.add_argument("--memory-limit", type=int, default=None, help="講座の合間にブラウザを作り直すメモリ使用量（MB、0なら見張らない）")
+    parser.add_argument("--timeout", type=float, default=None, help="打ち切りまでの秒数（既定: 動画の合計時間+講座ごとに60秒）")
+    parser.add_argument("--output", help="結果をJSONで書き出すパス")
+    parser.add_argument("--startup", type=int, metavar="N", default=None,
+                        help="ブラウザは起動せず、ツールの読み込み時間を N 回測る（python -X importtime）")
+    return parser
+
+
+def parse_importtime(stderr):
+    """python -X importtime の出力から、モジュールごとの読み込み時間（自身・配下を含む, ミリ秒）を読む"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue  # 見出し行
+        modules[name.strip()] = (int(self_us) / 1000, int(cumulative_us) / 1000, len(name) - len(name.lstrip()) - 1)
+    return modules
+
+
+def profile_startup(repeat):
+    """ツールの読み込みを別プロセスで repeat 回測り、中央値と遅いモジュールを返す"""
+    runs = []
+    modules = {}
+    for _ in range(repeat):
+        started = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP_PROBE],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, encoding="utf-8",
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "起動に失敗")
+        run = json.loads(proc.stdout.strip().splitlines()[-1])
+        run["process_ms"] = (time.perf_counter() - started) * 1000
+        runs.append(run)
+        modules = parse_importtime(proc.stderr)  # 表示は最後の回（キャッシュが温まった状態）
+    # ツールの読み込み中に読んだトップレベルのモジュール（インデント0）を遅い順に
+    top = sorted(
+        ((name, cumulative) for name, (_, cumulative, depth) in modules.items() if depth == 0 and name != "site"),
+        key=lambda item: -item[1],
+    )[:STARTUP_TOP_MODULES]
+    return {
+        "repeat": repeat,
+        "import_ms": round(statistics.median(run["import_ms"] for run in runs), 1),
+        "selenium_ms": round(statistics.median(run["selenium_ms"] for run in runs), 1),
+        "process_ms": round(statistics.median(run["process_ms"] for run in runs), 1),
+        "slowest_modules": [{"module": name, "cumulative_ms": round(ms, 1)} for name, ms in top],
+    }
+
+
+def print_startup(report):
+    print(f"ツールの読み込み（ウィンドウ表示前）: {report['import_ms']}ms  "
+          f"Seleniumの読み込み（表示後）: {report['selenium_ms']}ms  "
+          f"プロセス全体: {report['process_ms']}ms（{report['repeat']}回の中央値）")
+    print("読み込みの遅いモジュール:")
+    for row in report["slowest_modules"]:
+        print(f"  {row['cumulative_ms']:8.1f}ms  {row['module']}")
+
+
+def summarize_cpu(samples):
+    """[(Chrome CPU%, Chrome RSS MB, ツール CPU%)] の平均・最大"""
+    if not samples:
+        return None
+    chrome_cpu = [s[0] for s in samples]
+    chrome_rss = [s[1] for s in samples]
+    tool_cpu = [s[2] for s in samples if s[2] is not None]
+    return {
+        "samples": len(samples),
+        "chrome_cpu_mean": round(sum(chrome_cpu) / len(chrome_cpu), 1),
+        "chrome_cpu_max": round(max(chrome_cpu), 1),
+        "chrome_rss_max_mb": round(max(chrome_rss), 1),
+        "tool_cpu_mean": round(sum(tool_cpu) / len(tool_cpu), 1) if tool_cpu else None,
+    }
+
+
+def summarize_lessons(lessons, video_seconds):
+    """講座ごとのフェーズ別時間と、動画の再生時間を除いた遷移のオーバーヘッド"""
+    rows = []
+    for lesson in lessons:
+        phases = lesson["phases"]
+        total = sum(v for k, v in phases.items() if k != "gap")
+        rows.append({
+            "lesson_id": lesson["lesson_id"],
+            "total": round(total, 2),
+            "overhead": round(total - video_seconds, 2),
+            "buffering": lesson.get("buffering", 0),
+            "buffering_recoveries": lesson.get("buffering_recoveries", {}),
+            "phases": {k: round(v, 2) for k, v in phases.items()},
+        })
+    return rows
+
+
+def build_report(args, tool, data, elapsed, cpu_samples, completed):
+    video_seconds = args.parts * args.duration
+    commands = sum(stats["count"] for stats in data["commands"].values())
+    lessons = summarize_lessons(data["lessons"], video_seconds)
+    overheads = [row["overhead"] for row in lessons]
+    return {
+        "settings": {
+            "lessons": args.lessons, "parts": args.parts, "duration": args.duration,
+            "player_delay": args.player_delay, "latency": args.latency, "jitter": args.jitter,
+            "stall_at": args.stall_at, "stall_for": args.stall_for,
+            "cdp": args.cdp, "background": args.background or args.headless, "headless": args.headless,
+            "base_url": tool.BASE_URL,
+        },
+        "completed": completed,
+        "elapsed": round(elapsed, 2),
+        "commands": commands,
+        "commands_per_minute": round(commands / (elapsed / 60), 1) if elapsed > 0 else None,
+        "overhead_mean": round(sum(overheads) / len(overheads), 2) if overheads else None,
+        "lessons": lessons,
+        "waits": {name: {"count": s["count"], "mean_ms": s["mean_ms"], "max_ms": s["max_ms"]}
+                  for name, s in data["waits"].items()},
+        "cpu": summarize_cpu(cpu_samples),
+        "memory": {
+            "samples": data["memory"],
+            "trend_mb_per_lesson": data["memory_trend_mb_per_lesson"],
+            "recycles": sum(1 for sample in data["memory"] if sample["action"] is not None),
+        },
+        "watchdog": data["watchdog"],
+    }
+
+
+def print_report(report):
+    print(f"完了: {report['completed']}  経過: {report['elapsed']}秒")
+    print(f"WebDriverコマンド: {report['commands']}回 ({report['commands_per_minute']}回/分)")
+    for row in report["lessons"]:
+        phases = "  ".join(f"{k}={v}" for k, v in row["phases"].items())
+        buffering = ""
+        if row["buffering"] or row["buffering_recoveries"]:
+            recoveries = " ".join(f"{k}={v}" for k, v in row["buffering_recoveries"].items())
+            buffering = f" / 停滞 {row['buffering']}秒" + (f"（{recoveries}）" if recoveries else "")
+        print(f"  L={row['lesson_id']}: 合計 {row['total']}秒 / 遷移 {row['overhead']}秒{buffering}  ({phases})")
+    if report["overhead_mean"] is not None:
+        print(f"遷移のオーバーヘッド（動画時間を除く）平均: {report['overhead_mean']}秒/講座")
+    for name, stats in report["waits"].items():
+        print(f"  待機 {name}: {stats['count']}回 平均{stats['mean_ms']}ms 最大{stats['max_ms']}ms")
+    cpu = report["cpu"]
+    if cpu:
+        print(f"Chrome CPU 平均{cpu['chrome_cpu_mean']}% 最大{cpu['chrome_cpu_max']}%  RSS最大 {cpu['chrome_rss_max_mb']}MB"
+              f"  ツール CPU 平均{cpu['tool_cpu_mean']}%")
+    else:
+        print("CPU: 計測なし（psutilが必要）")
+    memory = report["memory"]
+    if memory["samples"]:
+        mbs = "  ".join(f"{sample['mb']:.0f}" + (f"({sample['action']})" if sample["action"] else "") for sample in memory["samples"])
+        print(f"Chromeメモリ（講座の合間, MB）: {mbs}  増加 {memory['trend_mb_per_lesson']}MB/講座  作り直し {memory['recycles']}回")
+    watchdog = report["watchdog"]
+    if watchdog["stalls"] or watchdog["command_timeouts"]:
+        print(f"監視の停止→復旧: {len(watchdog['stalls'])}回（復旧 平均{watchdog['recovery_mean']}秒）  "
+              f"時間切れのコマンド: {sum(watchdog['command_timeouts'].values())}回")
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    if args.startup is not None:
+        report = profile_startup(max(1, args.startup))
+        print_startup(report)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return 0
+    lesson_ids = [str(2001 + i) for i in range(args.lessons)]
+    new_count = args.new_count if args.new_count is not None else (args.lessons + 1) // 2
+    server, base_url = mp_fixture_server.start_server(
+        lessons=lesson_ids, new_count=new_count, parts=args.parts, duration=args.duration,
+        player_delay=args.player_delay, latency=args.latency, jitter=args.jitter,
+        stall_at=args.stall_at, stall_for=args.stall_for,
+    )
+    print(f"検証用サーバー: {base_url}")
+
+    # 接続先はツールの読み込み時に決まるので、環境変数を先に設定してから読み込む
+    os.environ["MPL_BASE_URL"] = base_url
+    import mp_learning_selenium as tool
+
+    # ウィンドウは作らず、エンジンをコマンドライン版と同じ view で動かす（進捗は出さない）
+    log_listener, _ = tool.setup_logging(console=sys.stderr)
+    view = tool.JsonLinesView(stream=None)
+    options = tool.EngineOptions(
+        use_cdp=args.cdp,
+        background_mode=args.background or args.headless,
+        headless_mode=args.headless,
+        use_profile=args.headless,
+    )
+    # 本番の予約リストを使わないように、ベンチマーク用のリストを使う
+    engine = tool.LearningEngine(view, options, tool.LessonQueue(":memory:"))
+    if args.memory_limit is not None:
+        engine.set_memory_limit(args.memory_limit)
+
+    timeout = args.timeout or args.lessons * (args.parts * args.duration + 60)
+    own_process = psutil.Process() if psutil is not None else None
+    if own_process is not None:
+        own_process.cpu_percent(None)
+    cpu_samples = []
+    result = {}
+
+    def sample():
+        usage = engine.resources.sample() if engine.resources is not None else None
+        if usage is not None:
+            tool_cpu = own_process.cpu_percent(None) if own_process is not None else None
+            cpu_samples.append((usage[0], usage[1], tool_cpu))
+
+    try:
+        if engine.start_browser(resume=False) and engine.wait_for_login(tool.STEP_TIMEOUTS["mypage"]):
+            started = time.monotonic()
+            engine.add_lessons(lesson_ids)
+            engine.submit(engine.start_continuous)
+            finished = view.run(timeout, tick=sample, tick_interval=SAMPLE_INTERVAL_MS / 1000)
+            elapsed = time.monotonic() - started
+            completed = finished and len(engine.metrics.lessons) >= args.lessons and not view.failed
+            report = build_report(args, tool, engine.metrics.to_dict(), elapsed, cpu_samples, completed)
+            report["metrics"] = engine.metrics.to_dict()
+            result["report"] = report
+        else:
+            result["error"] = "ブラウザを起動できませんでした"
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.shutdown(export=False)
+        log_listener.stop()
+        server.shutdown()
+
+    if "report" not in result:
+        print(result.get("error", "中断されました"), file=sys.stderr)
+        return 2
+    report = result["report"]
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を書き出しました: {args.output}")
+    return 0 if report["completed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+MPラーニングの代わりになるローカル検証用サーバー
+ツールが操作するページ（マイページ・動画・確認テスト・解説・アンケート）だけを最小限に再現する
+- 動画は偽の player.accessor（play / pause / seek / isPaused / getCurrentTime / getDuration）で、時間だけ進む
+- 動画の長さ・動画の本数・プレイヤーの準備時間・応答の遅延・再生の停滞（バッファリング）を指定できる
+
+使い方:
+    python mp_fixture_server.py --port 8765 --duration 20 --latency 100
+    set MPL_BASE_URL=http://127.0.0.1:8765
+    python mp_learning_selenium.py
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import html
+import json
+import random
+import threading
+import time
+
+
+# 既定の設定（コマンドライン引数・start_server の引数で上書き）
+DEFAULT_CONFIG = {
+    "lessons": ["1001", "1002", "1003"],  # マイページに並べる講座ID
+    "new_count": 2,          # 新着（スライダーに linkNewLessonPC-<id> のリンクがある）講座の数。残りはJS呼び出しでのみ開ける
+    "parts": 2,              # 1講座あたりの動画の本数
+    "duration": 20.0,        # 動画1本の長さ（秒）
+    "player_delay": 500,     # ページ読み込みから player.accessor が使えるまで（ミリ秒）
+    "latency": 0,            # 各リクエストへの応答遅延（ミリ秒）
+    "jitter": 0,             # 応答遅延に加えるランダムな揺らぎの上限（ミリ秒）
+    "stall_at": None,        # 各動画でこの再生位置（秒）に来たら再生位置が進まなくなる（Noneなら止まらない）
+    "stall_for": 0.0,        # 止まっている秒数（0ならシークされるまで止まったまま）
+}
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; margin: 16px; }}
+.hidden {{ display: none; }}
+#eqPlayer {{ width: 640px; height: 360px; background: #000; color: #fff; }}
+#eqPlayer iframe {{ width: 100%; height: 100%; border: 0; }}
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+MYPAGE_SCRIPT = """
+<script>
+// 本番と同じ引数で講座のポップアップを開く
+function lnkNewLesson_OnClick(lessonId, lessonType, a, anchorId, b) {
+    window.open('/Lesson/LessonStudyFixed.aspx?L=' + lessonId + '&P=1', 'LessonStudy',
+                'width=1000,height=700');
+    return false;
+}
+</script>
+"""
+
+# 偽のEQプレイヤー: 再生中は実時間で再生位置が進み、最後まで行くと「次の学習へ」ボタンを表示する
+# stallAt に来ると一時停止でないまま再生位置が進まなくなる（バッファリング）。シークすると直る
+PLAYER_SCRIPT = """
+<script>
+(function() {
+    var duration = %(duration)s;
+    var stallAt = %(stall_at)s, stallFor = %(stall_for)s;
+    function finished() {
+        document.getElementById('btn-next-study').classList.remove('hidden');
+    }
+    function createAccessor() {
+        var time = 0, paused = true, last = null, stalledSince = null, stallDone = false;
+        function tick() {
+            if (paused) return;
+            var now = Date.now();
+            if (stalledSince !== null) {
+                last = now;
+                if (stallFor <= 0 || now - stalledSince < stallFor * 1000) return;
+                stalledSince = null;
+                stallDone = true;
+            }
+            time = Math.min(duration, time + (now - last) / 1000);
+            last = now;
+            if (stallAt !== null && !stallDone && time >= stallAt) {
+                time = stallAt;
+                stalledSince = now;
+                return;
+            }
+            if (time >= duration) {
+                paused = true;
+                finished();
+            }
+        }
+        setInterval(tick, 200);
+        return {
+            play: function() { if (time < duration) { paused = false; last = Date.now(); } },
+            pause: function() { tick(); paused = true; },
+            seek: function(t) {
+                tick();
+                time = Math.max(0, Math.min(duration, t));
+                if (stalledSince !== null) {
+                    stalledSince = null;
+                    stallDone = true;
+                }
+                last = Date.now();
+            },
+            isPaused: function() { tick(); return paused; },
+            getCurrentTime: function() { tick(); return time; },
+            getDuration: function() { return duration; }
+        };
+    }
+    // 本番のプレイヤーと同じく、読み込み後しばらくしてから使えるようになる
+    setTimeout(function() {
+        window.player = {accessor: createAccessor()};
+    }, %(player_delay)s);
+})();
+</script>
+"""
+
+
+def lesson_title(lesson_id):
+    return f"講座{lesson_id}"
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """パスごとにページを返す（設定は self.server.config）"""
+
+    server_version = "MPLFixture/1.0"
+
+    def do_GET(self):
+        config = self.server.config
+        delay = config["latency"] + random.uniform(0, config["jitter"])
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        routes = {
+            "/": self.login_page,
+            "/Login.aspx": self.login_page,
+            "/Members/MyPage.aspx": self.mypage,
+            "/Lesson/LessonStudyFixed.aspx": self.lesson_page,
+            "/Lesson/Exam.aspx": self.exam_page,
+            "/Lesson/ExamResult.aspx": self.explanation_page,
+            "/Lesson/Survey.aspx": self.survey_page,
+            "/player/frame.html": self.player_frame,
+        }
+        route = routes.get(parts.path)
+        if route is None:
+            self.send_error(404)
+            return
+        title, body = route(query)
+        self.send_page(title, body)
+
+    def send_page(self, title, body):
+        data = PAGE_TEMPLATE.format(title=html.escape(title), body=body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- ページ ---
+
+    def login_page(self, query):
+        # 検証用なのでログインは不要（ログイン済みとしてすぐマイページへ移る）
+        body = (
+            '<p>検証用サーバー</p><a id="lnkMyPage" href="/Members/MyPage.aspx">マイページへ</a>'
+            "<script>location.replace('/Members/MyPage.aspx');</script>"
+        )
+        return "ログイン | MPラーニング", body
+
+    def mypage(self, query):
+        config = self.server.config
+        lessons = config["lessons"]
+        new_lessons = lessons[:config["new_count"]]
+        other_lessons = lessons[config["new_count"]:]
+
+        slider = "".join(
+            f'<li><a id="linkNewLessonPC-{lid}" href="javascript:void(0)" '
+            f'onclick="return lnkNewLesson_OnClick(\'{lid}\', 1, 1, \'linkNewLessonPC-{lid}\', 0);">'
+            f'{lesson_title(lid)}</a></li>'
+            for lid in new_lessons
+        )
+        # 新着以外はアコーディオンの中（閉じている）にあり、IDでは見つからない
+        accordion = "".join(
+            f'<li><a href="javascript:void(0)" '
+            f'onclick="return lnkNewLesson_OnClick(\'{lid}\', 2, 1, \'linkLessonPC-{lid}\', 0);">'
+            f'{lesson_title(lid)}</a></li>'
+            for lid in other_lessons
+        )
+        body = (
+            f'<h1>マイページ</h1><ul class="slider">{slider}</ul>'
+            f'<div class="accordion"><h2>すべての講座</h2><ul class="hidden">{accordion}</ul></div>'
+            + MYPAGE_SCRIPT
+        )
+        return "マイページ | MPラーニング", body
+
+    def lesson_page(self, query):
+        config = self.server.config
+        lesson_id = query.get("L", "")
+        part = int(query.get("P", "1"))
+        if part < config["parts"]:
+            next_url = f"/Lesson/LessonStudyFixed.aspx?L={lesson_id}&P={part + 1}"
+            next_text = "次の学習へ"
+        else:
+            next_url = f"/Lesson/Exam.aspx?L={lesson_id}"
+            next_text = "テストへ"
+        body = (
+            f'<h1>{lesson_title(lesson_id)} ({part}/{config["parts"]})</h1>'
+            f'<div id="eqPlayer"><iframe src="/player/frame.html"></iframe></div>'
+            f'<div id="btn-next-study" class="hidden" onclick="location.href=\'{next_url}\'">'
+            f'<a id="btn-next-study-link" href="{next_url}">{next_text}</a></div>'
+            + PLAYER_SCRIPT % {
+                "duration": json.dumps(config["duration"]), "player_delay": int(config["player_delay"]),
+                "stall_at": json.dumps(config["stall_at"]), "stall_for": json.dumps(config["stall_for"]),
+            }
+        )
+        return f"レッスン | {lesson_title(lesson_id)}", body
+
+    def player_frame(self, query):
+        # 本番ではここに<video>があるが、検証用では再生位置は player.accessor だけで管理する
+        return "player", "<p>EQ Player (fixture)</p>"
+
+    def exam_page(self, query):
+        lesson_id = query.get("L", "")
+        questions = "".join(
+            f'<p>問{n}</p>'
+            + "".join(
+                f'<label><input type="radio" name="q{n}" value="{c}">選択肢{c}</label>'
+                for c in range(1, 5)
+            )
+            for n in range(1, 4)
+        )
+        body = (
+            f'<form id="aspnetForm" method="get" action="/Lesson/ExamResult.aspx">'
+            f'<input type="hidden" name="L" value="{lesson_id}">{questions}'
+            f'<a id="ctl00_examBody_lnkExamAnswerSubmit" href="javascript:void(0)" '
+            f'onclick="document.getElementById(\'aspnetForm\').submit();">答案提出</a></form>'
+        )
+        return f"確認テスト | {lesson_title(lesson_id)}", body
+
+    def explanation_page(self, query):
+        lesson_id = query.get("L", "")
+        body = (
+            f'<h1>解説</h1><p>3問中{sum(1 for k in query if k.startswith("q"))}問回答</p>'
+            f'<input type="button" id="ctl00_examBody_cmdNext" value="次へ" '
+            f'onclick="location.href=\'/Lesson/Survey.aspx?L={lesson_id}\'">'
+        )
+        return f"確認テスト 解説 | {lesson_title(lesson_id)}", body
+
+    def survey_page(self, query):
+        lesson_id = query.get("L", "")
+        # 本番と同じく「終了」でポップアップが閉じる
+        body = '<h1>アンケート</h1><label id="panel-end-label" onclick="window.close();">終了</label>'
+        return f"アンケート | {lesson_title(lesson_id)}", body
+
+
+def start_server(host="127.0.0.1", port=0, verbose=False, **overrides):
+    """サーバーを別スレッドで起動して (server, ベースURL) を返す（port=0なら空きポート）"""
+    config = dict(DEFAULT_CONFIG, **overrides)
+    server = ThreadingHTTPServer((host, port), FixtureHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="MPラーニングの検証用ローカルサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--lessons", default=",".join(DEFAULT_CONFIG["lessons"]), help="講座ID（カンマ区切り）")
+    parser.add_argument("--new-count", type=int, default=DEFAULT_CONFIG["new_count"], help="新着として直接リンクを置く講座の数")
+    parser.add_argument("--parts", type=int, default=DEFAULT_CONFIG["parts"], help="1講座あたりの動画の本数")
+    parser.add_argument("--duration", type=float, default=DEFAULT_CONFIG["duration"], help="動画1本の長さ（秒）")
+    parser.add_argument("--player-delay", type=int, default=DEFAULT_CONFIG["player_delay"], help="プレイヤーが使えるまでの時間（ミリ秒）")
+    parser.add_argument("--latency", type=int, default=DEFAULT_CONFIG["latency"], help="応答遅延（ミリ秒）")
+    parser.add_argument("--jitter", type=int, default=DEFAULT_CONFIG["jitter"], help="応答遅延の揺らぎ（ミリ秒）")
+    parser.add_argument("--stall-at", type=float, default=DEFAULT_CONFIG["stall_at"], help="各動画で再生が止まる位置（秒）")
+    parser.add_argument("--stall-for", type=float, default=DEFAULT_CONFIG["stall_for"], help="止まっている秒数（0ならシークされるまで）")
+    parser.add_argument("--verbose", action="store_true", help="アクセスログを出す")
+    return parser
+
+
+def config_from_args(args):
+    """コマンドライン引数から start_server に渡す設定を作る"""
+    return {
+        "lessons": [lid.strip() for lid in args.lessons.split(",") if lid.strip()],
+        "new_count": args.new_count,
+        "parts": args.parts,
+        "duration": args.duration,
+        "player_delay": args.player_delay,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "stall_at": args.stall_at,
+        "stall_for": args.stall_for,
+    }
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    server, base_url = start_server(args.host, args.port, args.verbose, **config_from_args(args))
+    print(f"検証用サーバー起動: {base_url}  (MPL_BASE_URL={base_url} でツールを起動)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
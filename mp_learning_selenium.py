@@ -4,38 +4,3751 @@ MPラーニング 自動受講ツール (Selenium版 v2)
 バックグラウンドで動作可能な半自動ツール
 - チカチカ問題を解消（ポップアップウィンドウのみ監視）
 - 再生ボタン自動クリック機能追加
+- 講座IDを指定するとウィンドウなしで連続受講（進捗は1行1件のJSON）
+
+使い方:
+    python mp_learning_selenium.py                    # ウィンドウ版
+    python mp_learning_selenium.py 1234 5678 --profile
+    python mp_learning_selenium.py --file lessons.txt --headless
+"""
+
+import time
+
+STARTUP_STARTED = time.perf_counter()  # 起動時間の計測の基準（読み込みの最初）
+
+from selenium.common.exceptions import (
+    NoSuchWindowException, NoSuchElementException, StaleElementReferenceException,
+    JavascriptException, TimeoutException, WebDriverException
+)
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import argparse
+import itertools
+import csv
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+from urllib.parse import urlsplit
+
+try:
+    import psutil  # 任意: ChromeのCPU・メモリ使用量の表示に使う
+except ImportError:
+    psutil = None
+
+# tkinterはウィンドウ版でだけ使うので、起動時（run_gui）に読み込む
+tk = None
+messagebox = None
+
+# Selenium本体は読み込みに時間がかかる（exeでは特に）ので、ウィンドウを出した後に load_selenium で読み込む
+webdriver = None
+Service = None
+By = None
+Options = None
+EC = None
+SELENIUM_LOCK = threading.Lock()
+
+
+# 接続先（環境変数 MPL_BASE_URL でローカルの検証用サーバー mp_fixture_server.py などに向けられる）
+BASE_URL = os.environ.get("MPL_BASE_URL", "https://www.mp-learning.com").rstrip("/")
+SITE_HOST = urlsplit(BASE_URL).netloc
+LOGIN_URL = BASE_URL + "/Login.aspx"
+MYPAGE_URL = BASE_URL + "/Members/MyPage.aspx"
+
+# 「起動中Chromeに接続」で使うリモートデバッグポート
+REMOTE_DEBUGGING_PORT = 9222
+
+# バックグラウンド起動のウィンドウサイズ（プレイヤーが画面サイズに合わせて低いビットレートを選びやすい）
+BACKGROUND_WINDOW_SIZE = "960,540"
+
+# バックグラウンド起動で追加するChromeの引数
+BACKGROUND_ARGS = [
+    "--mute-audio",
+    "--disable-gpu-compositing",
+    # 使わない常駐サービスを止める
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-sync",
+    "--disable-default-apps",
+    "--disable-extensions",
+    "--no-first-run",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+    # 見えていないウィンドウでも動画とタイマーを止めない（最後まで再生しないと次へ進めないため）
+    "--disable-renderer-backgrounding",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+]
+
+# CPU・メモリ使用量の表示間隔（ミリ秒）
+RESOURCE_UPDATE_INTERVAL_MS = 5000
+
+# GUIのウィンドウサイズ（ログ欄を開いたときは縦に広げる）
+WINDOW_SIZE = "400x700"
+WINDOW_SIZE_WITH_LOG = "400x870"
+
+# 画面の応答の確認間隔と、ログに出す遅れ（ミリ秒）
+UI_LAG_CHECK_MS = 100
+UI_LAG_WARN_MS = 50
+
+# WebDriverコマンドの所要時間ヒストグラムの区切り（ミリ秒）
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# 1講座の中のフェーズ（表示・出力の順番）
+LESSON_PHASES = ("gap", "mypage", "link", "popup", "playback", "test", "explanation", "survey")
+
+# ログ設定
+LOG_RING_SIZE = 500                  # GUIのログ欄に残す行数
+LOG_QUEUE_SIZE = 10000               # 書き込み待ちの上限（超えたら捨てる）
+LOG_FILE_MAX_BYTES = 1024 * 1024     # ログファイル1つの上限
+LOG_BACKUP_COUNT = 3                 # ローテーションで残す世代数
+LOG_REPEAT_INTERVAL = 10             # 同じメッセージを繰り返し出さない間隔（秒）
+LOG_PANE_REFRESH_MS = 500            # ログ欄の更新間隔（ミリ秒）
+# アプリのデータ保存先（ドライバのキャッシュなど）
+APP_DIR_NAME = "MPLearningAutoTool"
+
+# 遷移ごとの待機上限秒数（固定sleepの代わりに、条件が満たされ次第すぐ次へ進む）
+STEP_TIMEOUTS = {
+    "mypage": 20,        # マイページの講座リンク / lnkNewLesson_OnClick が使えるまで
+    "popup": 15,         # 講座ポップアップが開くまで
+    "player": 20,        # player.accessor が使えるまで
+    "play_confirm": 3,   # play() 後に再生状態になるまで
+    "navigation": 20,    # ボタンクリック後のページ遷移が終わるまで
+}
+# 条件待機のポーリング間隔（秒）
+WAIT_POLL_INTERVAL = 0.2
+
+# イベント待機（長時間ポーリング）1回あたりの上限秒数
+# 待機中は他のWebDriverコマンドが後回しになるので、画面操作の待ち時間の上限も兼ねる
+EVENT_WAIT_TIMEOUT = 10
+# イベント待機が連続で失敗したらポーリング監視に切り替える回数
+EVENT_WAIT_MAX_FAILURES = 3
+
+# 再生中の監視間隔: 動画の残り時間から終了予定を見積もり、それまではページを調べずに眠る
+PAUSE_CHECK_INTERVAL = 30       # 再生中でも一時停止を確認する最大間隔（秒、GUIで変更可）
+PAUSE_CHECK_RANGE = (5, 120)    # GUIで指定できる範囲
+NEAR_END_MARGIN = 5             # 終了予定の何秒前から細かく確認するか
+NEAR_END_POLL_INTERVAL = 0.5    # 終了間際の確認間隔（秒）
+# 再生中に次の講座を準備する（メインウィンドウでマイページを開いて索引を引いておく）のは、
+# 動画の残りがこの秒数以上あるときだけ（終了の検出を遅らせない）
+PREFETCH_MIN_REMAINING = 15
+
+# 再生の停滞（バッファリング）: 再生位置の進み方をスナップショットごとに調べ、一時停止でも終了でもないのに
+# 経過時間ほど進んでいなければバッファリング、しばらく全く進まなければ停滞とみなして復旧する。
+# 復旧は今の位置より少し前へのシーク（先へのスキップにはならない）、それでも進まなければ<video>を
+# 読み込み直して同じ位置に戻す
+BUFFERING_DETECT_SECONDS = 2    # 再生位置が経過時間よりこの秒数以上遅れたらバッファリングとみなす
+STALL_RECOVER_SECONDS = 8       # 再生位置がこの秒数進まなければ復旧する（復旧の後もこの秒数は待つ）
+STALL_POLL_INTERVAL = 1         # バッファリング中・停滞中の確認間隔（秒）
+STALL_RESEEK_BACK = 1.0         # シークし直すときに今の位置から戻る秒数
+STALL_RESEEK_ATTEMPTS = 2       # <video>を読み込み直す前にシークし直す回数
+STALL_MAX_RECOVERIES = 4        # 1回の停滞で復旧を試す上限（超えたら進み始めるのを待つだけ）
+ENDED_MARGIN = 0.5              # 動画の長さからこの秒数以内なら終わりとみなす
+HAVE_FUTURE_DATA = 3            # <video>.readyState がこれ未満なら先のデータが届いていない
+
+# メモリの見張り: 講座の合間にChromeのメモリ使用量を調べ、上限を超えていたらメインウィンドウ、
+# それでも超えていればブラウザごと作り直す（Cookieは引き継ぐ）
+MEMORY_LIMIT_MB = 2000          # プロセス全体のRSSの上限（0なら見張らない。GUI・コマンドラインで変更可）
+MEMORY_LIMIT_RANGE = (0, 16000) # GUIで指定できる範囲
+JS_HEAP_LIMIT_MB = 400          # プロセスを測れない（psutilなし・起動中Chromeに接続）ときのJSヒープの上限
+BROWSER_RESTART_RETRY_DELAY = 3 # ブラウザの再起動に失敗したときに待つ秒数
+
+# ウィンドウを前面に出さない操作: WebDriverはウィンドウを切り替えるたびにそのウィンドウを
+# 前面に出すので、各ウィンドウにCDPで直接つないでスクリプト実行・クリックを送る（TargetChannel）
+CHANNEL_CONNECT_TIMEOUT = 3     # 接続の上限秒数
+CHANNEL_MAX_FAILURES = 3        # 接続の失敗が続いたらWebDriverの切り替えに戻す回数
+
+# 監視ループの見張り（watchdog）: 監視ループは周回ごとに「次はいつまでに戻る」という心拍を残し、
+# 見張りのスレッドが心拍の途絶え・終わらないコマンドを見つけたら、仲介スレッドを作り直して
+# （ブラウザが応答しなければ起動し直して）ポップアップを探し直し、ページから状態を決め直す
+WATCHDOG_INTERVAL = 5           # 見張りの確認間隔（秒）
+WATCHDOG_GRACE = 90             # 予定の待ち時間を過ぎて心拍がこの秒数途絶えたら止まったとみなす
+WATCHDOG_COMMAND_GRACE = 15     # コマンドが実行時間の上限をこの秒数過ぎても終わらなければ止まったとみなす
+WATCHDOG_PROBE_TIMEOUT = 10     # 復旧時にブラウザが応答するか確かめる上限（秒）
+
+# フライトレコーダー（監視ループの判断の記録）のファイルの上限（2世代の合計）
+RECORDER_MAX_BYTES = 8 * 1024 * 1024
+# 記録の再生で「止まっていた」とみなす、同じ状態のまま続いた秒数
+REPLAY_STALL_SECONDS = 60
+
+# コマンドライン版: ブラウザでのログインを待つ秒数と確認間隔
+CLI_LOGIN_TIMEOUT = 300
+LOGIN_POLL_INTERVAL = 2
+
+# コマンドライン版の終了コード
+EXIT_OK = 0               # 予約した講座を全て受講した
+EXIT_LESSONS_FAILED = 1   # 受講を頼まれた講座のうち、受講済みにならなかったものがある
+EXIT_STARTUP_FAILED = 2   # 講座の指定・ブラウザ起動・ログインに失敗
+EXIT_TIMEOUT = 3          # --timeout で打ち切った
+EXIT_INTERRUPTED = 130    # Ctrl+C
+EXIT_REPLAY_MISMATCH = 1  # --replay: 記録と違う判断になったティックがある
+
+# 監視対象のコントロール（スナップショットのキー → 要素ID）
+CONTROL_IDS = {
+    "next_study": "btn-next-study",                      # 「次の学習へ」「テストへ」
+    "exam_submit": "ctl00_examBody_lnkExamAnswerSubmit",  # 確認テストの答案提出
+    "exam_next": "ctl00_examBody_cmdNext",               # テスト解説の「次へ」
+    "survey_end": "panel-end-label",                     # アンケートの「終了」
+}
+
+# ページ状態のスナップショットを作る関数（各スクリプトの先頭に埋め込んで使う）
+SNAPSHOT_FUNCTION_JS = """
+function __mplVisible(el) {
+    if (!el) return false;
+    var style = window.getComputedStyle(el);
+    if (style.display === 'none' || style.visibility === 'hidden') return false;
+    return el.getClientRects().length > 0;
+}
+function __mplNumber(acc, names) {
+    for (var i = 0; i < names.length; i++) {
+        try {
+            var v = acc[names[i]];
+            v = (typeof v === 'function') ? v.call(acc) : v;
+            if (typeof v === 'number' && isFinite(v)) return v;
+        } catch (e) {}
+    }
+    return null;
+}
+function __mplPlayer() {
+    if (typeof player === 'undefined' || !player || !player.accessor) return null;
+    var acc = player.accessor;
+    var paused = null;
+    try { paused = acc.isPaused(); } catch (e) {}
+    return {
+        paused: paused,
+        time: __mplNumber(acc, ['getCurrentTime', 'currentTime']),
+        duration: __mplNumber(acc, ['getDuration', 'getTotalTime', 'duration'])
+    };
+}
+function __mplSnapshot(ids) {
+    var snap = {
+        title: document.title,
+        url: location.href,
+        ready: document.readyState,
+        controls: {},
+        next_study_text: '',
+        player: __mplPlayer()
+    };
+    for (var key in ids) {
+        snap.controls[key] = __mplVisible(document.getElementById(ids[key]));
+    }
+    var link = document.getElementById('btn-next-study-link');
+    if (link) snap.next_study_text = (link.textContent || '').trim();
+    return snap;
+}
+"""
+
+# ページ状態を1回のexecute_scriptでまとめて取得するスクリプト
+# arguments[0]: {キー: 要素ID}
+PAGE_SNAPSHOT_JS = SNAPSHOT_FUNCTION_JS + """
+return __mplSnapshot(arguments[0] || {});
+"""
+
+# ページにMutationObserverとプレイヤー監視を仕込み、状態変化を window.__mplObserver.events に積む。
+# 変化が起きるか timeout になるまで待ってからスナップショットを返す（execute_async_scriptで長時間ポーリング）
+# arguments[0]: {キー: 要素ID}, arguments[1]: 待機上限(ms)
+WAIT_PAGE_EVENT_JS = SNAPSHOT_FUNCTION_JS + """
+var ids = arguments[0] || {};
+var timeoutMs = arguments[1];
+var done = arguments[arguments.length - 1];
+var installed = false;
+
+if (!window.__mplObserver) {
+    var obs = {events: [], waiter: null, state: {}};
+    obs.push = function(ev) {
+        ev.t = Date.now();
+        obs.events.push(ev);
+        if (obs.events.length > 50) obs.events.shift();
+        if (obs.waiter) {
+            var wake = obs.waiter;
+            obs.waiter = null;
+            wake();
+        }
+    };
+    obs.check = function(silent) {
+        for (var key in ids) {
+            var v = __mplVisible(document.getElementById(ids[key]));
+            if (obs.state[key] !== v) {
+                obs.state[key] = v;
+                if (!silent) obs.push({type: 'control', key: key, visible: v});
+            }
+        }
+        var p = __mplPlayer();
+        var paused = p ? p.paused : null;
+        if (obs.state.__paused !== paused) {
+            obs.state.__paused = paused;
+            if (!silent && paused !== null) obs.push({type: paused ? 'pause' : 'play'});
+        }
+        var ended = !!(p && p.duration && p.time !== null && p.time >= p.duration - 0.5);
+        if (obs.state.__ended !== ended) {
+            obs.state.__ended = ended;
+            if (!silent && ended) obs.push({type: 'ended'});
+        }
+    };
+    // DOM変化はまとめて50ms後に判定（ボタン表示の切り替えを検出）
+    var pending = false;
+    obs.mutation = new MutationObserver(function() {
+        if (pending) return;
+        pending = true;
+        setTimeout(function() { pending = false; obs.check(false); }, 50);
+    });
+    obs.mutation.observe(document.documentElement, {
+        subtree: true, childList: true, attributes: true,
+        attributeFilter: ['style', 'class', 'hidden', 'disabled']
+    });
+    // 同一オリジンのvideo要素があればイベントを直接受け取る
+    var videos = Array.prototype.slice.call(document.querySelectorAll('video'));
+    var frames = document.querySelectorAll('iframe');
+    for (var i = 0; i < frames.length; i++) {
+        try { videos = videos.concat(Array.prototype.slice.call(frames[i].contentDocument.querySelectorAll('video'))); } catch (e) {}
+    }
+    videos.forEach(function(video) {
+        ['pause', 'play', 'ended'].forEach(function(name) {
+            video.addEventListener(name, function() { obs.push({type: name}); });
+        });
+    });
+    // プレイヤーAPIの一時停止はDOMに現れないので、ページ内で1秒ごとに確認（WebDriver通信は発生しない）
+    obs.timer = setInterval(function() { obs.check(false); }, 1000);
+    obs.check(true);
+    window.__mplObserver = obs;
+    installed = true;
+}
+
+var observer = window.__mplObserver;
+var timer = null;
+function finish() {
+    if (timer !== null) clearTimeout(timer);
+    if (observer.waiter === finish) observer.waiter = null;
+    var snap = __mplSnapshot(ids);
+    snap.events = observer.events;
+    snap.installed = installed;
+    observer.events = [];
+    done(snap);
+}
+if (installed || observer.events.length > 0) {
+    finish();
+} else {
+    timer = setTimeout(finish, timeoutMs);
+    observer.waiter = finish;
+}
+"""
+
+# プレイヤーのAPIで arguments[0] 秒にシークして再生するスクリプト（シークのAPIがなければ 'no_seek'）
+SEEK_PLAYER_JS = """
+if (typeof player === 'undefined' || !player || !player.accessor) return 'no_player';
+var acc = player.accessor;
+var names = ['seek', 'setCurrentTime'];
+for (var i = 0; i < names.length; i++) {
+    if (typeof acc[names[i]] === 'function') {
+        acc[names[i]](arguments[0]);
+        acc.play();
+        return 'seeked';
+    }
+}
+return 'no_seek';
+"""
+
+# 一時停止中なら再生を再開するスクリプト
+RESUME_PLAYER_JS = """
+if (typeof player !== 'undefined' && player && player.accessor) {
+    if (player.accessor.isPaused() === true) {
+        player.accessor.play();
+        return 'resumed';
+    }
+    return 'playing';
+}
+return 'no_player';
+"""
+
+# マイページの講座リンクを1回のスクリプトで集めて索引を作る（読み込み途中ならnull）
+# 戻り値: {ready: true, index: {講座ID: {anchor_id, args: lnkNewLesson_OnClick の引数, type: 講座の種類,
+#          area: 'slider'/'accordion'/'other'}}}（リンクの引数が読めないページでは index が空）
+MYPAGE_INDEX_JS = """
+if (document.readyState !== 'complete') return null;
+var index = {};
+var pattern = /lnkNewLesson_OnClick\\s*\\(([^)]*)\\)/;
+var anchors = document.querySelectorAll('a');
+for (var i = 0; i < anchors.length; i++) {
+    var a = anchors[i];
+    var m = pattern.exec((a.getAttribute('onclick') || '') + ' ' + (a.getAttribute('href') || ''));
+    if (!m) continue;
+    var args = m[1].split(',').map(function(s) {
+        s = s.trim();
+        if (/^(['"]).*\\1$/.test(s)) return s.slice(1, -1);
+        var n = Number(s);
+        return (s === '' || isNaN(n)) ? s : n;
+    });
+    var lessonId = String(args[0]);
+    // 同じ講座が新着とアコーディオンの両方にあれば、直接クリックできる新着を使う
+    if (index[lessonId] && index[lessonId].area === 'slider') continue;
+    var area = a.closest('[class*="slider"], [class*="swiper"], [class*="carousel"]') ? 'slider'
+        : a.closest('[class*="accordion"], [class*="collapse"]') ? 'accordion' : 'other';
+    index[lessonId] = {anchor_id: a.id || String(args[3] || ''), args: args, type: args[1], area: area};
+}
+if (typeof lnkNewLesson_OnClick !== 'function' && Object.keys(index).length === 0) return null;
+return {ready: true, index: index};
+"""
+
+# EQプレイヤーのAPIが使えるか
+PLAYER_READY_JS = """
+return typeof player !== 'undefined' && !!player && !!player.accessor;
+"""
+
+# EQプレイヤーが再生中か
+PLAYER_PLAYING_JS = """
+try {
+    return typeof player !== 'undefined' && !!player && !!player.accessor && player.accessor.isPaused() === false;
+} catch (e) {
+    return false;
+}
+"""
+
+# 遷移先ページの種類（'player': 動画ページ, 'other': テスト・アンケートなど, 未確定ならfalse）
+PAGE_KIND_JS = """
+if (typeof player !== 'undefined' && player && player.accessor) return 'player';
+if (document.readyState === 'complete' && (
+        document.getElementById('ctl00_examBody_lnkExamAnswerSubmit') ||
+        document.getElementById('ctl00_examBody_cmdNext') ||
+        document.getElementById('panel-end-label') ||
+        document.title.indexOf('確認テスト') >= 0 ||
+        document.title.indexOf('アンケート') >= 0)) return 'other';
+return false;
+"""
+
+# ウィンドウの種類判定用にタイトルとURLを1回で取得するスクリプト
+WINDOW_INFO_JS = """
+return {title: document.title, url: location.href};
+"""
+
+
+def is_lesson_window(info):
+    """タイトルまたはURLからレッスン画面（動画・確認テスト・アンケート）か判定"""
+    title, url = info["title"], info["url"]
+    return ("レッスン" in title or "Lesson" in title or "LessonStudy" in url
+            or "確認テスト" in title or "アンケート" in title)
+
+
+def is_lesson_url(info):
+    """URLだけでレッスン画面か判定（予約時の補助判定用）"""
+    return "LessonStudyFixed" in info["url"] or "Lesson" in info["url"]
+
+
+# 受講の状態（状態ごとに、そこから抜ける条件だけを調べる）
+# 状態は「ポップアップで最後に済ませた操作」を表し、その次に出るはずのページを待つ
+VIDEO_PLAYING = "VIDEO_PLAYING"  # 動画を再生中（「次の学習へ」「テストへ」が出るのを待つ）
+VIDEO_ENDED = "VIDEO_ENDED"      # 「次の学習へ」をクリック済み（次の動画か確認テストを待つ）
+EXAM = "EXAM"                    # 答案を提出済み（解説画面を待つ）
+EXPLANATION = "EXPLANATION"      # 解説の「次へ」をクリック済み（アンケートを待つ）
+SURVEY = "SURVEY"                # アンケートの「終了」をクリック済み（ポップアップが閉じるのを待つ）
+POPUP_CLOSED = "POPUP_CLOSED"    # ポップアップがない（新しいポップアップを探す）
+OPENING_NEXT = "OPENING_NEXT"    # 予約リストの次の講座を開いている
+# 監視開始直後や想定外のページでは状態は None（全コントロールを調べてページから決め直す）
+
+# 状態ごとにスナップショットで調べるコントロール（ページを調べない状態は含めない）
+STATE_CONTROLS = {
+    None: tuple(CONTROL_IDS),
+    VIDEO_PLAYING: ("next_study",),
+    VIDEO_ENDED: ("next_study", "exam_submit"),
+    EXAM: ("exam_submit", "exam_next"),
+    EXPLANATION: ("exam_next", "survey_end"),
+    SURVEY: ("survey_end",),
+}
+
+# 遷移の条件（スナップショット → bool）
+STATE_CONDITIONS = {
+    "next_study": lambda snap: bool(snap["controls"].get("next_study")),
+    "exam_submit": lambda snap: "確認テスト" in snap["title"] and bool(snap["controls"].get("exam_submit")),
+    "exam_next": lambda snap: bool(snap["controls"].get("exam_next")),
+    "survey_end": lambda snap: "アンケート" in snap["title"] and bool(snap["controls"].get("survey_end")),
+    "paused": lambda snap: snap["player"] is not None and (
+        snap["player"]["paused"] is True or (snap.get("playback") or {}).get("status") == "paused"),
+    "stalled": lambda snap: (snap.get("playback") or {}).get("status") == "stalled",
+    "player": lambda snap: snap["player"] is not None,
+    # 読み込み途中のレッスン画面（プレイヤーもテストのコントロールもまだない）
+    "loading": lambda snap: snap["player"] is None and is_lesson_window(snap)
+        and "確認テスト" not in snap["title"] and "アンケート" not in snap["title"],
+}
+
+# 遷移表: 状態 → ((条件, 次の状態, 処理), ...)  上から順に調べて最初に満たした行を使う
+STATE_TRANSITIONS = {
+    VIDEO_PLAYING: (
+        ("next_study", VIDEO_ENDED, "click_next_study"),
+        ("paused", VIDEO_PLAYING, "resume_player"),
+        ("stalled", VIDEO_PLAYING, "recover_playback"),
+        ("player", VIDEO_PLAYING, "show_progress"),
+    ),
+    VIDEO_ENDED: (
+        ("exam_submit", EXAM, "answer_exam"),
+        ("next_study", VIDEO_ENDED, "click_next_study"),  # クリックが効かなかった
+        ("player", VIDEO_PLAYING, "start_player"),
+        ("loading", VIDEO_ENDED, "await_page"),
+    ),
+    EXAM: (
+        ("exam_next", EXPLANATION, "click_exam_next"),
+        ("exam_submit", EXAM, "answer_exam"),            # 提出が効かなかった
+    ),
+    EXPLANATION: (
+        ("survey_end", SURVEY, "click_survey_end"),
+        ("exam_next", EXPLANATION, "click_exam_next"),
+    ),
+    SURVEY: (
+        ("survey_end", SURVEY, "click_survey_end"),
+    ),
+}
+
+
+def classify_page(snap):
+    """全コントロールを調べたスナップショットから、そのページを処理する状態を決める（分からなければNone）"""
+    title = snap["title"]
+    if snap["player"] is not None:
+        return VIDEO_PLAYING
+    if "アンケート" in title:
+        return EXPLANATION
+    if "確認テスト" in title:
+        return EXAM if snap["controls"].get("exam_next") else VIDEO_ENDED
+    if is_lesson_window(snap):
+        return VIDEO_ENDED
+    return None
+
+
+def decide(state, snap, queued=0):
+    """現在の状態とスナップショットから (次の状態, 処理) を決める
+    
+    snap が None ならポップアップが閉じている。queued は予約リストの残り件数。
+    WebDriverには触らないので、記録したスナップショットで同じ判断を再現できる
+    """
+    if state == OPENING_NEXT:
+        return OPENING_NEXT, "wait_open"
+    if state == POPUP_CLOSED:
+        return POPUP_CLOSED, "find_popup"
+    if snap is None:
+        if queued > 0:
+            return OPENING_NEXT, "open_next"
+        return POPUP_CLOSED, "lesson_done"
+    
+    classified = state is None
+    if classified:
+        state = classify_page(snap)
+        if state is None:
+            return None, "wait"
+    for condition, next_state, action in STATE_TRANSITIONS[state]:
+        if STATE_CONDITIONS[condition](snap):
+            return next_state, action
+    # この状態からの条件に当てはまらない → 想定外のページなので全コントロールを調べ直す
+    return (state if classified else None), "wait"
+
+
+class WindowRegistry:
+    """ブラウザのウィンドウハンドルと、各ウィンドウのタイトル・URLの記録
+    
+    既知のハンドル集合との差分で新しいウィンドウを検出し、種類の判定は
+    ウィンドウごとに1回だけ行う（ページ遷移したら invalidate で破棄する）
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handles = []   # 最後に確認したハンドル一覧（開いた順）
+        self.info = {}      # ハンドル → {"title": ..., "url": ...}
+    
+    def update(self, handles):
+        """最新のハンドル一覧を反映し、(新しく開いたハンドル, 閉じたハンドル) を返す"""
+        with self.lock:
+            known = set(self.handles)
+            current = set(handles)
+            opened = [h for h in handles if h not in known]
+            closed = [h for h in self.handles if h not in current]
+            for handle in closed:
+                self.info.pop(handle, None)
+            self.handles = list(handles)
+            return opened, closed
+    
+    def remember(self, handle, title, url):
+        """ウィンドウのタイトル・URLを記録"""
+        with self.lock:
+            self.info[handle] = {"title": title, "url": url}
+    
+    def invalidate(self, handle):
+        """ページ遷移などで記録が古くなったウィンドウの判定結果を破棄"""
+        with self.lock:
+            self.info.pop(handle, None)
+    
+    def get(self, handle):
+        """記録済みのタイトル・URL（未判定ならNone）"""
+        with self.lock:
+            return self.info.get(handle)
+    
+    def count(self):
+        """最後に確認したウィンドウ数"""
+        with self.lock:
+            return len(self.handles)
+
+
+# WebDriverコマンドの優先度（小さいほど先に実行）
+PRIORITY_USER = 0        # ボタン操作など、ユーザーが待っている処理
+PRIORITY_MONITOR = 1     # 監視ループ・講座オープン
+PRIORITY_BACKGROUND = 2  # ウィンドウ数の表示更新など
+
+# コマンドが実行開始されるまでの既定の期限（秒）
+DEFAULT_COMMAND_DEADLINE = 60
+# コマンドの実行時間の既定の上限（秒）。イベント待機・ページの読み込みも収まる長さにする
+COMMAND_TIMEOUT = 45
+# chromedriverへのHTTP要求の上限（秒）。応答のないコマンドでも仲介スレッドがいずれ戻るように
+HTTP_TIMEOUT = COMMAND_TIMEOUT + 5
+# ページの読み込み（driver.get）の上限（秒）
+PAGE_LOAD_TIMEOUT = 30
+# バックグラウンドコマンドの上限（回/分）。超えた分は実行せずに捨てる
+BACKGROUND_RATE_LIMIT = 120
+
+
+class CommandDeadlineExceeded(Exception):
+    """WebDriverコマンドが期限までに実行されなかった"""
+
+
+class CommandTimeout(TimeoutException):
+    """WebDriverコマンドが実行時間の上限までに終わらなかった"""
+
+
+class FrameUnreachable(NoSuchElementException):
+    """直接つないだ接続ではiframeの中に入れない（ウィンドウを切り替えて入り直す）"""
+
+
+class CommandAbandoned(Exception):
+    """仲介スレッドが詰まったので、実行中・実行待ちのコマンドを見捨てた"""
+
+
+class DriverBroker:
+    """WebDriverを操作する唯一のスレッドと、優先度付きのコマンドキュー
+    
+    Tkスレッドと監視スレッドはWebDriverを直接触らず、ここにコマンド（driverを受け取る関数）を
+    投入して Future で結果を受け取る。ウィンドウ切り替えとその後の操作を1つのコマンドに
+    まとめれば、他のスレッドの操作が割り込むことはない
+    """
+    
+    def __init__(self):
+        self.driver = None
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = {}  # 読み取りコマンドのキー → 実行待ちのFuture（同じ読み取りをまとめる）
+        self.history = deque()  # 直近1分間のコマンド実行時刻
+        self.command_count = 0
+        self.running = None  # 実行中のコマンド (名前, 開始時刻, Future, 実行時間の上限)
+        self.abandoned = False
+        self.thread = threading.Thread(target=self._worker, name="driver-broker", daemon=True)
+        self.thread.start()
+    
+    def submit(self, name, fn, priority=PRIORITY_MONITOR, deadline=DEFAULT_COMMAND_DEADLINE, key=None,
+               timeout=COMMAND_TIMEOUT):
+        """コマンドを投入して Future を返す
+        
+        key を指定した読み取りコマンドは、同じキーのコマンドが実行待ちならそれと結果を共有する。
+        timeout はコマンドの実行時間の上限（見張りが詰まったとみなす目安）
+        """
+        with self.lock:
+            if key is not None and key in self.pending:
+                return self.pending[key]
+            future = Future()
+            if key is not None:
+                self.pending[key] = future
+        expires = time.monotonic() + deadline if deadline is not None else None
+        self.queue.put((priority, next(self.sequence), name, fn, expires, future, key, timeout))
+        return future
+    
+    def call(self, name, fn, priority=PRIORITY_MONITOR, deadline=DEFAULT_COMMAND_DEADLINE, key=None,
+             timeout=COMMAND_TIMEOUT):
+        """コマンドを投入して結果を待つ（コマンド内の例外はそのまま送出される）
+        
+        実行開始の期限 deadline と実行時間の上限 timeout を過ぎても終わらなければ
+        CommandTimeout を送出する（詰まったコマンドは見張りが仲介スレッドごと見捨てる）
+        """
+        future = self.submit(name, fn, priority, deadline, key, timeout)
+        limit = None if deadline is None or timeout is None else deadline + timeout
+        try:
+            return future.result(limit)
+        except FutureTimeoutError:
+            raise CommandTimeout(f"{name}: {limit:.0f}秒以内に終わりませんでした") from None
+    
+    def hung_command(self, grace):
+        """実行時間の上限を grace 秒過ぎても実行中のコマンドがあれば (名前, 秒数) を返す"""
+        running = self.running
+        if running is None:
+            return None
+        seconds = time.monotonic() - running[1]
+        limit = (running[3] if running[3] is not None else COMMAND_TIMEOUT) + grace
+        return (running[0], seconds) if seconds > limit else None
+    
+    def abandon(self):
+        """実行中・実行待ちのコマンドを CommandAbandoned で終わらせ、ワーカースレッドを止める
+        
+        実行中のコマンドはそのまま（HTTP要求の上限で）終わるのを待たず、終わったらスレッドも終わる
+        """
+        self.abandoned = True
+        running = self.running
+        futures = [running[2]] if running is not None else []
+        while True:
+            try:
+                futures.append(self.queue.get_nowait()[5])
+            except queue.Empty:
+                break
+        for future in futures:
+            if future is not None and not future.done():
+                try:
+                    future.set_exception(CommandAbandoned("仲介スレッドが応答しないため中止しました"))
+                except InvalidStateError:
+                    pass
+        self.stop()
+    
+    def rate_per_minute(self):
+        """直近1分間に実行したコマンド数"""
+        with self.lock:
+            self._trim_history(time.monotonic())
+            return len(self.history)
+    
+    def stop(self):
+        """ワーカースレッドを終了（実行待ちのコマンドは破棄）"""
+        self.queue.put((-1, next(self.sequence), None, None, None, None, None, None))
+    
+    def _trim_history(self, now):
+        while self.history and now - self.history[0] > 60:
+            self.history.popleft()
+    
+    def _worker(self):
+        while True:
+            priority, _, name, fn, expires, future, key, timeout = self.queue.get()
+            if fn is None:
+                return
+            with self.lock:
+                if key is not None and self.pending.get(key) is future:
+                    del self.pending[key]
+                now = time.monotonic()
+                self._trim_history(now)
+                over_limit = priority >= PRIORITY_BACKGROUND and len(self.history) >= BACKGROUND_RATE_LIMIT
+            if not future.set_running_or_notify_cancel():
+                continue
+            if over_limit or (expires is not None and now > expires):
+                future.set_exception(CommandDeadlineExceeded(f"{name}: 期限切れのため実行しませんでした"))
+                continue
+            if self.driver is None:
+                future.set_exception(RuntimeError(f"{name}: ブラウザが起動していません"))
+                continue
+            with self.lock:
+                self.history.append(now)
+                self.command_count += 1
+            self.running = (name, now, future, timeout)
+            try:
+                result = fn(self.driver)
+            except BaseException as e:
+                result, error = None, e
+            else:
+                error = None
+            self.running = None
+            if self.abandoned:
+                return  # 見捨てられた（結果は誰も待っていない）
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+# 今の文書に目印を付けてその値を返す関数（遷移待ちで、目印のない新しい文書に入れ替わったことを確かめる）
+MARK_PAGE_FUNCTION_JS = """
+function __mplMarkPage() {
+    var token = String(Date.now()) + ':' + Math.random();
+    window.__mplPageToken = token;
+    return token;
+}
 """
 
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
-from webdriver_manager.chrome import ChromeDriverManager
-import tkinter as tk
-from tkinter import messagebox
-import threading
-import time
+MARK_PAGE_JS = MARK_PAGE_FUNCTION_JS + "return __mplMarkPage();"
+
+# arguments[0] の目印を付けた文書から入れ替わったか
+PAGE_CHANGED_JS = "return window.__mplPageToken !== arguments[0];"
+
+# ボタンをページ内でクリックし、クリック前の文書の目印を返す（ボタンがなければ null）
+# WebDriverのクリックはウィンドウを前面に出すので使わない。arguments[0]: ボタンのID
+CLICK_CONTROL_JS = MARK_PAGE_FUNCTION_JS + """
+var button = document.getElementById(arguments[0]);
+if (!button) return null;
+var token = __mplMarkPage();
+button.click();
+return token;
+"""
+
+# 要素の中心の座標（ビューポート内のCSSピクセル。見えていなければ null）。arguments[0]: 要素のID
+ELEMENT_CENTER_JS = """
+var element = document.getElementById(arguments[0]);
+if (!element) return null;
+element.scrollIntoView({block: 'center'});
+var rect = element.getBoundingClientRect();
+if (rect.width === 0 || rect.height === 0) return null;
+return {x: rect.left + rect.width / 2, y: rect.top + rect.height / 2};
+"""
+
+
+def click_control(key):
+    """CONTROL_IDS のボタンをクリックするコマンドを作る（遷移待ち用にクリック前の文書の目印を返す）"""
+    def command(driver):
+        token = driver.execute_script(CLICK_CONTROL_JS, CONTROL_IDS[key])
+        if token is None:
+            raise NoSuchElementException(f"ボタンがありません: {CONTROL_IDS[key]}")
+        return token
+    return command
+
+
+def dispatch_click(driver, point):
+    """CDPの Input.dispatchMouseEvent で point をクリックする
+    
+    ブラウザには本物のマウス操作として届く（自動再生の制限を受けない）が、ウィンドウは前面に出ない
+    """
+    for event_type in ("mousePressed", "mouseReleased"):
+        driver.execute_cdp_cmd("Input.dispatchMouseEvent", {
+            "type": event_type, "x": point["x"], "y": point["y"], "button": "left", "clickCount": 1,
+        })
+
+
+# 索引の講座を開く。見えているリンクはページ内でクリックし、
+# それ以外（閉じたアコーディオンの中など）は lnkNewLesson_OnClick を索引と同じ引数で呼ぶ
+# arguments[0]: 索引の1件
+OPEN_LESSON_JS = SNAPSHOT_FUNCTION_JS + """
+var entry = arguments[0];
+var anchor = entry.anchor_id ? document.getElementById(entry.anchor_id) : null;
+if (anchor && __mplVisible(anchor)) {
+    anchor.click();
+    return 'clicked';
+}
+if (typeof lnkNewLesson_OnClick !== 'function') return 'no_function';
+lnkNewLesson_OnClick.apply(window, entry.args);
+return 'called';
+"""
+
+# プレイヤーiframe（クロスオリジン）内の<video>の状態を読むスクリプト（iframeに切り替えてから実行）
+VIDEO_STATE_JS = """
+var video = document.querySelector('video');
+if (!video) return null;
+return {
+    paused: video.paused,
+    ended: video.ended,
+    time: video.currentTime,
+    duration: isFinite(video.duration) ? video.duration : null,
+    ready_state: video.readyState
+};
+"""
+
+# プレイヤーiframe内の<video>を target 秒にシークして再生するスクリプト（reload なら読み込み直してから）
+# MSE（blob: URL）で再生している<video>は load() で中身を失うので、読み込み直さずに 'blob_source' を返す
+# 引数を渡せないので video_seek_script で値を埋め込む
+VIDEO_SEEK_JS = """
+var video = document.querySelector('video');
+if (!video) return 'no_video';
+var target = %(target)s;
+function resume() {
+    video.currentTime = isFinite(video.duration) ? Math.min(target, video.duration) : target;
+    video.muted = true;
+    video.play();
+}
+if (%(reload)s) {
+    if (String(video.currentSrc).indexOf('blob:') === 0) return 'blob_source';
+    video.addEventListener('loadedmetadata', resume, {once: true});
+    video.load();
+    return 'reloaded';
+}
+resume();
+return 'seeked';
+"""
+
+# プレイヤーiframe内の<video>を再生するスクリプト（iframeに切り替えてから実行）
+VIDEO_PLAY_JS = """
+var video = document.querySelector('video');
+if (!video) return 'no_video';
+video.muted = true;  // ミュートにして再生（オートプレイポリシー回避）
+video.play();
+return 'played';
+"""
+
+
+def video_seek_script(target, reload=False):
+    """VIDEO_SEEK_JS に戻る位置（秒）と読み込み直すかを埋め込む"""
+    return VIDEO_SEEK_JS % {"target": json.dumps(round(target, 3)), "reload": json.dumps(reload)}
+
+
+def in_player_frame(script):
+    """EQプレイヤーのiframeに切り替えてスクリプトを実行し、元の文書に戻るコマンドを作る
+    
+    プレイヤーはクロスオリジンのiframe（別プロセス）なので contentDocument では触れないが、
+    WebDriverのフレーム切り替えなら中のスクリプトを実行できる（TargetChannel ならiframeのセッションで実行し、
+    入れなければ drive がウィンドウを切り替えてこちらで実行し直す）
+    """
+    def command(driver):
+        if isinstance(driver, TargetChannel):
+            return driver.execute_in_frame("#eqPlayer iframe", script, marker="video")
+        frame = driver.find_element(By.CSS_SELECTOR, "#eqPlayer iframe")
+        driver.switch_to.frame(frame)
+        try:
+            return driver.execute_script(script)
+        finally:
+            driver.switch_to.default_content()
+    return command
+
+
+class CdpEventSource:
+    """CDP（Chrome DevTools Protocol）でウィンドウの生成・破棄とページ遷移を受け取る
+    
+    Page ドメインのイベント（frameNavigated / loadEventFired / windowOpen）は chromedriver の
+    パフォーマンスログに溜まるので、1回の get_log でまとめて取り出す。chromedriver はこのログに
+    Target ドメインのイベントを流さないため、ウィンドウの生成・破棄は Target.getTargets の差分から
+    targetCreated / targetDestroyed 相当のイベントを作る
+    """
+    
+    PAGE_EVENTS = ("Page.frameNavigated", "Page.loadEventFired", "Page.windowOpen")
+    
+    def __init__(self):
+        self.targets = {}  # targetId → {"title": ..., "url": ...}
+    
+    @staticmethod
+    def configure(options):
+        """ブラウザ起動オプションにパフォーマンスログ（Pageイベントのみ）を設定"""
+        options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": False, "enablePage": True})
+    
+    def drain(self, driver):
+        """溜まっているPageイベントを取り出す（[{"method", "target", "params"}, ...]）"""
+        events = []
+        for entry in driver.get_log("performance"):
+            message = json.loads(entry["message"])
+            method = message["message"].get("method")
+            if method in self.PAGE_EVENTS:
+                params = message["message"].get("params", {})
+                # iframe内の遷移は無視（ページ本体の遷移だけを扱う）
+                if method == "Page.frameNavigated" and params.get("frame", {}).get("parentId"):
+                    continue
+                events.append({"method": method, "target": message.get("webview"), "params": params})
+        return events
+    
+    def refresh_targets(self, driver):
+        """ページ（ウィンドウ）の一覧を取得し、前回との差分をイベントとして返す"""
+        infos = driver.execute_cdp_cmd("Target.getTargets", {})["targetInfos"]
+        current = {
+            info["targetId"]: {"title": info.get("title", ""), "url": info.get("url", "")}
+            for info in infos if info.get("type") == "page"
+        }
+        events = [
+            {"method": "Target.targetCreated", "target": target_id, "params": info}
+            for target_id, info in current.items() if target_id not in self.targets
+        ]
+        events += [
+            {"method": "Target.targetDestroyed", "target": target_id, "params": {}}
+            for target_id in self.targets if target_id not in current
+        ]
+        self.targets = current
+        return events
+
+
+# selector のiframeのURLと、親の文書から中に入れるか（同じオリジンか）。arguments[0]: selector
+FRAME_INFO_JS = """
+var frame = document.querySelector(arguments[0]);
+if (!frame) return null;
+var sameOrigin = false;
+try { sameOrigin = !!frame.contentDocument; } catch (e) {}
+return {src: frame.src, same_origin: sameOrigin};
+"""
+
+
+class TargetChannel:
+    """1つのウィンドウ（CDPのページターゲット）に直接つないだDevToolsの接続
+    
+    WebDriverのように操作するウィンドウを切り替える必要がないので、ウィンドウを前面に出さない。
+    drive に渡す driver の代わりに使えるよう、execute_script / execute_async_script /
+    execute_cdp_cmd / get / close をWebDriverと同じ形で持ち、エラーもSeleniumの例外で返す。
+    プレイヤーのクロスオリジンiframe（別プロセス）には自動アタッチしたセッションで入る
+    """
+    
+    def __init__(self, debugger_address, handle, on_command=None):
+        import websocket  # Seleniumが依存しているwebsocket-client
+        self.handle = handle
+        self.on_command = on_command  # on_command(コマンド名, 秒数) で所要時間を記録
+        self.script_timeout = EVENT_WAIT_TIMEOUT + 10
+        self.frame_sessions = {}  # 自動アタッチしたiframeのセッションID → URL
+        self.ids = itertools.count(1)
+        target_id = handle.replace("CDwindow-", "")
+        try:
+            self.socket = websocket.create_connection(
+                f"ws://{debugger_address}/devtools/page/{target_id}",
+                timeout=CHANNEL_CONNECT_TIMEOUT, suppress_origin=True,
+            )
+        except websocket.WebSocketBadStatusException as e:
+            raise NoSuchWindowException(f"ウィンドウがありません: {handle}") from e
+        # ウィンドウが前面になくてもフォーカスがあるように見せる（blurで止まるプレイヤー対策）
+        self.execute_cdp_cmd("Emulation.setFocusEmulationEnabled", {"enabled": True})
+        try:
+            self.execute_cdp_cmd("Target.setAutoAttach", {
+                "autoAttach": True, "waitForDebuggerOnStart": False, "flatten": True,
+            })
+        except WebDriverException as e:
+            logger.debug("iframeへの自動アタッチを使えません: %s", e)
+    
+    def execute_cdp_cmd(self, method, params=None, session_id=None, timeout=None):
+        """CDPコマンドを送って結果を返す（待っている間に届いたイベントは読み捨てる）"""
+        import websocket
+        message_id = next(self.ids)
+        message = {"id": message_id, "method": method, "params": params or {}}
+        if session_id is not None:
+            message["sessionId"] = session_id
+        started = time.perf_counter()
+        try:
+            self.socket.settimeout(timeout or CHANNEL_CONNECT_TIMEOUT)
+            self.socket.send(json.dumps(message))
+            while True:
+                reply = json.loads(self.socket.recv())
+                if reply.get("id") == message_id:
+                    break
+                self.on_event(reply)
+        except websocket.WebSocketTimeoutException as e:
+            raise TimeoutException(f"{method}: 応答がありません") from e
+        except (websocket.WebSocketException, OSError) as e:
+            raise NoSuchWindowException(f"ウィンドウとの接続が切れました: {self.handle}") from e
+        finally:
+            if self.on_command is not None:
+                self.on_command(f"cdp:{method}", time.perf_counter() - started)
+        if "error" in reply:
+            message = reply["error"].get("message", "")
+            if "No target" in message or "Target closed" in message:
+                raise NoSuchWindowException(message)
+            # 遷移で文書が入れ替わった（WebDriverの実行中の遷移と同じ扱い）など
+            raise JavascriptException(f"{method}: {message}")
+        return reply.get("result", {})
+    
+    def on_event(self, event):
+        method = event.get("method")
+        params = event.get("params", {})
+        if method == "Target.attachedToTarget" and params.get("targetInfo", {}).get("type") == "iframe":
+            self.frame_sessions[params["sessionId"]] = params["targetInfo"].get("url", "")
+        elif method == "Target.detachedFromTarget":
+            self.frame_sessions.pop(params.get("sessionId"), None)
+    
+    def evaluate(self, expression, await_promise=False, session_id=None):
+        """式を評価して値を返す（ユーザー操作として実行するので、ポップアップ・自動再生の制限を受けない）"""
+        result = self.execute_cdp_cmd("Runtime.evaluate", {
+            "expression": expression,
+            "returnByValue": True,
+            "awaitPromise": await_promise,
+            "userGesture": True,
+        }, session_id, timeout=self.script_timeout)
+        if "exceptionDetails" in result:
+            details = result["exceptionDetails"]
+            raise JavascriptException(details.get("exception", {}).get("description") or details.get("text", ""))
+        return result.get("result", {}).get("value")
+    
+    def execute_script(self, script, *args):
+        return self.evaluate(f"(function() {{\n{script}\n}}).apply(null, {json.dumps(list(args))})")
+    
+    def execute_async_script(self, script, *args):
+        """WebDriverと同じく、最後の引数のコールバックに渡された値を返す"""
+        return self.evaluate(
+            f"new Promise(function(done) {{ (function() {{\n{script}\n}}).apply(null, {json.dumps(list(args))}.concat([done])); }})",
+            await_promise=True,
+        )
+    
+    def execute_in_frame(self, selector, script, marker=None):
+        """selector のiframeの中でスクリプトを実行する
+        
+        同じオリジンなら親の文書から contentDocument を document として渡して実行する。
+        クロスオリジン（別プロセス）なら、自動アタッチしたセッションのうちiframeのURLと同じオリジンの
+        セッションで実行する（広告などの別のiframeでは実行しない）。同じオリジンのセッションがなければ、
+        marker（CSSセレクタ）に当たる要素のあるセッションを探す。どれでも入れなければ FrameUnreachable
+        """
+        frame = self.execute_script(FRAME_INFO_JS, selector)
+        if frame is None:
+            raise NoSuchElementException(f"iframeがありません: {selector}")
+        if frame["same_origin"]:
+            return self.execute_script(
+                f"var frame = document.querySelector({json.dumps(selector)});"
+                f"return (function(document) {{\n{script}\n}})(frame.contentDocument);"
+            )
+        expression = f"(function() {{\n{script}\n}})()"
+        origin = urlsplit(frame["src"])[:2]
+        sessions = list(reversed(list(self.frame_sessions.items())))  # 新しくアタッチした順
+        matching = [session_id for session_id, url in sessions if urlsplit(url)[:2] == origin]
+        others = [session_id for session_id, url in sessions if session_id not in matching] if marker else []
+        for session_id in matching + others:
+            try:
+                if session_id in others and not self.evaluate(
+                        f"!!document.querySelector({json.dumps(marker)})", session_id=session_id):
+                    continue
+                return self.evaluate(expression, session_id=session_id)
+            except JavascriptException:
+                self.frame_sessions.pop(session_id, None)  # 閉じたiframe
+        raise FrameUnreachable(f"iframeの中に入れません: {selector}")
+    
+    def get(self, url):
+        """url を開いて読み込みが終わるまで待つ"""
+        result = self.execute_cdp_cmd("Page.navigate", {"url": url}, timeout=STEP_TIMEOUTS["navigation"])
+        if result.get("errorText"):
+            raise WebDriverException(f"{url}: {result['errorText']}")
+        end = time.monotonic() + STEP_TIMEOUTS["navigation"]
+        while time.monotonic() < end:
+            try:
+                if self.evaluate("document.readyState") == "complete":
+                    return
+            except JavascriptException:
+                pass  # 読み込み中で文書が入れ替わった
+            time.sleep(WAIT_POLL_INTERVAL)
+        raise TimeoutException(f"{url}: 読み込みが終わりません")
+    
+    def close(self):
+        """ウィンドウを閉じる"""
+        try:
+            self.execute_cdp_cmd("Page.close")
+        except NoSuchWindowException:
+            pass  # 応答より先に接続が切れた
+        self.disconnect()
+    
+    def disconnect(self):
+        try:
+            self.socket.close()
+        except Exception:
+            pass
+
+
+def playback_position(snap):
+    """スナップショットから (再生位置, 動画の長さ) を取り出す（分からなければNone）"""
+    player_state = snap.get("player") or {}
+    video = snap.get("video") or {}
+    position = player_state.get("time")
+    duration = player_state.get("duration")
+    if position is None:
+        position = video.get("time")
+    if duration is None:
+        duration = video.get("duration")
+    return position, duration
+
+
+def next_wakeup(snap, pause_check_interval):
+    """再生中のスナップショットから、次にページを調べるまで眠る秒数を決める（見積もれなければNone）
+    
+    終了予定の NEAR_END_MARGIN 秒前までは長く眠り（ただし一時停止の確認のため
+    pause_check_interval 秒まで）、終了間際は NEAR_END_POLL_INTERVAL ごとに確認する。
+    バッファリング中は STALL_POLL_INTERVAL ごとに確認する
+    """
+    if (snap.get("playback") or {}).get("status") in ("buffering", "stalled"):
+        return STALL_POLL_INTERVAL  # 進み始めたか、復旧が要るかをすぐ確かめる
+    position, duration = playback_position(snap)
+    if position is None or not duration:
+        return None
+    remaining = duration - position
+    if remaining > NEAR_END_MARGIN:
+        return min(remaining - NEAR_END_MARGIN, pause_check_interval)
+    return NEAR_END_POLL_INTERVAL
+
+
+class PlaybackWatch:
+    """再生位置の進み方から、再生中・バッファリング・停滞・一時停止・終了を見分ける
+    
+    監視ループがスナップショットを取るたびに update を呼ぶ。最後に再生が進んでいたと見積もれる時刻からの
+    秒数で判定し（長く眠った後でも、途中で止まっていれば止まった時刻から数える）、バッファリング・停滞と
+    判定している間の秒数を停滞で失った時間として数える。前回から進んだ再生位置が経過時間に
+    BUFFERING_DETECT_SECONDS 以上足りなくなければ普通に進んでいる扱い（コマンドの遅れや、
+    秒単位でしか位置を返さないプレイヤーの誤差は停滞と数えない）
+    """
+    
+    def __init__(self):
+        self.reset(None)
+    
+    def reset(self, url):
+        """別の動画（ページ）に移ったので数え直す"""
+        self.url = url
+        self.sampled_at = None   # 前回のスナップショットの時刻
+        self.position = None     # 前回の再生位置
+        self.progress_at = None  # 最後に再生が進んでいたと見積もれる時刻
+        self.advanced = False    # 前回から再生位置が進んだか
+        self.recoveries = 0      # 今の停滞で復旧を試した回数（普通に進み始めたら0に戻す）
+        self.lost = 0.0          # この動画で停滞により失った秒数
+        self.counted = 0.0       # 今の停滞で lost に数えた秒数
+        self.status = None       # 前回の判定
+    
+    def update(self, now, snap):
+        """スナップショットを1件取り込んで再生の状態（classify の戻り値）を返す
+        
+        戻り値の lost_delta は今回新たに数えた、停滞で失った秒数
+        """
+        if snap["url"] != self.url:
+            self.reset(snap["url"])
+        position, duration = playback_position(snap)
+        if position is None or self.position is None or self.is_paused(snap) or self.is_ended(snap):
+            # 進まないのが当たり前なので数えない
+            self.progress(now)
+            self.advanced = False
+        else:
+            elapsed = now - self.sampled_at
+            advance = max(0.0, position - self.position)  # 少し前へのシークで戻った分は進んでいない扱い
+            self.advanced = advance > 0
+            if self.advanced and elapsed - advance < BUFFERING_DETECT_SECONDS:
+                self.progress(now)
+            elif self.advanced:
+                # 前回から advance 秒だけ再生して、そこで止まったと見積もる
+                self.progress_at = max(self.progress_at, self.sampled_at + advance)
+        self.sampled_at, self.position = now, position
+        playback = self.classify(snap, now)
+        lost = 0.0
+        if playback["status"] in ("buffering", "stalled"):
+            stalled_for = now - self.progress_at
+            lost = max(0.0, stalled_for - self.counted)
+            self.counted = max(self.counted, stalled_for)
+            self.lost += lost
+            playback["lost"] = round(self.lost, 1)
+        return dict(playback, lost_delta=round(lost, 3))
+    
+    def progress(self, now):
+        """普通に進んでいる（今の停滞は終わった）"""
+        self.progress_at = now
+        self.recoveries = 0
+        self.counted = 0.0
+    
+    def recovering(self, now):
+        """復旧を試した（効き目が出るまで STALL_RECOVER_SECONDS は停滞と判定しない）"""
+        self.recoveries += 1
+        self.progress_at = now
+        self.counted = 0.0
+    
+    def classify(self, snap, now):
+        """取り込んだ進み方とスナップショットから再生の状態を決める
+        
+        status: "playing" / "buffering"（遅れている） / "stalled"（復旧が要る） / "paused" / "ended" / "unknown"
+        """
+        position, duration = playback_position(snap)
+        ready_state = (snap.get("video") or {}).get("ready_state")
+        stalled_for = now - self.progress_at if self.progress_at is not None else 0.0
+        if position is None:
+            status = "unknown"
+        elif self.is_ended(snap):
+            status = "ended"
+        elif self.is_paused(snap):
+            status = "paused"
+        elif not self.advanced and stalled_for >= STALL_RECOVER_SECONDS:
+            status = "stalled"
+        elif stalled_for >= BUFFERING_DETECT_SECONDS or (
+                not self.advanced and ready_state is not None and ready_state < HAVE_FUTURE_DATA):
+            status = "buffering"
+        else:
+            status = "playing"
+        self.status = status
+        return {
+            "status": status,
+            "stalled_for": round(stalled_for, 1),
+            "lost": round(self.lost, 1),
+            "ready_state": ready_state,
+        }
+    
+    @staticmethod
+    def is_paused(snap):
+        """プレイヤーか<video>が一時停止している"""
+        player_state = snap.get("player") or {}
+        video = snap.get("video") or {}
+        return player_state.get("paused") is True or video.get("paused") is True
+    
+    @staticmethod
+    def is_ended(snap):
+        """動画が最後まで再生された"""
+        position, duration = playback_position(snap)
+        if (snap.get("video") or {}).get("ended"):
+            return True
+        return position is not None and bool(duration) and position >= duration - ENDED_MARGIN
+
+
+def format_seconds(seconds):
+    """秒数を m:ss 形式にする"""
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def handle_for_target(target_id, handles):
+    """CDPのtargetIdに対応するウィンドウハンドル（chromedriverのハンドルはtargetIdそのもの）"""
+    for handle in handles:
+        if handle == target_id or handle == f"CDwindow-{target_id}":
+            return handle
+    return target_id
+
+
+logger = logging.getLogger("mp_learning")
+
+
+class RateLimitFilter(logging.Filter):
+    """同じメッセージが短時間に繰り返されたら間引く（次に出すときに省略した回数を添える）"""
+    
+    def __init__(self, interval=LOG_REPEAT_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = {}  # (レベル, メッセージ) → (最後に出した時刻, 省略した回数)
+    
+    def filter(self, record):
+        message = record.getMessage()
+        key = (record.levelno, message)
+        now = time.monotonic()
+        with self.lock:
+            last, suppressed = self.last.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self.last[key] = (last, suppressed + 1)
+                return False
+            if len(self.last) > 1000:
+                self.last.clear()
+            self.last[key] = (now, 0)
+        if suppressed:
+            record.msg = "%s（直前の同じメッセージを%d回省略）"
+            record.args = (message, suppressed)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ログをキューに積むだけのハンドラ（キューが一杯なら捨てて、呼び出し元を待たせない）"""
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class RingBufferHandler(logging.Handler):
+    """直近のログを決まった行数だけメモリに残す（GUIのログ欄に表示）"""
+    
+    def __init__(self, capacity=LOG_RING_SIZE):
+        super().__init__()
+        self.lines = deque(maxlen=capacity)
+        self.version = 0  # 追加されるたびに増える（表示の更新要否の判定用）
+    
+    def emit(self, record):
+        self.lines.append(self.format(record))
+        self.version += 1
+
+
+def setup_logging(verbose=False, console=sys.stdout):
+    """ログ出力を設定して (QueueListener, RingBufferHandler) を返す
+    
+    呼び出し元はキューに積むだけで、ファイル（ローテーション）・メモリ・コンソール（console）への
+    書き込みは QueueListener のスレッドが行う
+    """
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%H:%M:%S")
+    handlers = []
+    
+    ring = RingBufferHandler()
+    ring.setFormatter(formatter)
+    handlers.append(ring)
+    
+    try:
+        log_path = get_app_dir("logs", "mp_learning.log")
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        file_handler = RotatingFileHandler(
+            log_path, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s"))
+        handlers.append(file_handler)
+    except OSError:
+        pass  # ログファイルが作れなくても動作に支障なし
+    
+    # exe化（コンソールなし）では標準出力が無い
+    if console is not None:
+        console_handler = logging.StreamHandler(console)
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+    
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+    logger.handlers = [queue_handler]
+    logger.propagate = False
+    set_verbose(verbose)
+    
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=False)
+    listener.start()
+    return listener, ring
+
+
+def set_verbose(verbose):
+    """詳細ログ（DEBUG）の出力を切り替える（オフなら debug 呼び出しはほぼ無コスト）"""
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+
+def get_app_dir(*parts):
+    """アプリのデータ保存先（Windowsは %LOCALAPPDATA%、それ以外はホーム直下）のパスを返す"""
+    base = os.environ.get("LOCALAPPDATA")
+    if base:
+        root = os.path.join(base, APP_DIR_NAME)
+    else:
+        root = os.path.join(os.path.expanduser("~"), "." + APP_DIR_NAME)
+    return os.path.join(root, *parts)
+
+
+def detect_chrome_version():
+    """インストール済みChromeのバージョンをネットワークを使わずに調べる（不明ならNone）"""
+    if sys.platform == "win32":
+        try:
+            import winreg
+            for root in (winreg.HKEY_CURRENT_USER, winreg.HKEY_LOCAL_MACHINE):
+                try:
+                    with winreg.OpenKey(root, r"Software\Google\Chrome\BLBeacon") as key:
+                        return winreg.QueryValueEx(key, "version")[0]
+                except OSError:
+                    continue
+        except ImportError:
+            pass
+        return None
+    
+    if sys.platform == "darwin":
+        commands = [["/Applications/Google Chrome.app/Contents/MacOS/Google Chrome", "--version"]]
+    else:
+        commands = [[name, "--version"] for name in ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser")]
+    for command in commands:
+        try:
+            output = subprocess.run(command, capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.SubprocessError):
+            continue
+        match = re.search(r"(\d+\.\d+\.\d+\.\d+)", output)
+        if match:
+            return match.group(1)
+    return None
+
+
+def cached_driver_path(major):
+    """Chromeのメジャーバージョンに対応するキャッシュ済みchromedriverのパス"""
+    name = "chromedriver.exe" if sys.platform == "win32" else "chromedriver"
+    return get_app_dir("drivers", str(major), name)
+
+
+def store_driver(path, major):
+    """chromedriverをキャッシュにコピー（次回以降はネットワークなしで起動できる）"""
+    if not path or not major or not os.path.exists(path):
+        return
+    target = cached_driver_path(major)
+    if os.path.abspath(path) == os.path.abspath(target):
+        return
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(path, target)
+        logger.info("chromedriverをキャッシュしました: %s", target)
+    except OSError as e:
+        logger.warning("chromedriverのキャッシュに失敗: %s", e)
+
+
+def load_selenium():
+    """Selenium本体を読み込む（読み込み済みなら何もしない。どのスレッドから呼んでもよい）
+    
+    読み込みにかかった秒数を返す（読み込み済みなら0）
+    """
+    global webdriver, Service, By, Options, EC
+    with SELENIUM_LOCK:
+        if webdriver is not None:
+            return 0.0
+        started = time.perf_counter()
+        from selenium.webdriver.chrome.service import Service
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium import webdriver as chrome_webdriver
+        webdriver = chrome_webdriver  # 読み込み済みの目印なので最後に設定する
+        seconds = time.perf_counter() - started
+    logger.debug("Seleniumの読み込み: %.0fms", seconds * 1000)
+    return seconds
+
+
+def process_uptime():
+    """プロセスが起動してからの秒数（exeの展開・Pythonの初期化を含む。psutilがなければNone）"""
+    if psutil is None:
+        return None
+    try:
+        return time.time() - psutil.Process().create_time()
+    except psutil.Error:
+        return None
+
+
+def resolve_driver_service(refresh=False):
+    """chromedriverの Service と取得元（"キャッシュ" / "Selenium Manager" / "ダウンロード"）を返す
+    
+    インストール済みChromeのメジャーバージョンに合うドライバがキャッシュにあれば、
+    ネットワークを使わずにそれを使う。なければ Selenium Manager に任せる（Service にパスを
+    指定しない）。refresh=True のときだけ webdriver_manager で明示的にダウンロードし直す
+    """
+    version = detect_chrome_version()
+    major = version.split(".")[0] if version else None
+    if refresh:
+        from webdriver_manager.chrome import ChromeDriverManager  # 使うのは再取得のときだけ
+        path = ChromeDriverManager().install()
+        store_driver(path, major)
+        return Service(path), "ダウンロード", major
+    if major and os.path.exists(cached_driver_path(major)):
+        return Service(cached_driver_path(major)), "キャッシュ", major
+    return Service(), "Selenium Manager", major
+
+
+class ResourceSampler:
+    """chromedriver配下のChromeプロセス全体のCPU使用率とメモリ（RSS）を測る（psutilが必要）"""
+    
+    def __init__(self, root_pid):
+        self.root_pid = root_pid
+        self.processes = {}  # pid → psutil.Process（CPU使用率は前回からの差分で測るので使い回す）
+    
+    def sample(self):
+        """(CPU使用率%, RSS MB) を返す（測れなければNone）"""
+        if psutil is None or self.root_pid is None:
+            return None
+        try:
+            root = psutil.Process(self.root_pid)
+            current = {p.pid: p for p in [root] + root.children(recursive=True)}
+        except psutil.Error:
+            return None
+        cpu = 0.0
+        rss = 0
+        for pid, proc in current.items():
+            proc = self.processes.get(pid, proc)
+            current[pid] = proc
+            try:
+                cpu += proc.cpu_percent(None)
+                rss += proc.memory_info().rss
+            except psutil.Error:
+                continue
+        self.processes = current
+        return cpu, rss / (1024 * 1024)
+    
+    def memory_by_type(self):
+        """Chromeのプロセスの種類（browser / renderer / gpu-process / utility など）ごとのRSS（MB）
+        
+        CPU使用率の計測とは別に、その都度プロセスを調べ直す（測れなければNone）
+        """
+        if psutil is None or self.root_pid is None:
+            return None
+        try:
+            processes = psutil.Process(self.root_pid).children(recursive=True)
+        except psutil.Error:
+            return None
+        usage = {}
+        for proc in processes:
+            try:
+                kind = next((arg.split("=", 1)[1] for arg in proc.cmdline() if arg.startswith("--type=")), "browser")
+                rss = proc.memory_info().rss
+            except psutil.Error:
+                continue
+            usage[kind] = usage.get(kind, 0) + rss / (1024 * 1024)
+        return usage or None
+
+
+def read_js_heap(driver):
+    """CDPで現在のウィンドウのJSヒープ使用量（MB）を取得"""
+    driver.execute_cdp_cmd("Performance.enable", {})
+    metrics = driver.execute_cdp_cmd("Performance.getMetrics", {})["metrics"]
+    values = {m["name"]: m["value"] for m in metrics}
+    return values.get("JSHeapTotalSize", 0) / (1024 * 1024)
+
+
+def round_or_none(value, digits):
+    return None if value is None else round(value, digits)
+
+
+def memory_trend(samples):
+    """メモリの記録から、最後に作り直してからの1講座あたりの増加量（MB）を最小二乗法で求める（2点未満ならNone）"""
+    points = []
+    for sample in samples:
+        if sample["action"] is not None:
+            points = []  # 作り直した後から数え直す
+        else:
+            points.append((sample["lessons"], sample["mb"]))
+    if len(points) < 2:
+        return None
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+
+
+def format_memory(by_type):
+    """プロセスの種類別のメモリ使用量をログ用に並べる（多い順）"""
+    if not by_type:
+        return ""
+    return " ".join(f"{kind}={mb:.0f}MB" for kind, mb in sorted(by_type.items(), key=lambda item: -item[1]))
+
+
+def lesson_id_from_url(url):
+    """レッスン画面のURLから講座ID（L=の値）を取り出す（なければNone）"""
+    if "L=" not in url:
+        return None
+    return url.split("L=")[-1].split("&")[0]
+
+
+def page_phase(snap):
+    """スナップショットから講座のどのフェーズの画面か判定（分からなければNone）"""
+    title = snap["title"]
+    if snap["controls"].get("exam_next"):
+        return "explanation"
+    if "確認テスト" in title:
+        return "test"
+    if "アンケート" in title:
+        return "survey"
+    if snap["player"] is not None:
+        return "playback"
+    return None
+
+
+class LatencyHistogram:
+    """所要時間の件数・合計・最大と、LATENCY_BUCKETS_MS ごとの件数"""
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)  # 最後は上限超え
+    
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+    
+    def to_dict(self):
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 1),
+            "mean_ms": round(self.total / self.count, 1) if self.count else 0,
+            "max_ms": round(self.max, 1),
+            "histogram": dict(zip(labels, self.buckets)),
+        }
+
+
+class SessionMetrics:
+    """WebDriverコマンドの回数・所要時間と、講座ごとのフェーズ別の所要時間を集計する
+    
+    フェーズ: gap（前の講座の終了から次の講座を開き始めるまで）, mypage, link, popup,
+    playback, test, explanation, survey
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}  # WebDriverコマンド名 → LatencyHistogram
+        self.waits = {}     # 条件待機のステップ名 → LatencyHistogram
+        self.lessons = []   # 終了した講座 [{"lesson_id", "started", "ended", "phases", "buffering", "buffering_recoveries"}]
+        self.current = None  # 受講中の講座
+        self.phase = None
+        self.phase_started = None
+        self.last_lesson_ended = None  # 直前の講座が終わった時刻（gapの計測用）
+        self.memory = []  # 講座の合間のChromeのメモリ使用量 [{"time", "lessons", "mb", "source", "by_type", "action"}]
+        self.startup = {}  # 起動の各段階までの時間（ミリ秒）
+        self.stalls = []  # 見張りが検出した停止 [{"time", "reason", "command", "stalled", "recovery", "action"}]
+        self.command_timeouts = {}  # 実行時間の上限を超えたコマンド名 → 回数
+    
+    def record_command(self, command, seconds):
+        """WebDriverコマンド1回分の所要時間を記録"""
+        with self.lock:
+            self.commands.setdefault(command, LatencyHistogram()).add(seconds)
+    
+    def record_wait(self, step_name, seconds):
+        """条件待機1回分の所要時間を記録"""
+        with self.lock:
+            self.waits.setdefault(step_name, LatencyHistogram()).add(seconds)
+    
+    def record_stall(self, reason, command, stalled, recovery, action):
+        """見張りが検出した停止と、復旧にかかった秒数・復旧の方法（"reconnect" / "restart"）を記録"""
+        with self.lock:
+            self.stalls.append({
+                "time": round(time.time() - self.started, 1),
+                "reason": reason,
+                "command": command,
+                "stalled": round(stalled, 1),
+                "recovery": round(recovery, 2),
+                "action": action,
+            })
+    
+    def record_buffering(self, seconds):
+        """受講中の講座で、再生の停滞により失った秒数を足す"""
+        with self.lock:
+            if self.current is not None:
+                self.current["buffering"] += seconds
+    
+    def record_buffering_recovery(self, kind):
+        """受講中の講座で、停滞から復旧を試した方法（"reseek" / "reload" / "player" / "reopen"）を数える"""
+        with self.lock:
+            if self.current is not None:
+                recoveries = self.current["buffering_recoveries"]
+                recoveries[kind] = recoveries.get(kind, 0) + 1
+    
+    def record_command_timeout(self, name):
+        with self.lock:
+            self.command_timeouts[name] = self.command_timeouts.get(name, 0) + 1
+    
+    def record_startup(self, **phases):
+        """起動の各段階までの秒数を記録（window: ウィンドウが操作できるまで, selenium: Seleniumの読み込み など）"""
+        with self.lock:
+            self.startup.update({name: round(seconds * 1000) for name, seconds in phases.items() if seconds is not None})
+    
+    def record_memory(self, mb, source, by_type=None, action=None):
+        """講座の合間のメモリ使用量を記録（action: 作り直した場合の "window" / "browser"）"""
+        with self.lock:
+            self.memory.append({
+                "time": round(time.time() - self.started, 1),
+                "lessons": len(self.lessons),
+                "mb": round(mb, 1),
+                "source": source,
+                "by_type": {k: round(v, 1) for k, v in (by_type or {}).items()},
+                "action": action,
+            })
+    
+    def begin_lesson(self, lesson_id, phase):
+        """講座の開始（前の講座が終わってからの時間は gap として記録）"""
+        with self.lock:
+            now = time.monotonic()
+            self._close_lesson(now)
+            self.current = {
+                "lesson_id": lesson_id, "started": time.time(), "phases": {},
+                "buffering": 0.0,              # 再生の停滞で失った秒数
+                "buffering_recoveries": {},    # 停滞からの復旧の方法（"reseek" / "reload"）→ 回数
+            }
+            if self.last_lesson_ended is not None:
+                self.current["phases"]["gap"] = now - self.last_lesson_ended
+            self.phase = phase
+            self.phase_started = now
+    
+    def enter_phase(self, phase):
+        """受講中の講座のフェーズを切り替える（同じフェーズなら何もしない）"""
+        with self.lock:
+            if self.current is None or phase is None or phase == self.phase:
+                return
+            now = time.monotonic()
+            self._close_phase(now)
+            self.phase = phase
+            self.phase_started = now
+    
+    def end_lesson(self):
+        """受講中の講座の終了（ポップアップが閉じた）。終了した講座IDを返す"""
+        with self.lock:
+            lesson_id = self.current["lesson_id"] if self.current else None
+            self._close_lesson(time.monotonic())
+            return lesson_id
+    
+    def _close_phase(self, now):
+        if self.phase is not None:
+            phases = self.current["phases"]
+            phases[self.phase] = phases.get(self.phase, 0) + now - self.phase_started
+    
+    def _close_lesson(self, now):
+        if self.current is None:
+            return
+        self._close_phase(now)
+        self.current["ended"] = time.time()
+        self.lessons.append(self.current)
+        self.current = None
+        self.phase = None
+        self.last_lesson_ended = now
+    
+    def summary(self):
+        """GUI表示用の1行サマリー"""
+        with self.lock:
+            count = sum(h.count for h in self.commands.values())
+            total = sum(h.total for h in self.commands.values())
+            lessons = len(self.lessons)
+            memory = self.memory[-1]["mb"] if self.memory else None
+            trend = memory_trend(self.memory)
+            stalls = len(self.stalls)
+            buffering = sum(lesson["buffering"] for lesson in self.lessons)
+            if self.current is not None:
+                buffering += self.current["buffering"]
+        mean = total / count if count else 0
+        text = f"コマンド: {count}回 (平均{mean:.0f}ms)  完了講座: {lessons}件"
+        if stalls:
+            text += f"  停止→復旧: {stalls}回"
+        if buffering >= 1:
+            text += f"  再生の停滞: {buffering:.0f}秒"
+        if memory is not None:
+            text += f"\nChrome(講座の合間): {memory:.0f}MB" + (f" ({trend:+.0f}MB/講座)" if trend is not None else "")
+        return text
+    
+    def to_dict(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "ended": time.time(),
+                "commands": {name: h.to_dict() for name, h in sorted(self.commands.items())},
+                "waits": {name: h.to_dict() for name, h in sorted(self.waits.items())},
+                "lessons": [
+                    dict(lesson, phases={k: round(v, 2) for k, v in lesson["phases"].items()},
+                         buffering=round(lesson["buffering"], 2),
+                         buffering_recoveries=dict(lesson["buffering_recoveries"]))
+                    for lesson in self.lessons
+                ],
+                "memory": list(self.memory),
+                "startup": dict(self.startup),
+                "watchdog": {
+                    "stalls": list(self.stalls),
+                    "recovery_mean": round(sum(s["recovery"] for s in self.stalls) / len(self.stalls), 2)
+                                     if self.stalls else None,
+                    "command_timeouts": dict(self.command_timeouts),
+                },
+                "memory_trend_mb_per_lesson": round_or_none(memory_trend(self.memory), 1),
+            }
+    
+    def export(self, directory):
+        """JSON（全体）とCSV（講座別・コマンド別）に書き出し、JSONのパスを返す"""
+        data = self.to_dict()
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        base = os.path.join(directory, f"session-{stamp}")
+        
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        
+        with open(base + "-lessons.csv", "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["lesson_id"] + list(LESSON_PHASES) + ["total", "buffering"])  # total は gap を除く
+            for lesson in data["lessons"]:
+                phases = lesson["phases"]
+                writer.writerow(
+                    [lesson["lesson_id"]] + [phases.get(phase, "") for phase in LESSON_PHASES]
+                    + [round(sum(v for k, v in phases.items() if k != "gap"), 2), lesson["buffering"]]
+                )
+        
+        with open(base + "-commands.csv", "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            labels = list(next(iter(data["commands"].values()))["histogram"]) if data["commands"] else []
+            writer.writerow(["command", "count", "mean_ms", "max_ms", "total_ms"] + labels)
+            for name, stats in data["commands"].items():
+                writer.writerow(
+                    [name, stats["count"], stats["mean_ms"], stats["max_ms"], stats["total_ms"]]
+                    + list(stats["histogram"].values())
+                )
+        return base + ".json"
+
+
+def instrument_driver(driver, metrics):
+    """WebDriverの全コマンド（HTTPリクエスト単位）の所要時間を metrics に記録するようにする"""
+    executor = driver.command_executor
+    original = executor.execute
+    
+    def timed_execute(command, params):
+        started = time.perf_counter()
+        try:
+            return original(command, params)
+        finally:
+            metrics.record_command(command, time.perf_counter() - started)
+    
+    executor.execute = timed_execute
+
+
+class TransitionTimer:
+    """ページ遷移1回分の各ステップの所要時間を記録してログに出す"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.last = self.started
+        self.steps = []
+    
+    def step(self, label):
+        """前回のステップからの経過時間を label として記録"""
+        now = time.monotonic()
+        self.steps.append((label, now - self.last))
+        self.last = now
+    
+    def report(self):
+        """記録したステップの内訳をログに出す"""
+        total = time.monotonic() - self.started
+        detail = ", ".join(f"{label}={elapsed:.2f}s" for label, elapsed in self.steps)
+        logger.info("[遷移時間] %s: 合計%.2fs (%s)", self.name, total, detail)
+
+
+# 予約リストの講座の状態
+QUEUE_PENDING = "pending"          # 未受講
+QUEUE_IN_PROGRESS = "in_progress"  # 受講中（ツールやPCが落ちたらこのまま残り、次回ここから再開する）
+QUEUE_DONE = "done"                # 受講済み（ポップアップが閉じた）
+QUEUE_FAILED = "failed"            # QUEUE_MAX_ATTEMPTS 回開けなかった
+QUEUE_MAX_ATTEMPTS = 3
+# 講座を続けて開けなかったときに、次に開くまで待つ秒数（続くたびに倍にして上限まで）
+QUEUE_RETRY_DELAY = 5
+QUEUE_RETRY_MAX_DELAY = 60
+# 講座を取り出す前の準備（メモリの確認・予約リストの読み出し）の失敗をやり直す上限
+QUEUE_PREPARE_MAX_FAILURES = 3
+QUEUE_STATUS_LABELS = {QUEUE_PENDING: "", QUEUE_IN_PROGRESS: " (受講中)"}
+
+
+class LessonQueue:
+    """予約リスト（SQLiteに保存し、講座ごとの状態・試行回数・時刻を記録する）
+    
+    受講済み・失敗の講座も履歴として残し、リストに表示するのは未受講と受講中だけ。
+    restrict で講座IDを絞ると、取り出し・表示・件数はその講座だけになる（コマンドライン版）
+    """
+    
+    def __init__(self, path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)  # Tkと監視スレッドの両方から使う
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS lessons (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    lesson_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    added_at TEXT NOT NULL,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    error TEXT
+                )
+            """)
+        self.scope = None  # 扱う講座IDを絞る（Noneなら全部）
+    
+    @staticmethod
+    def now():
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+    
+    def restrict(self, lesson_ids):
+        """扱う講座を lesson_ids だけにする（それ以外の行は残したまま触らない）"""
+        with self.lock:
+            self.scope = list(lesson_ids)
+    
+    def _scoped(self, sql, params):
+        """WHERE 句の条件 sql に、扱う講座の絞り込みを足す"""
+        if self.scope is None:
+            return sql, params
+        marks = ", ".join("?" * len(self.scope))
+        return f"{sql} AND lesson_id IN ({marks})", tuple(params) + tuple(self.scope)
+    
+    def items(self):
+        """表示用に未受講・受講中の講座を [(講座ID, 状態, 試行回数)] で返す（受講中が先頭）"""
+        with self.lock:
+            where, params = self._scoped("status IN (?, ?)", (QUEUE_PENDING, QUEUE_IN_PROGRESS))
+            return self.conn.execute(
+                f"SELECT lesson_id, status, attempts FROM lessons WHERE {where} "
+                "ORDER BY status = ? DESC, id",
+                params + (QUEUE_IN_PROGRESS,)
+            ).fetchall()
+    
+    def __len__(self):
+        """未受講・受講中の件数"""
+        return len(self.items())
+    
+    def __contains__(self, lesson_id):
+        return any(item[0] == lesson_id for item in self.items())
+    
+    def pending_count(self):
+        """まだ開いていない講座の件数"""
+        with self.lock:
+            where, params = self._scoped("status = ?", (QUEUE_PENDING,))
+            return self.conn.execute(f"SELECT COUNT(*) FROM lessons WHERE {where}", params).fetchone()[0]
+    
+    def peek_next(self):
+        """次に開く未受講の講座ID（受講中の講座は含めない。なければNone）"""
+        with self.lock:
+            where, params = self._scoped("status = ?", (QUEUE_PENDING,))
+            row = self.conn.execute(f"SELECT lesson_id FROM lessons WHERE {where} ORDER BY id LIMIT 1", params).fetchone()
+        return row[0] if row else None
+    
+    def interrupted(self):
+        """前回受講中のまま終わった講座ID（なければNone）"""
+        with self.lock:
+            where, params = self._scoped("status = ?", (QUEUE_IN_PROGRESS,))
+            row = self.conn.execute(f"SELECT lesson_id FROM lessons WHERE {where} ORDER BY id LIMIT 1", params).fetchone()
+        return row[0] if row else None
+    
+    def add(self, lesson_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO lessons (lesson_id, status, added_at) VALUES (?, ?, ?)",
+                (lesson_id, QUEUE_PENDING, self.now())
+            )
+    
+    def remove(self, lesson_id):
+        """未受講・受講中の講座を予約リストから削除（履歴からも消す）"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM lessons WHERE lesson_id = ? AND status IN (?, ?)",
+                (lesson_id, QUEUE_PENDING, QUEUE_IN_PROGRESS)
+            )
+    
+    def start_next(self):
+        """次に受講する講座を受講中にして講座IDを返す（中断した講座を優先。空ならNone）"""
+        with self.lock, self.conn:
+            where, params = self._scoped("status IN (?, ?)", (QUEUE_PENDING, QUEUE_IN_PROGRESS))
+            row = self.conn.execute(
+                f"SELECT id, lesson_id FROM lessons WHERE {where} ORDER BY status = ? DESC, id LIMIT 1",
+                params + (QUEUE_IN_PROGRESS,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE lessons SET status = ?, attempts = attempts + 1, started_at = ?, error = NULL WHERE id = ?",
+                (QUEUE_IN_PROGRESS, self.now(), row[0])
+            )
+            return row[1]
+    
+    def status(self, lesson_id):
+        """講座の最新の状態（一度も予約していなければNone）"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status FROM lessons WHERE lesson_id = ? ORDER BY id DESC LIMIT 1", (lesson_id,)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def finish(self, lesson_id):
+        """受講中の講座を受講済みにする（予約リストの講座でなければ何もしない）"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE lessons SET status = ?, finished_at = ? WHERE lesson_id = ? AND status = ?",
+                (QUEUE_DONE, self.now(), lesson_id, QUEUE_IN_PROGRESS)
+            )
+    
+    def fail(self, lesson_id, error):
+        """開けなかった講座を未受講に戻す（QUEUE_MAX_ATTEMPTS 回目なら失敗にする）。失敗にしたらTrue"""
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT id, attempts FROM lessons WHERE lesson_id = ? AND status = ? ORDER BY id LIMIT 1",
+                (lesson_id, QUEUE_IN_PROGRESS)
+            ).fetchone()
+            if row is None:
+                return False
+            failed = row[1] >= QUEUE_MAX_ATTEMPTS
+            self.conn.execute(
+                "UPDATE lessons SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+                (QUEUE_FAILED if failed else QUEUE_PENDING, self.now() if failed else None, str(error), row[0])
+            )
+            return failed
+
+
+class FlightRecorder:
+    """監視ループが判断に使ったページ状態・決めた処理・各ステップの所要時間の記録
+    
+    1件ずつ「4バイトの長さ（ビッグエンディアン）+ UTF-8のJSON」で追記する。ファイルが
+    上限の半分を超えたら1世代前（.1）に回すので、ディスクは max_bytes までしか使わず直近の記録が残る
+    """
+    
+    def __init__(self, path, max_bytes=RECORDER_MAX_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.segment_bytes = max_bytes // 2
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.file = open(path, "ab")
+        self.record("session", {"started": time.time(), "base_url": BASE_URL})
+    
+    def record(self, kind, entry):
+        """1件書く（t はセッション開始からの秒数）。落ちても直前までは読めるよう毎回書き出す"""
+        entry = dict(entry, type=kind, t=round(time.monotonic() - self.started, 3))
+        data = json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                if self.file.tell() > 0 and self.file.tell() + len(data) + 4 > self.segment_bytes:
+                    self.rotate()
+                self.file.write(struct.pack(">I", len(data)) + data)
+                self.file.flush()
+            except OSError as e:
+                logger.warning("記録を書けないのでフライトレコーダーを止めます: %s", e)
+                self.file = None
+    
+    def rotate(self):
+        self.file.close()
+        os.replace(self.path, self.path + ".1")
+        self.file = open(self.path, "ab")
+    
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+    
+    @staticmethod
+    def read(path):
+        """記録を古い順に返す（.1 → 本体の順。書きかけで切れた最後の1件は捨てる）"""
+        for name in (path + ".1", path):
+            if not os.path.exists(name):
+                continue
+            with open(name, "rb") as f:
+                while True:
+                    header = f.read(4)
+                    if len(header) < 4:
+                        break
+                    length = struct.unpack(">I", header)[0]
+                    data = f.read(length)
+                    if len(data) < length:
+                        break
+                    yield json.loads(data)
+
+
+def open_flight_recorder(path=None):
+    """フライトレコーダーを開く（既定はアプリのデータフォルダ。開けなければ記録しない）"""
+    try:
+        return FlightRecorder(path or get_app_dir("flight", "monitor.rec"))
+    except OSError as e:
+        logger.warning("フライトレコーダーを開けないため記録しません: %s", e)
+        return None
+
+
+def replay_trace(entries, repeat=1, stall_seconds=REPLAY_STALL_SECONDS):
+    """記録したティックをブラウザなしで decide に通し、記録と同じ判断になるか確かめる
+    
+    返り値: ティック数・食い違い・decide の所要時間（ティック/秒）・同じ状態のまま止まっていた区間
+    """
+    ticks = []
+    sessions = 0
+    for entry in entries:
+        if entry["type"] == "session":
+            sessions += 1
+        elif entry["type"] == "tick":
+            ticks.append((sessions, entry))
+    
+    mismatches = []
+    for _, tick in ticks:
+        next_state, action = decide(tick["state"], tick["snap"], tick["queued"])
+        if (next_state, action) != (tick["next"], tick["action"]):
+            mismatches.append({
+                "t": tick["t"], "state": tick["state"],
+                "recorded": [tick["next"], tick["action"]], "replayed": [next_state, action],
+                "title": tick["snap"]["title"] if tick["snap"] else None,
+            })
+    
+    # 判断だけの速さ（監視ループの1周からWebDriverの通信と待機を除いた分）
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for _, tick in ticks:
+            decide(tick["state"], tick["snap"], tick["queued"])
+    elapsed = time.perf_counter() - started
+    count = len(ticks) * repeat
+    
+    # 同じ状態・同じ処理のまま、動画も進まずに stall_seconds 以上続いた区間（止まっていた場所）
+    def position(tick):
+        return playback_position(tick["snap"])[0] if tick["snap"] else None
+    
+    stalls = []
+    run = None
+    for session, tick in ticks + [(None, None)]:
+        key = (session, tick["next"], tick["action"]) if tick else None
+        if run is not None and key != run["key"]:
+            first, last = position(run["first"]), position(run["last"])
+            moved = first is not None and last is not None and last > first
+            if run["last"]["t"] - run["first"]["t"] >= stall_seconds and not moved:
+                snap = run["last"]["snap"]
+                stalls.append({
+                    "t": run["first"]["t"], "seconds": round(run["last"]["t"] - run["first"]["t"], 1),
+                    "state": run["key"][1], "action": run["key"][2], "ticks": run["ticks"],
+                    "title": snap["title"] if snap else None, "url": snap["url"] if snap else None,
+                })
+            run = None
+        if tick is None:
+            break
+        if run is None:
+            run = {"key": key, "first": tick, "ticks": 0}
+        run["last"] = tick
+        run["ticks"] += 1
+    
+    return {
+        "sessions": sessions,
+        "ticks": len(ticks),
+        "mismatches": mismatches,
+        "decide_us_mean": round(elapsed / count * 1e6, 2) if count else None,
+        "ticks_per_second": round(count / elapsed) if elapsed > 0 else None,
+        "recorded_decide_us_mean": round(sum(t["decide_us"] for _, t in ticks) / len(ticks), 2) if ticks else None,
+        "stalls": sorted(stalls, key=lambda stall: -stall["seconds"]),
+    }
+
+
+class EngineOptions:
+    """ブラウザの起動オプション（GUIのチェックボックス・コマンドライン引数から作る）"""
+    
+    def __init__(self, use_cdp=False, refresh_driver=False, use_profile=False,
+                 attach_browser=False, background_mode=False, headless_mode=False):
+        self.use_cdp = use_cdp                    # CDPイベント監視
+        self.refresh_driver = refresh_driver      # 起動時にchromedriverをダウンロードし直す
+        self.use_profile = use_profile            # ログイン状態・キャッシュを残す専用プロファイルで起動
+        self.attach_browser = attach_browser      # リモートデバッグポートで起動中のChromeに接続
+        self.background_mode = background_mode    # 画面外・ミュート・省リソースで起動
+        self.headless_mode = headless_mode        # バックグラウンド起動をヘッドレスにする（要ログイン済みプロファイル）
+
+
+def open_lesson_queue(path=None):
+    """予約リストを開く（既定はアプリのデータフォルダ。開けなければ今回だけのリスト）"""
+    try:
+        return LessonQueue(path or get_app_dir("queue.sqlite3"))
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("予約リストを保存できないため、今回だけのリストを使います: %s", e)
+        return LessonQueue(":memory:")
+
+
+class LearningEngine:
+    """ブラウザ操作と受講の監視（画面を持たず、表示は view に任せる）
+    
+    view は post(event, data) を持つオブジェクト（Tkのウィンドウでもコマンドラインでもよい）で、
+    進捗・状態の通知は監視スレッド・作業スレッドなど、どのスレッドからも届く。
+    ブラウザ起動や講座を開く処理のような時間のかかる操作は submit で作業スレッドに回し、
+    呼び出し元（Tkのイベントループなど）を止めない
+    """
+    
+    def __init__(self, view, options=None, lesson_queue=None, recorder=None):
+        self.view = view
+        self.recorder = recorder  # 監視ループの判断の記録（FlightRecorder。Noneなら記録しない）
+        self.options = options or EngineOptions()
+        self.driver = None
+        self.monitoring = False
+        self.monitor_thread = None
+        self.monitor_generation = 0  # 見張りが監視ループを作り直すたびに増やす（古いループは次の周で終わる）
+        self.heartbeat_due = None  # 監視ループの次の心拍の期限（time.monotonic()）
+        # ブラウザの起動し直し（作業スレッドのメモリの見張り・見張りの復旧）を1つずつにする
+        self.restart_lock = threading.RLock()
+        self.restarting = False  # 起動し直している間は見張りが止まったと判定しない
+        self.watchdog_thread = None
+        self.main_window = None  # メインウィンドウのハンドル
+        self.popup_window = None  # ポップアップウィンドウのハンドル
+        self.current_window = None  # WebDriverが現在操作しているウィンドウのハンドル（仲介スレッドだけが更新）
+        self.debugger_address = None  # ChromeのDevToolsの接続先（ウィンドウに直接つなぐのに使う。Noneなら切り替える）
+        self.channels = {}  # ウィンドウハンドル → TargetChannel（仲介スレッドだけが使う）
+        self.channel_failures = 0  # TargetChannel の接続が続けて失敗した回数
+        self.broker = DriverBroker()  # WebDriver操作を1つのスレッドにまとめる仲介役
+        # 時間のかかる操作（ブラウザ起動・講座を開く・予約など）を1つずつ順番に実行する作業スレッド
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine-worker")
+        # 再生中に次の講座を準備するスレッド（監視スレッド・作業スレッドを待たせない）
+        self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine-prefetch")
+        self.windows = WindowRegistry()  # ウィンドウハンドルと種類の記録
+        self.event_driven = True  # ページ内のイベント監視で待機する（Falseなら1秒ポーリング）
+        self.cdp = None  # CDPイベント監視（ブラウザ起動時に有効化した場合のみ）
+        self.attached = False  # 起動中のChromeに接続している（終了時にブラウザを閉じない）
+        self.resources = None  # ChromeのCPU・メモリ使用量の計測
+        self.metrics = SessionMetrics()  # コマンド数・所要時間・講座のフェーズ別時間の集計
+        self.lesson_queue = lesson_queue if lesson_queue is not None else open_lesson_queue()  # 予約リスト（再起動しても残る）
+        self.mypage_index = None  # マイページの講座リンクの索引（講座ID → リンク情報。失敗したら作り直す）
+        self.mypage_lock = threading.RLock()  # 索引を作る処理（準備と講座を開く処理）を1つずつにする
+        self.prefetched_lesson = None  # 再生中に準備を済ませた次の講座ID
+        self.open_retry = None  # 講座を開けなかったときに、待ってからやり直すタイマー
+        self.state = None  # 受講の状態（VIDEO_PLAYING など。監視スレッドが遷移表で更新する）
+        # 状態の書き換え（監視スレッドの判断と、予約・講座を開く処理・見張りからの割り込み）をまとめる
+        self.state_lock = threading.Lock()
+        self.playback = PlaybackWatch()  # 再生位置の進み方（バッファリング・停滞の判定）
+        self.resume_position = None  # 講座を開き直した後に戻る位置 {"url": 動画ページ, "position": 秒}
+        self.wakeup = threading.Event()  # 再生中の待機を途中で起こす（停止・予約など）
+        self.pause_check_seconds = PAUSE_CHECK_INTERVAL  # 再生中に一時停止を確認する最大間隔
+        self.memory_limit_mb = MEMORY_LIMIT_MB  # 講座の合間に作り直すメモリ使用量（0なら見張らない）
+        # decide が返す処理 → 実行するメソッド
+        self.state_actions = {
+            "click_next_study": self.on_next_study,
+            "await_page": self.on_await_page,
+            "start_player": self.on_start_player,
+            "answer_exam": self.on_answer_exam,
+            "click_exam_next": self.on_exam_next,
+            "click_survey_end": self.on_survey_end,
+            "resume_player": self.on_resume_player,
+            "recover_playback": self.on_recover_playback,
+            "show_progress": self.on_show_progress,
+            "open_next": self.on_open_next,
+            "lesson_done": self.on_lesson_done,
+            "find_popup": self.on_find_popup,
+            "wait_open": self.on_wait_open,
+            "wait": self.on_wait,
+        }
+    
+    def emit(self, event, **data):
+        """view に進捗を知らせる（どのスレッドからでも呼べる）"""
+        try:
+            self.view.post(event, data)
+        except Exception as e:
+            logger.debug("表示の更新に失敗: %s", e)
+    
+    def submit(self, fn, *args):
+        """時間のかかる操作を作業スレッドで実行して Future を返す（例外はログに出す）"""
+        future = self.worker.submit(fn, *args)
+        future.add_done_callback(self.log_failure)
+        return future
+    
+    @staticmethod
+    def log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("処理エラー: %s", future.exception())
+    
+    def record(self, kind, **entry):
+        """フライトレコーダーに1件書く（記録しない設定なら何もしない）"""
+        if self.recorder is not None:
+            self.recorder.record(kind, entry)
+    
+    def set_state(self, state):
+        """状態を書き換える（監視スレッドの判断より優先する。他のスレッドから呼ぶ）"""
+        with self.state_lock:
+            self.state = state
+    
+    def transition(self, expected, next_state):
+        """状態が expected のままなら next_state にする（他のスレッドが変えていればFalse）"""
+        with self.state_lock:
+            if self.state != expected:
+                return False
+            self.state = next_state
+            return True
+    
+    def notify(self, level, message):
+        """利用者に知らせるメッセージ（level: warning / info / error）"""
+        self.emit("notice", level=level, message=message)
+    
+    def set_pause_check_interval(self, seconds):
+        """再生中に一時停止を確認する間隔を変更（範囲外は丸める。監視中でもすぐ反映）"""
+        low, high = PAUSE_CHECK_RANGE
+        self.pause_check_seconds = max(low, min(high, seconds))
+        self.wakeup.set()
+    
+    def set_memory_limit(self, mb):
+        """作り直すメモリ使用量の上限を変更（範囲外は丸める。0なら見張らない）"""
+        low, high = MEMORY_LIMIT_RANGE
+        self.memory_limit_mb = max(low, min(high, mb))
+    
+    def build_options(self):
+        """Chromeの起動オプションを組み立てる"""
+        opts = self.options
+        options = Options()
+        if opts.attach_browser:
+            # 起動中のChromeに接続（起動引数は既に決まっているので指定しない）
+            options.debugger_address = f"127.0.0.1:{REMOTE_DEBUGGING_PORT}"
+        else:
+            options.add_argument("--disable-popup-blocking")
+            # 前面にないウィンドウでも、クリックなしで動画を再生できるようにする
+            options.add_argument("--autoplay-policy=no-user-gesture-required")
+            if opts.background_mode:
+                # 画面外（またはヘッドレス）・ミュート・省リソースで起動
+                if opts.headless_mode:
+                    options.add_argument("--headless=new")
+                else:
+                    options.add_argument("--window-position=-32000,-32000")
+                options.add_argument(f"--window-size={BACKGROUND_WINDOW_SIZE}")
+                for arg in BACKGROUND_ARGS:
+                    options.add_argument(arg)
+            else:
+                options.add_argument("--start-maximized")
+            if opts.use_profile:
+                # 専用プロファイル（ログイン情報・Cookie・ディスクキャッシュが次回も残る）
+                options.add_argument(f"--user-data-dir={get_app_dir('profile')}")
+        if opts.use_cdp:
+            CdpEventSource.configure(options)
+        return options
+    
+    def start_browser(self, resume=True):
+        """ブラウザを起動してログインページを開く（起動できたらTrue）
+        
+        resume=True なら、前回中断した講座があってログイン済みのときに連続受講を再開する
+        """
+        opts = self.options
+        if opts.background_mode and opts.headless_mode and not opts.use_profile:
+            self.notify("warning", "ヘッドレスでは画面でログインできません。\n一度普通に起動してログインした「プロファイル保持」と併用してください。")
+            return False
+        
+        try:
+            started = time.monotonic()
+            driver_source = self.launch_driver()
+            
+            def open_login(driver):
+                driver.set_script_timeout(EVENT_WAIT_TIMEOUT + 10)
+                driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+                self.current_window = driver.current_window_handle
+                # 接続したChromeや保持プロファイルで既にマイラーニングを開いていればそのまま使う
+                if SITE_HOST not in driver.current_url:
+                    driver.get(LOGIN_URL)
+                return self.current_window
+            
+            # メインウィンドウを記録
+            self.main_window = self.drive("ログインページを開く", open_login, priority=PRIORITY_USER)
+            self.windows.update([self.main_window])
+            startup_time = time.monotonic() - started
+            logger.info("ブラウザ起動完了: %.2f秒（ドライバ: %s）", startup_time, driver_source)
+            self.emit("browser_started", seconds=round(startup_time, 2), driver_source=driver_source)
+        
+        except Exception as e:
+            if opts.attach_browser:
+                hint = f"Chromeを --remote-debugging-port={REMOTE_DEBUGGING_PORT} 付きで起動しているか確認してください"
+            elif opts.use_profile:
+                hint = "保持プロファイルを使うChromeが既に開いている場合は閉じてください"
+            else:
+                hint = ""
+            logger.error("ブラウザ起動に失敗: %s", e)
+            self.emit("browser_failed", error=str(e), hint=hint)
+            return False
+        
+        if resume:
+            self.resume_interrupted()
+        return True
+    
+    def launch_driver(self):
+        """起動オプションに従ってChromeとchromedriverを起動し、ドライバの入手元を返す"""
+        load_selenium()
+        opts = self.options
+        options = self.build_options()
+        
+        service, driver_source, chrome_major = resolve_driver_service(opts.refresh_driver)
+        self.driver = webdriver.Chrome(service=service, options=options)
+        # 応答のないコマンドで仲介スレッドが戻らなくならないように、HTTP要求に上限を付ける
+        self.driver.command_executor.client_config.timeout = HTTP_TIMEOUT
+        self.broker.driver = self.driver
+        instrument_driver(self.driver, self.metrics)
+        if driver_source == "Selenium Manager":
+            # Selenium Managerが用意したドライバを、次回以降のためにキャッシュしておく
+            store_driver(self.driver.service.path, chrome_major)
+        opts.refresh_driver = False
+        self.resources = None if opts.attach_browser else ResourceSampler(self.driver.service.process.pid)
+        self.cdp = CdpEventSource() if opts.use_cdp else None
+        self.attached = opts.attach_browser
+        self.current_window = None
+        self.disconnect_channels()
+        self.debugger_address = (self.driver.capabilities.get("goog:chromeOptions") or {}).get("debuggerAddress")
+        self.channel_failures = 0
+        return driver_source
+    
+    def is_logged_in(self):
+        """メインウィンドウがログイン後のページ（マイラーニング内でログイン画面以外）か"""
+        url = self.window_info(self.main_window, refresh=True, priority=PRIORITY_USER)["url"]
+        return SITE_HOST in url and "Login" not in url
+    
+    def wait_for_login(self, timeout):
+        """開いたブラウザでログインが済むまで待つ（timeout秒以内にログインできたらTrue）"""
+        end = time.monotonic() + timeout
+        waiting = False
+        while not self.is_logged_in():
+            if time.monotonic() >= end:
+                logger.warning("ログイン待ちがタイムアウトしました (%s秒)", timeout)
+                return False
+            if not waiting:
+                logger.info("ブラウザでのログインを待っています")
+                self.emit("waiting_login", timeout=timeout)
+                waiting = True
+            time.sleep(LOGIN_POLL_INTERVAL)
+        return True
+    
+    def resume_interrupted(self):
+        """前回中断した講座があり、既にログイン済み（保持プロファイル・接続したChrome）なら連続受講を再開"""
+        interrupted = self.lesson_queue.interrupted()
+        if interrupted is None:
+            return
+        if not self.is_logged_in():
+            return  # ログイン後に「連続受講開始」で再開する
+        logger.info("前回中断した講座 L=%s から連続受講を再開します", interrupted)
+        self.submit(self.start_continuous)
+    
+    def drive(self, name, fn, handle=None, priority=PRIORITY_MONITOR, deadline=DEFAULT_COMMAND_DEADLINE, key=None,
+              native=False, timeout=COMMAND_TIMEOUT):
+        """WebDriver操作 fn(driver) を仲介スレッドで実行して結果を返す
+        
+        handle を指定すると、そのウィンドウに直接つないだ TargetChannel を driver として渡す
+        （ウィンドウを前面に出さない）。つなげないとき・native=True のときは、そのウィンドウに
+        切り替えてから（切り替えと操作をまとめて）WebDriverで実行する。
+        timeout 秒（と実行待ちの deadline 秒）を過ぎても終わらなければ CommandTimeout を送出する
+        """
+        def command(driver):
+            if handle is not None and not native:
+                channel = self.channel(handle)
+                if channel is not None:
+                    try:
+                        return fn(channel)
+                    except NoSuchWindowException:
+                        self.channels.pop(handle, None)
+                        raise
+                    except FrameUnreachable as e:
+                        logger.debug("%s: ウィンドウを切り替えて実行します（%s）", name, e)
+            if handle is not None and handle != self.current_window:
+                driver.switch_to.window(handle)
+                self.current_window = handle
+            return fn(driver)
+        try:
+            return self.broker.call(name, command, priority, deadline, key, timeout)
+        except CommandTimeout:
+            self.metrics.record_command_timeout(name)
+            raise
+    
+    def channel(self, handle):
+        """ウィンドウに直接つないだ TargetChannel を返す（仲介スレッドから呼ぶ。使えなければNone）
+        
+        閉じたウィンドウなら NoSuchWindowException を送出する
+        """
+        channel = self.channels.get(handle)
+        if channel is not None or self.debugger_address is None:
+            return channel
+        try:
+            channel = TargetChannel(self.debugger_address, handle, self.metrics.record_command)
+        except NoSuchWindowException:
+            raise
+        except Exception as e:
+            self.channel_failures += 1
+            logger.warning("ウィンドウに直接つなげません（%d回目）: %s", self.channel_failures, e)
+            if self.channel_failures >= CHANNEL_MAX_FAILURES:
+                logger.warning("ウィンドウを切り替えて操作します（切り替えるとウィンドウが前面に出ます）")
+                self.debugger_address = None
+            return None
+        self.channel_failures = 0
+        self.channels[handle] = channel
+        return channel
+    
+    def disconnect_channels(self, deadline=DEFAULT_COMMAND_DEADLINE):
+        """各ウィンドウのCDP接続を切る（channels は仲介スレッドだけが使うので、仲介スレッドで実行する）"""
+        def disconnect(driver):
+            for channel in self.channels.values():
+                channel.disconnect()
+            self.channels = {}
+        self.drive("CDP接続を切る", disconnect, priority=PRIORITY_USER, deadline=deadline)
+    
+    def get_window_handles(self, priority=PRIORITY_MONITOR):
+        """ウィンドウハンドル一覧を取得して記録に反映（同時に要求されたら1回にまとめる）"""
+        handles = self.drive("window_handles", lambda d: d.window_handles, priority=priority, key="window_handles")
+        self.windows.update(handles)
+        return handles
+    
+    def probe_page(self, handle, controls=CONTROL_IDS):
+        """指定ウィンドウのページ状態を1回のスクリプト実行で取得（controls: 調べるコントロール）
+        
+        ウィンドウが閉じられていれば NoSuchWindowException を送出する
+        """
+        return self.drive("スナップショット", lambda d: d.execute_script(PAGE_SNAPSHOT_JS, controls), handle)
+    
+    def wait_page_event(self, handle, timeout, controls=CONTROL_IDS):
+        """指定ウィンドウで状態変化が起きるまで待ってからスナップショットを取得
+        
+        初回（ページ遷移直後）は監視スクリプトを仕込んで即座に返る（監視するコントロールは
+        仕込んだときの controls で決まる）。待機中にページが遷移すると JavascriptException になる
+        """
+        return self.drive(
+            "イベント待機",
+            lambda d: d.execute_async_script(WAIT_PAGE_EVENT_JS, controls, int(timeout * 1000)),
+            handle
+        )
+    
+    def window_info(self, handle, refresh=False, priority=PRIORITY_MONITOR):
+        """ウィンドウのタイトル・URLを取得（記録済みならウィンドウを切り替えずに返す）"""
+        info = None if refresh else self.windows.get(handle)
+        if info is None:
+            info = self.drive(
+                "ウィンドウ判定", lambda d: d.execute_script(WINDOW_INFO_JS), handle,
+                priority=priority, key=f"window_info:{handle}"
+            )
+            self.windows.remember(handle, info["title"], info["url"])
+        return info
+    
+    def find_popup_window(self, match=is_lesson_window, refresh=False, priority=PRIORITY_MONITOR):
+        """ポップアップウィンドウ（レッスン画面）を特定
+        
+        ハンドル一覧を1回取得し、まだ判定していないウィンドウだけを調べる。
+        refresh=True なら記録を使わず全ウィンドウを調べ直す
+        """
+        if self.cdp is not None:
+            return self.find_popup_by_targets(match, priority)
+        try:
+            for handle in self.get_window_handles(priority):
+                if handle != self.main_window:
+                    # メインウィンドウ以外を確認（タイトルまたはURLで判定）
+                    if match(self.window_info(handle, refresh, priority)):
+                        return handle
+            return None
+        except:
+            return None
+    
+    def find_popup_by_targets(self, match=is_lesson_window, priority=PRIORITY_MONITOR):
+        """CDPのターゲット一覧（全ウィンドウのタイトル・URL）からポップアップを特定
+        
+        1回のコマンドで全ウィンドウの情報が得られるので、ウィンドウを切り替えずに判定できる
+        """
+        try:
+            events = self.drive("Target.getTargets", self.cdp.refresh_targets, priority=priority, key="cdp_targets")
+            self.log_cdp_events(events)
+            handles = [handle_for_target(target_id, self.windows.handles) for target_id in self.cdp.targets]
+            self.windows.update(handles)
+            for target_id, info in self.cdp.targets.items():
+                handle = handle_for_target(target_id, handles)
+                self.windows.remember(handle, info["title"], info["url"])
+                if handle != self.main_window and match(info):
+                    return handle
+            return None
+        except:
+            return None
+    
+    def log_cdp_events(self, events):
+        """CDPイベントをログに出し、ページ遷移したウィンドウの記録を破棄する"""
+        for event in events:
+            handle = handle_for_target(event["target"], self.windows.handles)
+            method = event["method"]
+            if method == "Page.frameNavigated":
+                self.windows.invalidate(handle)
+                logger.debug("[CDP] ページ遷移: %s", event['params'].get('frame', {}).get('url', ''))
+            elif method == "Page.windowOpen":
+                logger.debug("[CDP] 新しいウィンドウ: %s", event['params'].get('url', ''))
+            elif method == "Target.targetCreated":
+                logger.debug("[CDP] ウィンドウ生成: %s", event['params'].get('url', ''))
+            elif method == "Target.targetDestroyed":
+                self.windows.invalidate(handle)
+                logger.debug("[CDP] ウィンドウ破棄: %s", handle)
+    
+    def consume_cdp_events(self):
+        """溜まったCDPイベントを処理し、監視中のポップアップが閉じていればTrueを返す"""
+        events = self.drive("CDPイベント取得", self.cdp.drain)
+        # 新しいウィンドウが開いたときだけターゲット一覧を取り直す
+        if any(event["method"] == "Page.windowOpen" for event in events):
+            events += self.drive("Target.getTargets", self.cdp.refresh_targets, key="cdp_targets")
+        self.log_cdp_events(events)
+        popup_target = self.popup_window.replace("CDwindow-", "") if self.popup_window else None
+        return any(
+            event["method"] == "Target.targetDestroyed" and event["target"] == popup_target
+            for event in events
+        )
+    
+    def read_video_state(self, handle):
+        """プレイヤーiframe内の<video>の状態を直接読む（読めなければNone）"""
+        try:
+            return self.drive("video状態取得", in_player_frame(VIDEO_STATE_JS), handle)
+        except (NoSuchElementException, JavascriptException):
+            return None
+    
+    def start_monitoring(self):
+        """監視を開始（ポップアップが見つからなければFalse）"""
+        if self.driver is None:
+            self.notify("warning", "先にブラウザを起動してください")
+            return False
+        
+        # ポップアップウィンドウを探す
+        self.popup_window = self.find_popup_window(priority=PRIORITY_USER)
+        
+        if self.popup_window is None:
+            self.notify("warning", "レッスン画面（ポップアップ）が見つかりません。\n講座を選んで動画再生画面を開いてください。")
+            return False
+        
+        self.monitoring = True
+        with self.state_lock:
+            if self.state != OPENING_NEXT:
+                self.state = None  # 最初のスナップショットでページから状態を決める
+        self.emit("monitoring", active=True)
+        
+        # 監視スレッドと、それが止まっていないかの見張りを開始
+        self.start_monitor_thread()
+        if self.watchdog_thread is None or not self.watchdog_thread.is_alive():
+            self.watchdog_thread = threading.Thread(target=self.watchdog_loop, name="watchdog", daemon=True)
+            self.watchdog_thread.start()
+        return True
+    
+    def start_monitor_thread(self):
+        """監視ループを新しい世代で開始（前の世代のループは次の周で終わる）"""
+        self.monitor_generation += 1
+        self.beat()
+        self.monitor_thread = threading.Thread(
+            target=self.monitor_loop, args=(self.monitor_generation,), name="monitor", daemon=True
+        )
+        self.monitor_thread.start()
+    
+    def beat(self, expected_wait=0):
+        """監視ループの心拍: expected_wait 秒眠るので、その後 WATCHDOG_GRACE 秒以内に戻る"""
+        self.heartbeat_due = time.monotonic() + expected_wait + WATCHDOG_GRACE
+    
+    def watchdog_loop(self):
+        """監視ループの心拍と仲介スレッドのコマンドを見張り、止まっていたら復旧する"""
+        while self.monitoring:
+            time.sleep(WATCHDOG_INTERVAL)
+            if not self.monitoring:
+                return
+            if self.restarting:
+                continue  # 起動し直しは実行時間の長いコマンドが続くので、終わってから見る
+            hung = self.broker.hung_command(WATCHDOG_COMMAND_GRACE)
+            overdue = time.monotonic() - self.heartbeat_due if self.heartbeat_due is not None else 0
+            if hung is not None:
+                self.recover("command", hung[0], hung[1])
+            elif overdue > 0:
+                running = self.broker.running
+                self.recover("heartbeat", running[0] if running else None, overdue + WATCHDOG_GRACE)
+    
+    def recover(self, reason, command, stalled):
+        """止まった監視を復旧する
+        
+        詰まったコマンドを見捨てて仲介スレッドを作り直し、ブラウザが応答しなければ起動し直す。
+        ポップアップを探し直し、ページから状態を決め直す監視ループを新しく始める
+        （ポップアップがなく、受講中の講座があればその講座を開き直す）。
+        作業スレッドがブラウザを起動し直している間は、それを待ってから次の見張りで見直す
+        """
+        if not self.restart_lock.acquire(blocking=False):
+            with self.restart_lock:
+                return  # 起動し直しで心拍も打ち直されるので、止まったかどうかは改めて判定する
+        try:
+            self._recover(reason, command, stalled)
+        finally:
+            self.restart_lock.release()
+    
+    def _recover(self, reason, command, stalled):
+        """recover の実装"""
+        started = time.monotonic()
+        logger.warning("監視が止まっています（%s, %s, %.0f秒）。復旧します", reason, command or "-", stalled)
+        self.emit("watchdog", stage="stalled", reason=reason, command=command, seconds=round(stalled))
+        self.update_detail("監視が止まったので復旧中...")
+        
+        old_broker = self.broker
+        self.broker = DriverBroker()
+        self.broker.driver = self.driver
+        old_broker.abandon()
+        self.disconnect_channels()
+        self.current_window = None  # 見捨てたコマンドがどのウィンドウにいたか分からない
+        try:
+            self.drive("復旧確認", lambda d: d.window_handles, priority=PRIORITY_USER, timeout=WATCHDOG_PROBE_TIMEOUT)
+            action = "reconnect"
+        except Exception as e:
+            logger.warning("ブラウザが応答しないので起動し直します: %s", e)
+            action = "restart"
+            try:
+                self.restart_browser()
+            except Exception as e:
+                logger.error("ブラウザを起動し直せません: %s", e)
+                self.metrics.record_stall(reason, command, stalled, time.monotonic() - started, "failed")
+                self.emit("watchdog", stage="failed", reason=reason, error=str(e))
+                self.stop_monitoring()
+                return
+        
+        self.popup_window = self.find_popup_window(refresh=True, priority=PRIORITY_USER)
+        interrupted = self.lesson_queue.interrupted()
+        with self.state_lock:
+            reopen = False
+            if self.popup_window is not None:
+                self.state = None
+            elif self.state == OPENING_NEXT:
+                pass  # 講座を開く処理が終われば状態を進める
+            elif interrupted is not None:
+                self.state = OPENING_NEXT
+                reopen = True
+            else:
+                self.state = None
+        if reopen:
+            logger.info("ポップアップが見つからないので講座 L=%s を開き直します", interrupted)
+            self.metrics.end_lesson()
+            self.submit(self.open_next_queue)
+        self.start_monitor_thread()
+        
+        recovery = time.monotonic() - started
+        self.metrics.record_stall(reason, command, stalled, recovery, action)
+        self.record("watchdog", reason=reason, command=command, stalled=round(stalled, 1),
+                    recovery=round(recovery, 2), action=action)
+        logger.info("監視を復旧しました（%s, %.1f秒）", action, recovery)
+        self.emit("watchdog", stage="recovered", reason=reason, action=action, seconds=round(recovery, 2))
+    
+    def stop_monitoring(self):
+        """監視を停止"""
+        self.monitoring = False
+        self.wakeup.set()
+        self.cancel_open_retry()
+        self.emit("monitoring", active=False)
+    
+    def update_detail(self, text):
+        """詳細表示を更新（スレッドセーフ）"""
+        self.emit("detail", text=text)
+    
+    def add_to_queue(self):
+        """現在のポップアップウィンドウの講座を予約リストに追加（追加した講座IDを返す）"""
+        if self.driver is None:
+            self.notify("warning", "ブラウザが起動していません")
+            return None
+        
+        try:
+            # ポップアップウィンドウを探す（ユーザーが画面を移動しているかもしれないので調べ直す）
+            popup = self.find_popup_window(refresh=True, priority=PRIORITY_USER)
+            if popup is None:
+                # 確認テスト画面やレッスン画面も含めて探す
+                popup = self.find_popup_window(match=is_lesson_url, priority=PRIORITY_USER)
+            
+            if popup is None:
+                self.notify("warning", "講座画面が見つかりません。\n講座を開いてから予約してください。")
+                return None
+            
+            url = self.window_info(popup, priority=PRIORITY_USER)["url"]
+            
+            # URLから講座IDを抽出
+            lesson_id = lesson_id_from_url(url)
+            if lesson_id is None:
+                self.notify("warning", "講座IDを取得できませんでした")
+                return None
+            
+            # 既に予約済みかチェック
+            if lesson_id in self.lesson_queue:
+                self.notify("info", "この講座は既に予約済みです")
+                return None
+            
+            # 予約リストに講座IDを追加
+            self.lesson_queue.add(lesson_id)
+            self.emit("queue_changed", count=len(self.lesson_queue))
+            
+            # ポップアップを閉じる（予約のために閉じたので、監視中でも次の講座は開かない）
+            self.set_state(POPUP_CLOSED)
+            self.wakeup.set()
+            def close_popup(driver):
+                driver.close()
+                if driver is self.driver:
+                    self.current_window = None
+                self.channels.pop(popup, None)
+            
+            self.drive("ポップアップを閉じる", close_popup, popup, priority=PRIORITY_USER)
+            self.windows.invalidate(popup)
+            self.drive("メインウィンドウに戻る", lambda d: None, self.main_window, priority=PRIORITY_USER)
+            
+            logger.info("講座を予約: L=%s", lesson_id)
+            self.emit("lesson_added", lesson_id=lesson_id, count=len(self.lesson_queue))
+            return lesson_id
+        
+        except Exception as e:
+            logger.error("予約追加エラー: %s", e)
+            self.notify("error", f"予約追加に失敗:\n{e}")
+            return None
+    
+    def add_lessons(self, lesson_ids):
+        """講座IDをまとめて予約リストに追加（予約済みの講座は飛ばす）。追加した件数を返す"""
+        added = 0
+        for lesson_id in lesson_ids:
+            if lesson_id in self.lesson_queue:
+                logger.info("予約済みのため飛ばします: L=%s", lesson_id)
+                continue
+            self.lesson_queue.add(lesson_id)
+            added += 1
+        if added:
+            logger.info("講座を予約: %d件", added)
+            self.emit("queue_changed", count=len(self.lesson_queue))
+        return added
+    
+    def remove_from_queue(self, lesson_id):
+        """講座を予約リストから削除"""
+        self.lesson_queue.remove(lesson_id)
+        self.emit("queue_changed", count=len(self.lesson_queue))
+        logger.info("予約削除: %s", lesson_id)
+    
+    def start_continuous(self):
+        """連続受講を開始（始められなければFalse）"""
+        if self.driver is None:
+            self.notify("warning", "ブラウザを起動してください")
+            return False
+        
+        if len(self.lesson_queue) == 0:
+            self.notify("warning", "予約リストが空です。\n講座を予約してから開始してください。")
+            return False
+        
+        # 最初の講座を開く（開き終わるまで監視スレッドは待機する）
+        self.set_state(OPENING_NEXT)
+        self.open_next_queue()
+        return True
+    
+    def open_next_queue(self, failures=0):
+        """予約リストの次の講座を開く（終わったら状態を OPENING_NEXT から進める）
+        
+        failures は続けて開けなかった回数（やり直しは retry_open_next_queue で待ってから投入する）
+        """
+        try:
+            # ポップアップが閉じていて監視も待機中なので、ブラウザを作り直すならここ
+            self.check_memory()
+            opened = self._open_next_queue_impl()
+        except Exception as e:
+            # 講座を取り出す前に失敗した（講座は fail していない）→ 同じ講座を上限までやり直す
+            lesson_id = self.lesson_queue.interrupted() or self.lesson_queue.peek_next()
+            if failures + 1 < QUEUE_PREPARE_MAX_FAILURES:
+                logger.warning("講座 L=%s を開く準備に失敗したのでやり直します（%d回目）: %s", lesson_id, failures + 1, e)
+                self.retry_open_next_queue(failures + 1)
+                return
+            logger.error("講座 L=%s を開く準備に%d回失敗したので連続受講を止めます: %s", lesson_id, failures + 1, e)
+            opened = False
+        else:
+            if opened is False and len(self.lesson_queue) > 0:
+                # 開けなかった講座は fail で未受講に戻した（試行回数の上限なら外した）→ 待ってから次を開く
+                lesson_id = self.lesson_queue.interrupted() or self.lesson_queue.peek_next()
+                logger.warning("講座を開けなかったので、待ってから L=%s を開きます（続けて%d回目の失敗）", lesson_id, failures + 1)
+                self.retry_open_next_queue(failures + 1)
+                return
+        if opened:
+            self.set_state(None)  # 開いたページから状態を決める
+        else:
+            self.set_state(POPUP_CLOSED)
+            if opened is False:
+                self.emit("queue_empty", reason="open_failed")
+    
+    def retry_open_next_queue(self, failures):
+        """続けて failures 回開けなかったので、その回数に応じて待ってから open_next_queue をやり直す
+        
+        待つ間も作業スレッドを塞がないよう、タイマーから投入する（監視を止めたら取り消す）
+        """
+        delay = min(QUEUE_RETRY_DELAY * 2 ** (failures - 1), QUEUE_RETRY_MAX_DELAY)
+        timer = threading.Timer(delay, self.submit, (self.open_next_queue, failures))
+        timer.daemon = True
+        self.open_retry = timer
+        timer.start()
+    
+    def cancel_open_retry(self):
+        """待っている open_next_queue のやり直しを取り消す（取り消したらポップアップを探す状態に戻す）"""
+        timer, self.open_retry = self.open_retry, None
+        if timer is not None and timer.is_alive():
+            timer.cancel()
+            self.transition(OPENING_NEXT, POPUP_CLOSED)
+    
+    def _open_next_queue_impl(self):
+        """open_next_queueの実装（ポップアップを開けたらTrue、開く講座がなければNone）"""
+        next_lesson_id = self.lesson_queue.start_next()
+        if next_lesson_id is None:
+            logger.info("予約リストの講座を全て受講しました")
+            self.emit("queue_empty", reason="all_done")
+            return None
+        
+        # 取り出した講座は受講中になる（ポップアップが閉じたら受講済み）
+        logger.info("次の講座を開く: L=%s", next_lesson_id)
+        self.emit("lesson_started", lesson_id=next_lesson_id, remaining=self.lesson_queue.pending_count())
+        timer = TransitionTimer(f"講座オープン L={next_lesson_id}")
+        self.metrics.begin_lesson(next_lesson_id, "mypage")
+        
+        try:
+            # マイページの索引から講座のリンクを1回で開く（索引がなければマイページを読み込んで作る）
+            entry = self.mypage_entry(next_lesson_id)
+            timer.step("マイページ")
+            self.metrics.enter_phase("link")
+            
+            handles_before = self.get_window_handles()
+            result = self.open_lesson_link(entry)
+            if result == "no_function":
+                # マイページから移動していた → 読み込み直して索引を作り直す
+                self.mypage_index = None
+                entry = self.mypage_entry(next_lesson_id)
+                handles_before = self.get_window_handles()
+                result = self.open_lesson_link(entry)
+            logger.info("講座リンク (%s, type=%s): %s", entry["area"], entry["type"], result)
+            timer.step("リンク")
+            self.metrics.enter_phase("popup")
+            
+            # ポップアップが開くのを待ってから探す
+            self.wait_until(EC.new_window_is_opened(handles_before), STEP_TIMEOUTS["popup"], "ポップアップ出現")
+            self.popup_window = self.find_popup_window()
+            logger.info("ポップアップ検出: %s", self.popup_window)
+            timer.step("ポップアップ")
+            self.metrics.enter_phase("playback")
+            
+            if self.popup_window:
+                if not self.monitoring:
+                    self.start_monitoring()
+                # 監視開始後も明示的に再生ボタンをクリック
+                logger.info("連続受講: 再生開始を試みます")
+                self.click_play_button(timer)
+                return True
+            logger.warning("ポップアップが見つかりませんでした")
+            error = "ポップアップが見つかりませんでした"
+        except Exception as e:
+            logger.error("講座オープンエラー: %s", e)
+            error = e
+        finally:
+            timer.report()
+        self.mypage_index = None  # マイページの内容が変わったかもしれないので次は作り直す
+        self.metrics.end_lesson()
+        gave_up = self.lesson_queue.fail(next_lesson_id, error)
+        if gave_up:
+            logger.error("講座 L=%s は%d回開けなかったので予約リストから外しました", next_lesson_id, QUEUE_MAX_ATTEMPTS)
+        self.emit("lesson_failed", lesson_id=next_lesson_id, error=str(error), gave_up=gave_up)
+        return False
+    
+    def memory_usage(self):
+        """Chromeのメモリ使用量を (MB, 測り方, 種類別MB) で返す（測れなければNone）
+        
+        自分で起動したChromeはプロセス全体のRSS（psutilが必要）、
+        それ以外はCDPで取ったメインウィンドウのJSヒープで代用する
+        """
+        by_type = self.resources.memory_by_type() if self.resources is not None else None
+        if by_type:
+            return sum(by_type.values()), "rss", by_type
+        try:
+            heap = self.drive("メモリ計測", read_js_heap, self.main_window, priority=PRIORITY_BACKGROUND)
+        except Exception as e:
+            logger.debug("メモリ使用量を測れません: %s", e)
+            return None
+        return heap, "js_heap", None
+    
+    def check_memory(self):
+        """講座の合間にメモリ使用量を記録し、上限を超えていればメインウィンドウ → ブラウザの順に作り直す"""
+        usage = self.memory_usage()
+        if usage is None:
+            return
+        mb, source, by_type = usage
+        limit = self.memory_limit_mb if source == "rss" else JS_HEAP_LIMIT_MB
+        if not self.memory_limit_mb or mb < limit:
+            self.metrics.record_memory(mb, source, by_type)
+            logger.info("Chromeのメモリ使用量: %.0fMB (%s) %s", mb, source, format_memory(by_type))
+            return
+        
+        logger.warning("Chromeのメモリ使用量 %.0fMB が上限 %dMB を超えたのでメインウィンドウを作り直します %s",
+                       mb, limit, format_memory(by_type))
+        self.metrics.record_memory(mb, source, by_type, action="window")
+        self.emit("memory", mb=round(mb), limit=limit, action="window")
+        self.recycle_main_window()
+        
+        usage = self.memory_usage()
+        if usage is None:
+            return
+        mb, source, by_type = usage
+        if mb < limit or self.attached:
+            # 作り直した後の値から増え方を測り直す（接続しただけのChromeは起動し直せない）
+            self.metrics.record_memory(mb, source, by_type)
+            logger.info("作り直した後のメモリ使用量: %.0fMB", mb)
+            return
+        logger.warning("まだ %.0fMB 使っているのでブラウザを起動し直します", mb)
+        self.metrics.record_memory(mb, source, by_type, action="browser")
+        self.emit("memory", mb=round(mb), limit=limit, action="browser")
+        self.restart_browser()
+        
+        usage = self.memory_usage()
+        if usage is not None:
+            self.metrics.record_memory(*usage)
+            logger.info("起動し直した後のメモリ使用量: %.0fMB", usage[0])
+    
+    def recycle_main_window(self):
+        """メインウィンドウを新しいタブで開き直して古いタブを閉じる（同じブラウザなのでログイン状態はそのまま）"""
+        old = self.main_window
+        def command(driver):
+            driver.switch_to.new_window("tab")
+            new = driver.current_window_handle
+            self.current_window = new
+            driver.get(MYPAGE_URL)
+            driver.switch_to.window(old)
+            driver.close()
+            driver.switch_to.window(new)
+            channel = self.channels.pop(old, None)
+            if channel is not None:
+                channel.disconnect()
+            return new
+        self.main_window = self.drive("メインウィンドウを作り直す", command)
+        self.windows.invalidate(old)
+        self.get_window_handles()
+        self.mypage_index = None
+        self.prefetched_lesson = None
+        logger.info("メインウィンドウを作り直しました")
+    
+    def restart_browser(self):
+        """ブラウザを終了して起動し直し、Cookieを引き継いでマイページを開く
+        
+        起動し直している間は見張りを止める（終わったら心拍を打ち直す）
+        """
+        with self.restart_lock:
+            self.restarting = True
+            try:
+                self._restart_browser()
+            finally:
+                self.restarting = False
+                self.beat()
+    
+    def _restart_browser(self):
+        """restart_browser の実装"""
+        started = time.monotonic()
+        try:
+            cookies = self.drive("Cookie取得", lambda d: d.get_cookies(), self.main_window, native=True)
+        except Exception as e:
+            # ブラウザが応答しない（見張りからの再起動）ときは引き継げない
+            logger.warning("Cookieを取得できません: %s", e)
+            cookies = []
+        try:
+            self.drive("ブラウザ終了", lambda d: d.quit(), priority=PRIORITY_USER, deadline=EVENT_WAIT_TIMEOUT + 5)
+        except Exception as e:
+            logger.warning("ブラウザ終了に失敗: %s", e)
+        for attempt in range(2):
+            try:
+                self.launch_driver()
+                break
+            except Exception as e:
+                # 終了したChromeがまだプロファイルを使っていることがあるので、少し待って1回だけやり直す
+                if attempt:
+                    raise
+                logger.warning("ブラウザの再起動に失敗したのでやり直します: %s", e)
+                time.sleep(BROWSER_RESTART_RETRY_DELAY)
+        
+        def restore(driver):
+            driver.set_script_timeout(EVENT_WAIT_TIMEOUT + 10)
+            driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+            self.current_window = driver.current_window_handle
+            # Cookieはそのドメインのページを開いてからでないと設定できない
+            driver.get(LOGIN_URL)
+            restored = 0
+            for cookie in cookies:
+                try:
+                    driver.add_cookie(cookie)
+                    restored += 1
+                except Exception as e:
+                    logger.debug("Cookieを引き継げません: %s (%s)", cookie.get("name"), e)
+            driver.get(MYPAGE_URL)
+            logger.info("Cookieを%d/%d件引き継ぎました", restored, len(cookies))
+            return self.current_window
+        
+        self.main_window = self.drive("マイページを開き直す", restore, priority=PRIORITY_USER,
+                                      timeout=PAGE_LOAD_TIMEOUT * 2 + COMMAND_TIMEOUT)
+        self.windows.update([self.main_window])
+        self.popup_window = None
+        self.mypage_index = None
+        self.prefetched_lesson = None
+        logger.info("ブラウザを起動し直しました: %.2f秒", time.monotonic() - started)
+    
+    def build_mypage_index(self, timeout=STEP_TIMEOUTS["mypage"]):
+        """メインウィンドウでマイページを読み込み、全講座のリンクの索引を作る（timeout: 読み込みを待つ秒数）"""
+        main = self.main_window
+        logger.info("マイページに移動中...")
+        self.drive("マイページに移動", lambda d: d.get(MYPAGE_URL), main)
+        index = self.wait_until(
+            lambda d: d.execute_script(MYPAGE_INDEX_JS),
+            timeout, "マイページ読み込み", main
+        )["index"]
+        if not index:
+            # リンクに引数が書かれていない（イベントで結び付けている）→ 関数呼び出しで開く
+            logger.warning("マイページの講座リンクから引数を読めません（lnkNewLesson_OnClick を直接呼びます）")
+        areas = {}
+        for entry in index.values():
+            areas[entry["area"]] = areas.get(entry["area"], 0) + 1
+        logger.info("マイページの講座索引: %d件 %s", len(index), areas)
+        self.mypage_index = index
+    
+    def mypage_entry(self, lesson_id, timeout=STEP_TIMEOUTS["mypage"]):
+        """索引から講座のリンク情報を返す
+        
+        索引がない・講座が索引にないときはマイページを読み込み直して作り直す（索引が空のページは作り直さない）。
+        それでも見つからない講座は、新着以外の種類（2、だめなら3）として lnkNewLesson_OnClick を呼ぶ。
+        準備のスレッドが索引を作っている間は、それが終わるのを待つ
+        """
+        with self.mypage_lock:
+            if self.mypage_index is None or (self.mypage_index and lesson_id not in self.mypage_index):
+                self.build_mypage_index(timeout)
+            entry = self.mypage_index.get(lesson_id)
+        if entry is None:
+            logger.warning("講座 L=%s はマイページの索引にありません（種類2・3として開きます）", lesson_id)
+            anchor_id = f"linkNewLessonPC-{lesson_id}"
+            entry = {"anchor_id": anchor_id, "args": [lesson_id, 2, 1, anchor_id, 0], "type": 2, "area": "unknown"}
+        return entry
+    
+    def open_lesson_link(self, entry):
+        """索引の1件の講座を開く（見えているリンクはクリック、それ以外は関数呼び出し）
+        
+        索引になかった講座は種類2で呼んで、失敗したら種類3で呼び直す
+        """
+        if entry["area"] != "unknown":
+            return self._open_lesson_link(entry)
+        for lesson_type in (2, 3):
+            args = list(entry["args"])
+            args[1] = lesson_type
+            attempt = dict(entry, args=args, type=lesson_type)
+            try:
+                result = self._open_lesson_link(attempt)
+            except JavascriptException as e:
+                logger.warning("講座 L=%s を種類%dで開けません: %s", args[0], lesson_type, e)
+                if lesson_type == 3:
+                    raise
+                continue
+            entry.update(attempt)
+            return result
+    
+    def _open_lesson_link(self, entry):
+        """open_lesson_link の実装"""
+        return self.drive("講座リンクを開く", lambda d: d.execute_script(OPEN_LESSON_JS, entry), self.main_window)
+    
+    def click_play_button(self, timer=None):
+        """再生ボタンをクリック（EQプレイヤーのJavaScript APIを使用）
+        
+        timer を渡すと、プレイヤー準備と再生開始までの所要時間をそこに記録する
+        """
+        popup = self.popup_window
+        try:
+            logger.debug("=== 再生開始処理 ===")
+            
+            # プレイヤーのAPIが使えるようになるまで待つ
+            player_ready = self.wait_until(
+                lambda d: d.execute_script(PLAYER_READY_JS),
+                STEP_TIMEOUTS["player"], "プレイヤー準備", popup
+            )
+            if timer:
+                timer.step("プレイヤー準備")
+            
+            # 方法1: まずプレイヤー領域をクリック（オートプレイポリシー回避）
+            # CDPでマウス操作を送るので、ウィンドウが最小化・背面でも前面に出さずにクリックできる
+            def click_player_area(driver):
+                point = driver.execute_script(ELEMENT_CENTER_JS, "eqPlayer")
+                if point is None:
+                    raise NoSuchElementException("プレイヤー領域が見えません")
+                dispatch_click(driver, point)
+                logger.debug("Step1: プレイヤー領域をクリック (%.0f, %.0f)", point["x"], point["y"])
+            
+            try:
+                self.drive("プレイヤー領域をクリック", click_player_area, popup)
+            except Exception as e:
+                logger.warning("プレイヤークリック失敗: %s", e)
+            
+            # 方法2: JavaScript APIで再生（再生状態になったことを確認できるまで再試行）
+            if player_ready:
+                for attempt in range(3):
+                    try:
+                        result = self.drive("再生API", lambda d: d.execute_script("""
+                            if (typeof player !== 'undefined' && player && player.accessor) {
+                                try {
+                                    player.accessor.play();
+                                    return 'play() called';
+                                } catch(e) {
+                                    return 'play() error: ' + e.toString();
+                                }
+                            }
+                            return 'player not ready';
+                        """), popup)
+                        logger.debug("Step3: 再生API試行%s: %s", attempt+1, result)
+                        if 'called' in result and self.wait_until(
+                            lambda d: d.execute_script(PLAYER_PLAYING_JS),
+                            STEP_TIMEOUTS["play_confirm"], "再生確認", popup
+                        ):
+                            break
+                    except Exception as e:
+                        logger.warning("再生API例外%s: %s", attempt+1, e)
+            
+            # 方法3: video要素を直接操作
+            # iframeはクロスオリジンなので、フレームを切り替えて中で実行する
+            try:
+                result = self.drive("iframe内video再生", in_player_frame(VIDEO_PLAY_JS), popup)
+                logger.debug("Step4: iframe内video.play()試行: %s", result)
+            except Exception as e:
+                logger.warning("iframe操作失敗: %s", e)
+            
+            if timer:
+                timer.step("再生開始")
+            return True
+        except Exception as e:
+            logger.error("再生ボタンエラー: %s", e)
+            return False
+    
+    def wait_until(self, condition, timeout, step_name, handle=None):
+        """条件 condition(driver) が満たされるまで待機（満たされればその値、タイムアウトならFalseを返す）
+        
+        判定は1回ずつ仲介スレッドで実行するので、待機中も他のスレッドの操作が割り込める
+        """
+        started = time.monotonic()
+        end = started + timeout
+        try:
+            while True:
+                try:
+                    value = self.drive(step_name, condition, handle)
+                    if value:
+                        return value
+                except (NoSuchElementException, StaleElementReferenceException):
+                    pass
+                except JavascriptException as e:
+                    logger.debug("%s: 遷移中でスクリプトを実行できません: %s", step_name, e)
+                if time.monotonic() >= end:
+                    logger.warning("待機タイムアウト: %s (%s秒)", step_name, timeout)
+                    return False
+                time.sleep(WAIT_POLL_INTERVAL)
+        finally:
+            self.metrics.record_wait(step_name, time.monotonic() - started)
+    
+    def wait_for_navigation(self, old_page, step_name, handle):
+        """クリック前に目印を付けた文書（old_page は目印の値）が入れ替わる（ページ遷移する）まで待機
+        
+        ウィンドウ自体が閉じた場合も遷移完了とみなし、Falseを返す
+        """
+        self.windows.invalidate(handle)
+        try:
+            self.wait_until(
+                lambda d: d.execute_script(PAGE_CHANGED_JS, old_page),
+                STEP_TIMEOUTS["navigation"], step_name, handle
+            )
+            self.wait_until(
+                lambda d: d.execute_script("return document.readyState") == "complete",
+                STEP_TIMEOUTS["navigation"], f"{step_name}（読み込み）", handle
+            )
+            return True
+        except NoSuchWindowException:
+            return False
+    
+    def monitor_loop(self, generation):
+        """監視ループ（ポップアップウィンドウのみ監視）
+        
+        現在の状態から抜ける条件に関わるコントロールだけをスナップショットで調べ、
+        遷移表（decide）で次の状態と処理を決めて実行する。
+        イベント駆動ならページ内の監視スクリプトから状態変化が届くまで待つ。
+        見張りが新しい世代のループを始めたら（generation が古くなったら）終わる
+        """
+        last_title = None
+        event_failures = 0
+        wait_timeout = EVENT_WAIT_TIMEOUT
+        while self.monitoring and generation == self.monitor_generation:
+            self.beat()
+            action = None
+            started = time.perf_counter()
+            snapshot_ms = None
+            try:
+                state = self.state
+                snap = None
+                if state in STATE_CONTROLS:
+                    # ページ状態を取得（ポップアップが閉じていれば snap は None）
+                    controls = {key: CONTROL_IDS[key] for key in STATE_CONTROLS[state]}
+                    waiting = self.event_driven and state is not None
+                    try:
+                        if self.cdp is not None and self.consume_cdp_events():
+                            raise NoSuchWindowException("ポップアップが閉じられました（CDP）")
+                        if waiting:
+                            snap = self.wait_page_event(self.popup_window, wait_timeout, controls)
+                            event_failures = 0
+                        else:
+                            snap = self.probe_page(self.popup_window, controls)
+                    except (JavascriptException, TimeoutException) as e:
+                        # 待機中のページ遷移など → イベント待機ならすぐに取り直す
+                        self.record("error", state=state, step="snapshot", error=str(e))
+                        event_failures += 1
+                        if event_failures >= EVENT_WAIT_MAX_FAILURES:
+                            logger.warning("イベント監視に失敗が続いたためポーリング監視に切り替えます: %s", e)
+                            self.event_driven = False
+                        if not waiting or not self.event_driven:
+                            time.sleep(1)  # ポーリングは失敗しても1秒あける（続けて取り直すとコマンドが詰まる）
+                        continue
+                    except NoSuchWindowException:
+                        pass
+                    snapshot_ms = (time.perf_counter() - started) * 1000
+                
+                if snap is not None:
+                    logger.debug("スナップショット: %s", snap)
+                    if self.metrics.current is None:
+                        self.metrics.begin_lesson(lesson_id_from_url(snap["url"]), page_phase(snap))
+                    else:
+                        self.metrics.enter_phase(page_phase(snap))
+                    if self.cdp is not None and snap["player"] is not None and snap["player"]["time"] is None:
+                        # プレイヤーAPIで再生位置が取れない場合は<video>から直接読む
+                        snap["video"] = self.read_video_state(self.popup_window)
+                    if snap["player"] is not None:
+                        self.track_playback(snap)
+                    self.windows.remember(self.popup_window, snap["title"], snap["url"])
+                    if snap["title"] != last_title:
+                        logger.info("現在のページタイトル: %s", snap["title"])
+                        last_title = snap["title"]
+                
+                queued = self.lesson_queue.pending_count()
+                decided = time.perf_counter()
+                next_state, action = decide(state, snap, queued)
+                decide_us = (time.perf_counter() - decided) * 1e6
+                if not self.transition(state, next_state):
+                    # 判断の間に他のスレッド（予約・講座を開く処理・見張り）が状態を変えた → 変わった状態で判断し直す
+                    logger.debug("状態が変わったので判断し直します: %s → %s (%s は実行しない)", state, self.state, action)
+                    self.record("superseded", state=state, current=self.state, next=next_state, action=action)
+                    action = None
+                    continue
+                if next_state != state:
+                    logger.debug("状態: %s → %s (%s)", state, next_state, action)
+                    self.emit("state", state=next_state, action=action)
+                acted = time.perf_counter()
+                try:
+                    self.state_actions[action](snap)
+                finally:
+                    # 判断に使ったスナップショット・決めた処理・各ステップの所要時間を残す
+                    self.record(
+                        "tick", state=state, snap=snap, queued=queued, next=next_state, action=action,
+                        snapshot_ms=round_or_none(snapshot_ms, 1), decide_us=round(decide_us, 1),
+                        action_ms=round((time.perf_counter() - acted) * 1000, 1),
+                    )
+                
+            except Exception as e:
+                self.record("error", state=self.state, step=action or "snapshot", error=str(e))
+                logger.warning("監視エラー: %s", e)
+                self.update_detail(f"エラー: {str(e)[:30]}")
+                time.sleep(1)
+                continue
+            
+            # 再生中は終了予定の少し前まで眠る（一時停止の確認のため最大 pause_check_seconds 秒）
+            delay = next_wakeup(snap, self.pause_check_seconds) if action in ("show_progress", "recover_playback") else None
+            # 眠った後は溜まったイベントだけ受け取ればよいので待たない（終了間際は変化まで待つ）
+            wait_timeout = 0 if delay is not None and delay > NEAR_END_POLL_INTERVAL else EVENT_WAIT_TIMEOUT
+            if delay is not None:
+                self.beat(delay)
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+            # ポーリング監視の場合は1秒待機（イベント駆動なら次の変化まで待機スクリプト側で待つ）
+            elif not self.event_driven or self.state is None:
+                time.sleep(1)
+    
+    def track_playback(self, snap):
+        """再生位置の進み方から再生の状態を決めて snap["playback"] に入れ、停滞で失った秒数を講座に記録する
+        
+        進んでいなければ<video>の状態（readyState・一時停止・終了）も読んで、バッファリングか
+        一時停止か終了かを見分ける
+        """
+        now = time.monotonic()
+        previous = self.playback.status
+        playback = self.playback.update(now, snap)
+        if playback["status"] in ("buffering", "stalled") and snap.get("video") is None:
+            snap["video"] = self.read_video_state(self.popup_window)
+            playback = dict(self.playback.classify(snap, now), lost_delta=playback["lost_delta"])
+        if playback["lost_delta"]:
+            self.metrics.record_buffering(playback["lost_delta"])
+        if playback["status"] == "buffering" and previous == "playing":
+            logger.info("バッファリング中です（readyState=%s）", playback["ready_state"])
+        elif playback["status"] == "playing" and previous in ("buffering", "stalled"):
+            logger.info("再生が進み始めました（この動画の停滞: 計%.1f秒）", playback["lost"])
+            self.emit("buffering", stage="resumed", lost=playback["lost"])
+        snap["playback"] = playback
+    
+    def on_next_study(self, snap):
+        """「次の学習へ」「テストへ」ボタンをクリックしてページ遷移を待つ"""
+        popup = self.popup_window
+        link_text = snap["next_study_text"]
+        self.update_detail(f"検出: {link_text}")
+        logger.info("ボタン検出: %s", link_text)
+        
+        # クリック
+        timer = TransitionTimer(link_text or "次の学習へ")
+        old_page = self.drive("次の学習へクリック", click_control("next_study"), popup)
+        logger.info("クリック完了: %s", link_text)
+        self.update_detail(f"クリック: {link_text}")
+        
+        # ページ遷移を待機（同じポップアップ内で遷移したならハンドルはそのまま）
+        if not self.wait_for_navigation(old_page, "次ページへの遷移", popup):
+            # ポップアップが閉じた → 新しいポップアップを探す
+            self.popup_window = self.find_popup_window()
+        timer.step("遷移")
+        timer.report()
+    
+    def on_await_page(self, snap):
+        """読み込み途中のレッスン画面で、動画ページかテストなどのページかが分かるまで待つ"""
+        page_kind = self.wait_until(
+            lambda d: d.execute_script(PAGE_KIND_JS),
+            STEP_TIMEOUTS["player"], "遷移先ページの判定", self.popup_window
+        )
+        logger.debug("遷移先ページ: %s", page_kind)
+    
+    def on_start_player(self, snap):
+        """次の動画ページに移ったので再生を開始"""
+        timer = TransitionTimer("再生開始")
+        self.click_play_button(timer)
+        self.update_detail("再生開始...")
+        timer.report()
+    
+    def on_answer_exam(self, snap):
+        """確認テストを自動回答して提出"""
+        popup = self.popup_window
+        self.update_detail("テスト回答中...")
+        logger.info("テスト回答画面検出 - 自動回答開始")
+        
+        # JavaScriptでラジオボタン選択 + 答案提出を一括実行
+        # checked=trueでポストバックを防ぎ、即座にsubmitクリック
+        timer = TransitionTimer("答案提出")
+        old_page = self.drive("ページの目印", lambda d: d.execute_script(MARK_PAGE_JS), popup)
+        result = self.drive("テスト自動回答", lambda d: d.execute_script("""
+            // 全てのラジオボタングループを取得
+            var radioGroups = {};
+            var radios = document.querySelectorAll('input[type="radio"]');
+            radios.forEach(function(radio) {
+                var name = radio.name;
+                if (!radioGroups[name]) {
+                    radioGroups[name] = [];
+                }
+                radioGroups[name].push(radio);
+            });
+            
+            // 各グループの最初のラジオボタンを選択（checked=trueでポストバック回避）
+            var count = 0;
+            for (var name in radioGroups) {
+                if (radioGroups[name].length > 0) {
+                    radioGroups[name][0].checked = true;
+                    count++;
+                }
+            }
+            
+            // 答案提出ボタンをクリック
+            var submitBtn = document.getElementById('ctl00_examBody_lnkExamAnswerSubmit');
+            if (submitBtn) {
+                submitBtn.click();
+                return count + '問回答 + 答案提出';
+            }
+            return count + '問回答（提出ボタン見つからず）';
+        """), popup)
+        logger.info("テスト処理結果: %s", result)
+        self.update_detail("答案提出完了")
+        self.wait_for_navigation(old_page, "解説画面への遷移", popup)
+        timer.step("遷移")
+        timer.report()
+    
+    def on_exam_next(self, snap):
+        """テスト解説画面の「次へ」をクリック"""
+        popup = self.popup_window
+        self.update_detail("解説画面 - 次へ")
+        logger.info("解説画面検出 - 次へクリック")
+        timer = TransitionTimer("解説画面 - 次へ")
+        old_page = self.drive("解説画面 次へクリック", click_control("exam_next"), popup)
+        self.wait_for_navigation(old_page, "解説画面からの遷移", popup)
+        timer.step("遷移")
+        timer.report()
+    
+    def on_survey_end(self, snap):
+        """アンケート画面の「終了」をクリック"""
+        popup = self.popup_window
+        self.update_detail("アンケート画面 - 終了")
+        logger.info("アンケート画面検出 - 終了クリック")
+        timer = TransitionTimer("アンケート - 終了")
+        old_page = self.drive("アンケート終了クリック", click_control("survey_end"), popup)
+        self.wait_for_navigation(old_page, "アンケート終了後の遷移", popup)
+        timer.step("遷移")
+        timer.report()
+    
+    def on_resume_player(self, snap):
+        """動画が停止していたら再生する（強制再生機能）"""
+        popup = self.popup_window
+        result = self.drive("再生再開", lambda d: d.execute_script(RESUME_PLAYER_JS), popup)
+        if result == 'playing' and (snap.get("video") or {}).get("paused"):
+            # プレイヤーは再生中のつもりでも<video>が止まっている
+            result = self.drive("iframe内video再生", in_player_frame(VIDEO_PLAY_JS), popup)
+        if result in ('resumed', 'played'):
+            logger.info("動画を再開しました")
+            self.update_detail("動画再開...")
+    
+    def on_recover_playback(self, snap):
+        """再生位置が進まなくなった動画を再開する
+        
+        今の位置より STALL_RESEEK_BACK 秒前にシークし直し（先へのスキップにはならない）、
+        STALL_RESEEK_ATTEMPTS 回で直らなければ<video>を読み込み直して同じ位置に戻す。
+        MSE（blob: URL）の<video>は読み込み直せないので、プレイヤーのAPIでシークし直し、
+        それもなければ講座を開き直して同じ位置に戻す
+        """
+        popup = self.popup_window
+        playback = snap["playback"]
+        attempt = self.playback.recoveries
+        if attempt >= STALL_MAX_RECOVERIES:
+            logger.warning("再生が止まったままです（復旧をやめて、進み始めるのを待ちます）")
+            self.update_detail(f"再生が止まっています... {format_seconds(playback['stalled_for'])}")
+            return
+        self.playback.recovering(time.monotonic())
+        position, duration = playback_position(snap)
+        target = max(0.0, position - STALL_RESEEK_BACK)
+        kind = "reseek" if attempt < STALL_RESEEK_ATTEMPTS else "reload"
+        try:
+            if kind == "reseek":
+                result = self.drive("再生位置のシーク", lambda d: d.execute_script(SEEK_PLAYER_JS, target), popup)
+                if result == 'no_seek':
+                    result = self.drive("iframe内videoのシーク", in_player_frame(video_seek_script(target)), popup)
+            else:
+                result = self.drive(
+                    "iframe内videoの読み込み直し", in_player_frame(video_seek_script(target, reload=True)), popup
+                )
+                if result == 'blob_source':
+                    kind = "player"
+                    result = self.drive("再生位置のシーク", lambda d: d.execute_script(SEEK_PLAYER_JS, target), popup)
+                    if result in ('no_player', 'no_seek'):
+                        kind = "reopen"
+                        result = self.reopen_lesson(snap["url"], target)
+        except (NoSuchElementException, JavascriptException) as e:
+            result = f"失敗: {e}"
+        self.metrics.record_buffering_recovery(kind)
+        logger.info(
+            "再生が%.0f秒止まっているため復旧します（%s %d回目, %s → %s）: %s",
+            playback["stalled_for"], kind, attempt + 1, format_seconds(position), format_seconds(target), result
+        )
+        self.emit("buffering", stage="recovering", kind=kind, attempt=attempt + 1,
+                  position=round(position, 1), stalled=playback["stalled_for"])
+        self.update_detail(f"再生の停滞から復旧中... {format_seconds(target)}")
+        if kind == "reopen" and result == 'reopening':
+            self.metrics.end_lesson()
+            self.submit(self.open_next_queue)
+    
+    def reopen_lesson(self, url, position):
+        """ポップアップを閉じて、受講中の講座を開き直す準備をする（予約リストの講座でなければ 'no_lesson'）
+        
+        開き直した講座が同じ動画ページで position 秒より前から再生を始めたら、on_show_progress が戻す
+        """
+        lesson_id = self.lesson_queue.interrupted()
+        if lesson_id is None:
+            return 'no_lesson'
+        logger.info("講座 L=%s を開き直して %s に戻ります", lesson_id, format_seconds(position))
+        self.resume_position = {"url": url, "position": position}
+        popup = self.popup_window
+        # 閉じたポップアップを受講済みと判定しないよう、閉じる前に講座を開く状態にする
+        self.set_state(OPENING_NEXT)
+        def close_popup(driver):
+            driver.close()
+            if driver is self.driver:
+                self.current_window = None
+            self.channels.pop(popup, None)
+        
+        self.drive("ポップアップを閉じる", close_popup, popup, priority=PRIORITY_USER)
+        self.windows.invalidate(popup)
+        self.popup_window = None
+        return 'reopening'
+    
+    def resume_reopened(self, snap, position):
+        """開き直した講座を、停滞した時点まで見終わっていた位置に戻す（見ていない所へは進めない）"""
+        resume = self.resume_position
+        if resume is None or snap["url"] != resume["url"] or position is None:
+            return
+        self.resume_position = None
+        if position >= resume["position"] - STALL_RESEEK_BACK:
+            return
+        target = resume["position"]
+        popup = self.popup_window
+        try:
+            result = self.drive("再生位置のシーク", lambda d: d.execute_script(SEEK_PLAYER_JS, target), popup)
+            if result in ('no_player', 'no_seek'):
+                result = self.drive("iframe内videoのシーク", in_player_frame(video_seek_script(target)), popup)
+        except (NoSuchElementException, JavascriptException) as e:
+            result = f"失敗: {e}"
+        logger.info("開き直した講座を %s → %s に戻しました: %s", format_seconds(position), format_seconds(target), result)
+    
+    def on_show_progress(self, snap):
+        """再生位置を表示（連続受講中なら次の講座の準備もする）"""
+        position, duration = playback_position(snap)
+        self.resume_reopened(snap, position)
+        label = "バッファリング中" if (snap.get("playback") or {}).get("status") == "buffering" else "再生中"
+        if position is not None and duration:
+            self.update_detail(f"{label}... {format_seconds(position)} / {format_seconds(duration)}")
+        else:
+            self.update_detail(f"{label}...")
+        self.prefetch_next_lesson(position, duration)
+    
+    def prefetch_next_lesson(self, position, duration):
+        """再生中に、メインウィンドウをマイページにして次の講座のリンクを索引から引いておく（準備のスレッドで実行）
+        
+        ポップアップが閉じたら open_next_queue はマイページを読み込まずにすぐ次の講座を開ける
+        """
+        lesson_id = self.lesson_queue.peek_next()
+        if lesson_id is None or lesson_id == self.prefetched_lesson:
+            return
+        if position is None or not duration or duration - position < PREFETCH_MIN_REMAINING:
+            return
+        self.prefetched_lesson = lesson_id  # 失敗しても同じ講座では繰り返さない
+        # 読み込みを待つのは動画の終わる少し前まで（講座を開く処理を長く待たせない）
+        timeout = min(STEP_TIMEOUTS["mypage"], duration - position - NEAR_END_MARGIN)
+        self.prefetcher.submit(self.prefetch_lesson, lesson_id, timeout)
+    
+    def prefetch_lesson(self, lesson_id, timeout):
+        """prefetch_next_lesson の実装（準備のスレッドで実行）"""
+        started = time.monotonic()
+        try:
+            with self.mypage_lock:
+                on_mypage = self.drive(
+                    "マイページ確認", lambda d: d.execute_script("return typeof lnkNewLesson_OnClick === 'function';"),
+                    self.main_window, priority=PRIORITY_BACKGROUND
+                )
+                if not on_mypage:
+                    self.mypage_index = None  # マイページから移動していれば読み込み直す
+                entry = self.mypage_entry(lesson_id, timeout)
+            logger.info("次の講座を準備しました: L=%s (%s, %.2f秒)", lesson_id, entry["area"], time.monotonic() - started)
+        except Exception as e:
+            with self.mypage_lock:
+                self.mypage_index = None
+            logger.warning("次の講座の準備に失敗: %s", e)
+    
+    def on_open_next(self, snap):
+        """ポップアップが閉じた → 予約リストの次の講座を開く（作業スレッドで実行）"""
+        self.finish_lesson()
+        logger.info("ポップアップ閉じ検出 - 次の講座を開く")
+        self.submit(self.open_next_queue)
+    
+    def on_lesson_done(self, snap):
+        """ポップアップが閉じ、予約リストも空"""
+        self.finish_lesson()
+        logger.info("講座の受講が終わりました（予約リストは空です）")
+        self.emit("queue_empty", reason="lesson_done")
+    
+    def finish_lesson(self):
+        """ポップアップが閉じた講座を終了として記録（予約リストの講座なら受講済みにする）"""
+        self.resume_position = None
+        lesson_id = self.metrics.end_lesson()
+        if lesson_id is not None:
+            self.lesson_queue.finish(lesson_id)
+            buffering = self.metrics.lessons[-1]["buffering"]
+            if buffering >= 1:
+                logger.info("L=%s の再生の停滞: 計%.1f秒", lesson_id, buffering)
+            self.emit("lesson_finished", lesson_id=lesson_id, buffering=round(buffering, 1))
+    
+    def on_find_popup(self, snap):
+        """新しいポップアップを探す"""
+        self.popup_window = self.find_popup_window()
+        if self.popup_window is None:
+            self.update_detail("ポップアップを探しています...")
+            time.sleep(2)
+            return
+        logger.info("ポップアップ検出: %s", self.popup_window)
+        self.transition(POPUP_CLOSED, None)
+    
+    def on_wait_open(self, snap):
+        """open_next_queue が終わるまで待機（WebDriver通信なし）"""
+        time.sleep(WAIT_POLL_INTERVAL)
+    
+    def on_wait(self, snap):
+        """条件を満たすまで何もしない"""
+        if snap is not None and snap["player"] is None and not snap["controls"].get("next_study"):
+            self.update_detail("ボタン待機中...")
+    
+    def shutdown(self, close_browser=True, export=True):
+        """監視を止めてブラウザを終了し、統計を書き出す
+        
+        接続しただけのChromeは閉じず、chromedriverだけ終了する
+        """
+        self.monitoring = False
+        self.wakeup.set()
+        self.cancel_open_retry()
+        self.worker.shutdown(wait=False, cancel_futures=True)
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
+        if self.recorder is not None:
+            self.recorder.close()
+        
+        if self.driver:
+            if self.attached:
+                try:
+                    self.driver.service.stop()
+                except:
+                    pass
+            elif close_browser:
+                try:
+                    self.drive("ブラウザ終了", lambda d: d.quit(), priority=PRIORITY_USER, deadline=EVENT_WAIT_TIMEOUT + 5)
+                except:
+                    pass
+        if self.channels:
+            try:
+                self.disconnect_channels(deadline=EVENT_WAIT_TIMEOUT + 5)
+            except:
+                pass
+        self.broker.stop()
+        
+        # 統計をファイルに書き出す（ブラウザを起動しなかったときは何もない）
+        if export and self.driver is not None:
+            try:
+                path = self.metrics.export(get_app_dir("metrics"))
+                logger.info("統計を書き出しました: %s", path)
+            except OSError as e:
+                logger.warning("統計の書き出しに失敗: %s", e)
+
 
 class MPLearningAutoTool:
-    """MPラーニング自動受講ツール"""
+    """MPラーニング自動受講ツールのウィンドウ（受講の処理は LearningEngine）"""
     
     def __init__(self):
-        self.driver = None
-        self.monitoring = False
-        self.monitor_thread = None
-        self.main_window = None  # メインウィンドウのハンドル
-        self.popup_window = None  # ポップアップウィンドウのハンドル
-        self.queue_list = []  # 予約リスト
-        self.continuous_mode = False  # 連続受講モード
-        self.opening_next = False  # 次の講座を開く処理中フラグ（二重発火防止）
+        self.root = tk.Tk()  # 先に作る（Tkの変数はウィンドウがないと作れない）
+        self.use_cdp = tk.BooleanVar(value=False)
+        self.refresh_driver = tk.BooleanVar(value=False)  # 起動時にchromedriverをダウンロードし直す
+        self.use_profile = tk.BooleanVar(value=False)  # ログイン状態・キャッシュを残す専用プロファイルで起動
+        self.attach_browser = tk.BooleanVar(value=False)  # リモートデバッグポートで起動中のChromeに接続
+        self.background_mode = tk.BooleanVar(value=False)  # 画面外・ミュート・省リソースで起動
+        self.headless_mode = tk.BooleanVar(value=False)  # バックグラウンド起動をヘッドレスにする（要ログイン済みプロファイル）
+        self.verbose_log = tk.BooleanVar(value=False)  # 詳細ログ（DEBUG）を出す
+        self.log_listener, self.log_ring = setup_logging()
+        self.log_version = -1  # ログ欄に表示済みのログの版
+        self.log_visible = False
+        self.engine = LearningEngine(self, recorder=open_flight_recorder())
+        self.sampler = ThreadPoolExecutor(max_workers=1, thread_name_prefix="resource-sampler")  # Chromeのプロセス集計
+        self.ui_tick = time.monotonic()  # 画面の応答の遅れの計測（watch_ui_lag）
+        self.ui_lag_max_ms = 0.0
+        self.pause_check_interval = tk.IntVar(value=PAUSE_CHECK_INTERVAL)
+        self.memory_limit = tk.IntVar(value=MEMORY_LIMIT_MB)
+        # エンジンからの通知 → 表示を更新するメソッド
+        self.event_handlers = {
+            "notice": self.on_notice,
+            "browser_started": self.on_browser_started,
+            "browser_failed": self.on_browser_failed,
+            "monitoring": self.on_monitoring,
+            "detail": lambda data: self.detail_label.config(text=data["text"]),
+            "queue_changed": lambda data: self.update_queue_display(),
+            "lesson_added": self.on_lesson_added,
+            "lesson_started": self.on_lesson_started,
+            "lesson_finished": lambda data: self.update_queue_display(),
+            "lesson_failed": lambda data: self.update_queue_display(),
+            "queue_empty": self.on_queue_empty,
+            "watchdog": self.on_watchdog,
+            "memory": self.on_memory,
+        }
         
         # GUI作成
-        self.root = tk.Tk()
         self.root.title("MPラーニング 自動受講 v3")
-        self.root.geometry("400x500")
+        self.root.geometry(WINDOW_SIZE)
         self.root.attributes("-topmost", True)
         self.root.configure(bg='#2C3E50')
         
@@ -46,7 +3759,7 @@ class MPLearningAutoTool:
             ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
         except Exception:
             pass
-
+        
         # アイコン設定（タスクバー・ウィンドウ）
         try:
             import sys, os
@@ -127,6 +3840,51 @@ class MPLearningAutoTool:
         )
         self.stop_button.pack(side=tk.LEFT, padx=3)
         
+        # 起動オプション（ブラウザ起動前に選ぶ）
+        option_frame = tk.Frame(self.root, bg='#2C3E50')
+        option_frame.pack(pady=2)
+        
+        self.option_checks = [
+            self.add_option_check(option_frame, "CDPイベント監視", self.use_cdp, 0, 0),
+            self.add_option_check(option_frame, "ドライバ再取得", self.refresh_driver, 0, 1),
+            self.add_option_check(option_frame, "プロファイル保持", self.use_profile, 1, 0),
+            self.add_option_check(option_frame, "起動中Chromeに接続", self.attach_browser, 1, 1),
+            self.add_option_check(option_frame, "バックグラウンド起動", self.background_mode, 2, 0),
+            self.add_option_check(option_frame, "ヘッドレス", self.headless_mode, 2, 1),
+        ]
+        
+        # 再生中の一時停止確認間隔（監視中でも変更できる）
+        tk.Label(
+            option_frame,
+            text="一時停止の確認間隔(秒)",
+            font=('Helvetica', 9),
+            bg='#2C3E50', fg='#BDC3C7'
+        ).grid(row=3, column=0, sticky=tk.W, padx=3)
+        tk.Spinbox(
+            option_frame,
+            from_=PAUSE_CHECK_RANGE[0], to=PAUSE_CHECK_RANGE[1], increment=5,
+            textvariable=self.pause_check_interval,
+            width=5,
+            font=('Helvetica', 9)
+        ).grid(row=3, column=1, sticky=tk.W, padx=3)
+        self.pause_check_interval.trace_add("write", self.on_pause_check_changed)
+        
+        # 講座の合間にブラウザを作り直すメモリ使用量（0なら見張らない。監視中でも変更できる）
+        tk.Label(
+            option_frame,
+            text="メモリ上限(MB)",
+            font=('Helvetica', 9),
+            bg='#2C3E50', fg='#BDC3C7'
+        ).grid(row=4, column=0, sticky=tk.W, padx=3)
+        tk.Spinbox(
+            option_frame,
+            from_=MEMORY_LIMIT_RANGE[0], to=MEMORY_LIMIT_RANGE[1], increment=250,
+            textvariable=self.memory_limit,
+            width=5,
+            font=('Helvetica', 9)
+        ).grid(row=4, column=1, sticky=tk.W, padx=3)
+        self.memory_limit.trace_add("write", self.on_memory_limit_changed)
+        
         # ウィンドウ数ラベル
         self.window_label = tk.Label(
             self.root,
@@ -137,6 +3895,26 @@ class MPLearningAutoTool:
         )
         self.window_label.pack(pady=3)
         
+        # Chromeのリソース使用量ラベル
+        self.resource_label = tk.Label(
+            self.root,
+            text="",
+            font=('Helvetica', 9),
+            bg='#2C3E50',
+            fg='#95A5A6'
+        )
+        self.resource_label.pack()
+        
+        # 統計ラベル（WebDriverコマンド数・完了講座数）
+        self.metrics_label = tk.Label(
+            self.root,
+            text="",
+            font=('Helvetica', 9),
+            bg='#2C3E50',
+            fg='#95A5A6'
+        )
+        self.metrics_label.pack()
+        
         # === 予約機能セクション ===
         queue_frame = tk.LabelFrame(
             self.root,
@@ -188,6 +3966,7 @@ class MPLearningAutoTool:
         list_frame = tk.Frame(queue_frame, bg='#2C3E50')
         list_frame.pack(pady=5, padx=5, fill=tk.BOTH, expand=True)
         
+        self.queue_lesson_ids = []  # 予約リスト表示の各行の講座ID（表示した時点のもの）
         self.queue_listbox = tk.Listbox(
             list_frame,
             height=6,
@@ -214,155 +3993,195 @@ class MPLearningAutoTool:
             font=('Arial', 10, 'bold'),
             state=tk.DISABLED
         )
-        self.continuous_button.pack(pady=8)
+        self.continuous_button.pack(pady=8)
+        
+        # === ログ欄（折りたたみ） ===
+        log_header = tk.Frame(self.root, bg='#2C3E50')
+        log_header.pack(fill=tk.X, padx=10)
+        
+        self.log_toggle_button = tk.Button(
+            log_header,
+            text="ログ表示 ▼",
+            command=self.toggle_log_pane,
+            width=10, height=1,
+            bg='#7F8C8D', fg='white',
+            font=('Arial', 8, 'bold')
+        )
+        self.log_toggle_button.pack(side=tk.LEFT)
+        
+        self.verbose_check = tk.Checkbutton(
+            log_header,
+            text="詳細ログ",
+            variable=self.verbose_log,
+            command=lambda: set_verbose(self.verbose_log.get()),
+            font=('Helvetica', 9),
+            bg='#2C3E50', fg='#BDC3C7',
+            selectcolor='#34495E',
+            activebackground='#2C3E50'
+        )
+        self.verbose_check.pack(side=tk.LEFT, padx=5)
+        
+        self.log_frame = tk.Frame(self.root, bg='#2C3E50')  # 「ログ表示」で開く
+        self.log_text = tk.Text(
+            self.log_frame,
+            height=10,
+            font=('Consolas', 8),
+            bg='#34495E',
+            fg='#ECF0F1',
+            wrap=tk.NONE,
+            state=tk.DISABLED
+        )
+        self.log_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        log_scrollbar = tk.Scrollbar(self.log_frame, command=self.log_text.yview)
+        log_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.log_text.config(yscrollcommand=log_scrollbar.set)
         
         # ウィンドウを閉じる際の処理
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
+        # 前回の予約リストを表示（受講中のまま終わった講座があれば知らせる）
+        self.update_queue_display()
+        interrupted = self.engine.lesson_queue.interrupted()
+        if interrupted is not None:
+            logger.info("前回中断した講座があります: L=%s", interrupted)
+            self.detail_label.config(text=f"前回中断した講座 L={interrupted} から再開できます\nブラウザ起動・ログイン後に「連続受講開始」")
+        
         # ウィンドウ数の定期更新
         self.update_window_count()
+        self.update_resource_usage()
+        self.root.after(UI_LAG_CHECK_MS, self.watch_ui_lag)
+        # ウィンドウが表示されて操作できるようになってから、Seleniumを作業スレッドで読み込む
+        self.root.after_idle(self.on_window_ready)
     
-    def start_browser(self):
-        """ブラウザを起動してログインページを開く"""
-        try:
-            self.status_label.config(text="ブラウザ起動中...")
-            self.root.update()
-            
-            options = Options()
-            options.add_argument("--start-maximized")
-            options.add_argument("--disable-popup-blocking")
-            
-            service = Service(ChromeDriverManager().install())
-            self.driver = webdriver.Chrome(service=service, options=options)
-            self.driver.get("https://www.mp-learning.com/Login.aspx")
-            
-            # メインウィンドウを記録
-            self.main_window = self.driver.current_window_handle
-            
-            self.status_label.config(text="ログイン後、講座を開いてください")
-            self.detail_label.config(text="動画再生画面（ポップアップ）を開いてから監視開始")
-            self.browser_button.config(state=tk.DISABLED)
-            self.start_button.config(state=tk.NORMAL)
-            self.add_queue_button.config(state=tk.NORMAL)
-            self.continuous_button.config(state=tk.NORMAL)
-            
-        except Exception as e:
-            messagebox.showerror("エラー", f"ブラウザ起動に失敗:\n{e}")
-            self.status_label.config(text="起動失敗")
+    def on_window_ready(self):
+        """起動時間を記録し、「ブラウザ起動」より先にSeleniumを読み込んでおく"""
+        window = time.perf_counter() - STARTUP_STARTED
+        process = process_uptime()
+        self.engine.metrics.record_startup(window=window, process=process)
+        logger.info(
+            "起動: ウィンドウ表示まで %.0fms（プロセス開始から %s）", window * 1000,
+            f"{process * 1000:.0f}ms" if process is not None else "-"
+        )
+        self.run_in_background(load_selenium, self.on_selenium_loaded)
+    
+    def on_selenium_loaded(self, seconds):
+        if seconds:
+            self.engine.metrics.record_startup(selenium=seconds)
     
-    def find_popup_window(self):
-        """ポップアップウィンドウ（レッスン画面）を特定"""
+    def post(self, event, data):
+        """エンジンからの通知をTkスレッドで表示に反映（スレッドセーフ）"""
+        handler = self.event_handlers.get(event)
+        if handler is None:
+            return
         try:
-            for handle in self.driver.window_handles:
-                if handle != self.main_window:
-                    # メインウィンドウ以外を確認
-                    self.driver.switch_to.window(handle)
-                    title = self.driver.title
-                    url = self.driver.current_url
-                    # タイトルまたはURLで判定
-                    if "レッスン" in title or "Lesson" in title or "LessonStudy" in url or "確認テスト" in title or "アンケート" in title:
-                        return handle
-            return None
+            self.root.after(0, handler, data)
         except:
-            return None
+            pass
     
-    def start_monitoring(self):
-        """監視を開始"""
-        if self.driver is None:
-            messagebox.showwarning("警告", "先にブラウザを起動してください")
-            return
-        
-        # ポップアップウィンドウを探す
-        self.popup_window = self.find_popup_window()
-        
-        if self.popup_window is None:
-            messagebox.showwarning("警告", "レッスン画面（ポップアップ）が見つかりません。\n講座を選んで動画再生画面を開いてください。")
-            return
-        
-        self.monitoring = True
-        self.status_label.config(text="監視中...", fg='#2ECC71')
-        self.detail_label.config(text="ボタン待機中...")
-        self.start_button.config(state=tk.DISABLED)
-        self.stop_button.config(state=tk.NORMAL)
+    def run_in_background(self, fn, on_done=None):
+        """エンジンの時間のかかる操作を作業スレッドで実行（Tkのイベントループは止めない）
         
-        # 監視スレッド開始
-        self.monitor_thread = threading.Thread(target=self.monitor_loop, daemon=True)
-        self.monitor_thread.start()
+        on_done を渡すと、終わったときに on_done(結果) をTkスレッドで呼ぶ（例外なら結果はNone）
+        """
+        future = self.engine.submit(fn)
+        if on_done is not None:
+            def done(f):
+                result = None if f.cancelled() or f.exception() is not None else f.result()
+                try:
+                    self.root.after(0, on_done, result)
+                except:
+                    pass
+            future.add_done_callback(done)
+        return future
     
-    def stop_monitoring(self):
-        """監視を停止"""
-        self.monitoring = False
-        self.status_label.config(text="停止中", fg='#ECF0F1')
-        self.detail_label.config(text="")
-        self.start_button.config(state=tk.NORMAL)
-        self.stop_button.config(state=tk.DISABLED)
+    def watch_ui_lag(self):
+        """Tkのイベントループが止まっていないか測る（UI_LAG_WARN_MS を超えたらログに出す）"""
+        now = time.monotonic()
+        lag_ms = (now - self.ui_tick - UI_LAG_CHECK_MS / 1000) * 1000
+        if lag_ms > UI_LAG_WARN_MS:
+            logger.warning("画面の応答が%.0fms遅れました", lag_ms)
+        self.ui_lag_max_ms = max(self.ui_lag_max_ms, lag_ms)
+        self.ui_tick = now
+        self.root.after(UI_LAG_CHECK_MS, self.watch_ui_lag)
     
-    def update_detail(self, text):
-        """詳細ラベルを更新（スレッドセーフ）"""
+    def add_option_check(self, parent, text, variable, row, column):
+        """起動オプションのチェックボックスを作って配置"""
+        check = tk.Checkbutton(
+            parent,
+            text=text,
+            variable=variable,
+            font=('Helvetica', 9),
+            bg='#2C3E50', fg='#BDC3C7',
+            selectcolor='#34495E',
+            activebackground='#2C3E50'
+        )
+        check.grid(row=row, column=column, sticky=tk.W, padx=3)
+        return check
+    
+    def on_pause_check_changed(self, *args):
+        """一時停止の確認間隔の入力をエンジンに反映"""
         try:
-            self.root.after(0, lambda: self.detail_label.config(text=text))
-        except:
-            pass
+            value = self.pause_check_interval.get()
+        except tk.TclError:
+            return  # 入力途中
+        self.engine.set_pause_check_interval(value)
     
-    def update_queue_display(self):
-        """予約リスト表示を更新"""
-        self.queue_listbox.delete(0, tk.END)
-        for i, lesson_id in enumerate(self.queue_list):
-            self.queue_listbox.insert(tk.END, f"{i+1}. L={lesson_id}")
-        self.queue_count_label.config(text=f"予約: {len(self.queue_list)}件")
+    def on_memory_limit_changed(self, *args):
+        """メモリ上限の入力をエンジンに反映"""
+        try:
+            value = self.memory_limit.get()
+        except tk.TclError:
+            return  # 入力途中
+        self.engine.set_memory_limit(value)
+    
+    def read_options(self):
+        """チェックボックスの状態から起動オプションを作る"""
+        return EngineOptions(
+            use_cdp=self.use_cdp.get(),
+            refresh_driver=self.refresh_driver.get(),
+            use_profile=self.use_profile.get(),
+            attach_browser=self.attach_browser.get(),
+            background_mode=self.background_mode.get(),
+            headless_mode=self.headless_mode.get(),
+        )
+    
+    def start_browser(self):
+        """ブラウザを起動してログインページを開く（起動中も画面は操作できる）"""
+        self.engine.options = self.read_options()
+        self.status_label.config(text="ブラウザ起動中...")
+        self.set_launch_controls(tk.DISABLED)
+        self.run_in_background(self.engine.start_browser, self.on_browser_start_done)
+    
+    def on_browser_start_done(self, started):
+        if started:
+            self.refresh_driver.set(False)
+        else:
+            self.set_launch_controls(tk.NORMAL)
+            if self.status_label.cget("text") == "ブラウザ起動中...":
+                self.status_label.config(text="停止中")
+    
+    def set_launch_controls(self, state):
+        """「ブラウザ起動」ボタンと起動オプションの有効・無効を切り替える"""
+        self.browser_button.config(state=state)
+        for check in self.option_checks:
+            check.config(state=state)
+    
+    def start_monitoring(self):
+        """監視を開始（ポップアップを探す間も画面は止めない）"""
+        self.start_button.config(state=tk.DISABLED)
+        self.run_in_background(self.engine.start_monitoring, self.on_start_monitoring_done)
+    
+    def on_start_monitoring_done(self, started):
+        if not started:
+            self.start_button.config(state=tk.NORMAL)
+    
+    def stop_monitoring(self):
+        """監視を停止"""
+        self.engine.stop_monitoring()
     
     def add_to_queue(self):
         """現在のポップアップウィンドウの講座を予約リストに追加"""
-        if self.driver is None:
-            messagebox.showwarning("警告", "ブラウザが起動していません")
-            return
-        
-        try:
-            # ポップアップウィンドウを探す
-            popup = self.find_popup_window()
-            if popup is None:
-                # 確認テスト画面やレッスン画面も含めて探す
-                for handle in self.driver.window_handles:
-                    if handle != self.main_window:
-                        self.driver.switch_to.window(handle)
-                        url = self.driver.current_url
-                        if "LessonStudyFixed" in url or "Lesson" in url:
-                            popup = handle
-                            break
-            
-            if popup is None:
-                messagebox.showwarning("警告", "講座画面が見つかりません。\n講座を開いてから予約してください。")
-                return
-            
-            self.driver.switch_to.window(popup)
-            url = self.driver.current_url
-            
-            # URLから講座IDを抽出
-            if "L=" in url:
-                lesson_id = url.split("L=")[-1].split("&")[0]
-            else:
-                messagebox.showwarning("警告", "講座IDを取得できませんでした")
-                return
-            
-            # 既に予約済みかチェック
-            if lesson_id in self.queue_list:
-                messagebox.showinfo("情報", "この講座は既に予約済みです")
-                return
-            
-            # 予約リストに講座IDを追加
-            self.queue_list.append(lesson_id)
-            self.update_queue_display()
-            
-            # ポップアップを閉じる
-            self.driver.close()
-            self.driver.switch_to.window(self.main_window)
-            
-            print(f"講座を予約: L={lesson_id}")
-            self.detail_label.config(text=f"予約追加: {len(self.queue_list)}件目")
-            
-        except Exception as e:
-            print(f"予約追加エラー: {e}")
-            messagebox.showerror("エラー", f"予約追加に失敗:\n{e}")
+        self.run_in_background(self.engine.add_to_queue)
     
     def remove_from_queue(self):
         """選択した講座を予約リストから削除"""
@@ -371,404 +4190,181 @@ class MPLearningAutoTool:
             messagebox.showwarning("警告", "削除する講座を選択してください")
             return
         
+        # 作業スレッドが予約リストを変えているかもしれないので、表示した時点の講座IDで削除する
         index = selection[0]
-        removed = self.queue_list.pop(index)
-        self.update_queue_display()
-        print(f"予約削除: {removed}")
+        if index >= len(self.queue_lesson_ids):
+            return
+        self.engine.remove_from_queue(self.queue_lesson_ids[index])
     
     def start_continuous(self):
-        """連続受講を開始"""
-        if self.driver is None:
-            messagebox.showwarning("警告", "ブラウザを起動してください")
-            return
-        
-        if len(self.queue_list) == 0:
-            messagebox.showwarning("警告", "予約リストが空です。\n講座を予約してから開始してください。")
-            return
-        
-        # 連続受講モードを有効化
-        self.continuous_mode = True
-        
-        # 最初の講座を開く
-        self.open_next_queue()
+        """連続受講を開始（講座を開く処理は作業スレッドで進む）"""
+        self.run_in_background(self.engine.start_continuous)
     
-    def open_next_queue(self):
-        """予約リストの次の講座を開く"""
-        try:
-            self._open_next_queue_impl()
-        finally:
-            self.opening_next = False  # 処理完了後にフラグを解除
+    def on_notice(self, data):
+        """エンジンからのメッセージをダイアログで表示"""
+        title, show = {
+            "warning": ("警告", messagebox.showwarning),
+            "info": ("情報", messagebox.showinfo),
+            "error": ("エラー", messagebox.showerror),
+        }[data["level"]]
+        show(title, data["message"])
     
-    def _open_next_queue_impl(self):
-        """open_next_queueの実装（finallyでフラグ解除するためのラッパー）"""
-        if len(self.queue_list) == 0:
-            self.continuous_mode = False
+    def on_browser_started(self, data):
+        """ブラウザ起動後: 起動オプションを固定し、監視・予約のボタンを有効にする"""
+        self.status_label.config(text="ログイン後、講座を開いてください")
+        self.detail_label.config(
+            text=f"動画再生画面（ポップアップ）を開いてから監視開始\n起動 {data['seconds']:.1f}秒（ドライバ: {data['driver_source']}）"
+        )
+        self.set_launch_controls(tk.DISABLED)
+        self.start_button.config(state=tk.NORMAL)
+        self.add_queue_button.config(state=tk.NORMAL)
+        self.continuous_button.config(state=tk.NORMAL)
+    
+    def on_browser_failed(self, data):
+        hint = f"\n\n{data['hint']}" if data["hint"] else ""
+        messagebox.showerror("エラー", f"ブラウザ起動に失敗:\n{data['error']}{hint}")
+        self.status_label.config(text="起動失敗")
+    
+    def on_monitoring(self, data):
+        """監視の開始・停止に合わせて表示とボタンを切り替える"""
+        if data["active"]:
+            self.status_label.config(text="監視中...", fg='#2ECC71')
+            self.detail_label.config(text="ボタン待機中...")
+            self.start_button.config(state=tk.DISABLED)
+            self.stop_button.config(state=tk.NORMAL)
+        else:
+            self.status_label.config(text="停止中", fg='#ECF0F1')
+            self.detail_label.config(text="")
+            self.start_button.config(state=tk.NORMAL)
+            self.stop_button.config(state=tk.DISABLED)
+    
+    def on_watchdog(self, data):
+        """見張りが監視の停止を検出・復旧した"""
+        if data["stage"] == "stalled":
+            self.detail_label.config(text=f"監視が{data['seconds']}秒止まっていたので復旧中...")
+        elif data["stage"] == "recovered":
+            how = "ブラウザを起動し直して" if data["action"] == "restart" else ""
+            self.detail_label.config(text=f"監視を{how}復旧しました（{data['seconds']:.1f}秒）")
+        else:
+            messagebox.showerror("エラー", f"監視を復旧できませんでした:\n{data['error']}")
+    
+    def on_lesson_added(self, data):
+        self.update_queue_display()
+        self.detail_label.config(text=f"予約追加: {data['count']}件目")
+    
+    def on_lesson_started(self, data):
+        self.update_queue_display()
+        self.detail_label.config(text=f"残り{data['remaining']}件...")
+    
+    def on_memory(self, data):
+        """メモリ上限を超えてウィンドウ・ブラウザを作り直すとき"""
+        target = "メインウィンドウ" if data["action"] == "window" else "ブラウザ"
+        self.detail_label.config(text=f"メモリ {data['mb']}MB > {data['limit']}MB: {target}を作り直しています...")
+    
+    def on_queue_empty(self, data):
+        """予約リストの講座がなくなった"""
+        self.update_queue_display()
+        if data["reason"] == "all_done":
             self.status_label.config(text="全講座完了！", fg='#F39C12')
             self.detail_label.config(text="予約リストの講座を全て受講しました")
             messagebox.showinfo("完了", "予約した講座を全て受講しました！")
-            return
-        
-        # リストの先頭から講座IDを取り出す
-        next_lesson_id = self.queue_list.pop(0)
-        self.update_queue_display()
-        
-        print(f"次の講座を開く: L={next_lesson_id}")
-        self.detail_label.config(text=f"残り{len(self.queue_list)}件...")
-        
-        try:
-            # メインウィンドウに切り替える
-            self.driver.switch_to.window(self.main_window)
-            time.sleep(0.5)
-            
-            # マイページに移動
-            print("マイページに移動中...")
-            self.driver.get("https://www.mp-learning.com/Members/MyPage.aspx")
-            time.sleep(3)
-            
-            # 講座リンク要素を探してクリック
-            link_id = f"linkNewLessonPC-{next_lesson_id}"
-            print(f"講座リンクを探しています: {link_id}")
-            
-            link_clicked = False
-            
-            # 方法1: 直接IDで要素を探してクリック
-            try:
-                link = self.driver.find_element(By.ID, link_id)
-                print(f"リンク発見: {link_id}")
-                self.driver.execute_script("arguments[0].scrollIntoView(true);", link)
-                time.sleep(0.5)
-                link.click()
-                print("講座リンクをクリックしました")
-                link_clicked = True
-            except Exception as e:
-                print(f"ID検索失敗: {e}")
-            
-            # 方法2: XPathで探す
-            if not link_clicked:
-                try:
-                    link = self.driver.find_element(By.XPATH, f"//a[contains(@id, '{next_lesson_id}')]")
-                    self.driver.execute_script("arguments[0].scrollIntoView(true);", link)
-                    time.sleep(0.5)
-                    link.click()
-                    print("XPathで講座リンクをクリックしました")
-                    link_clicked = True
-                except Exception as e2:
-                    print(f"XPath検索も失敗: {e2}")
-            
-            # 方法3: lnkNewLesson_OnClick をJS直接呼び出し（新着以外の講座用）
-            if not link_clicked:
-                print("方法3: lnkNewLesson_OnClick を直接呼び出します")
-                for lesson_type in [2, 3]:
-                    try:
-                        result = self.driver.execute_script(f"""
-                            lnkNewLesson_OnClick("{next_lesson_id}", {lesson_type}, 1, "linkNewLessonPC-{next_lesson_id}", 0);
-                            return 'called_type_{lesson_type}';
-                        """)
-                        print(f"lnkNewLesson_OnClick (type={lesson_type}): {result}")
-                        link_clicked = True
-                        break
-                    except Exception as e3:
-                        print(f"type={lesson_type} 失敗: {e3}")
-            
-            if not link_clicked:
-                print(f"全ての方法で講座 {next_lesson_id} のオープンに失敗しました")
-            
-            # ポップアップウィンドウを探して監視開始
-            time.sleep(4)
-            self.popup_window = self.find_popup_window()
-            print(f"ポップアップ検出: {self.popup_window}")
-            
-            if self.popup_window:
-                self.driver.switch_to.window(self.popup_window)
-                if not self.monitoring:
-                    self.start_monitoring()
-                # 監視開始後も明示的に再生ボタンをクリック
-                time.sleep(3)
-                print("連続受講: 再生開始を試みます")
-                self.click_play_button()
-            else:
-                print("ポップアップが見つかりませんでした")
-        except Exception as e:
-            print(f"講座オープンエラー: {e}")
-
-    
-    def click_play_button(self):
-        """再生ボタンをクリック（EQプレイヤーのJavaScript APIを使用）"""
-        try:
-            print("=== 再生開始処理 ===")
-            
-            # 方法1: まずプレイヤー領域をクリック（オートプレイポリシー回避）
-            try:
-                player_area = self.driver.find_element(By.ID, "eqPlayer")
-                
-                # ActionChainsで確実にクリック
-                actions = ActionChains(self.driver)
-                actions.move_to_element(player_area).click().perform()
-                print("Step1: プレイヤー領域をクリック")
-                time.sleep(0.5)
-                
-                # さらに普通のクリックも試す
-                player_area.click()
-                print("Step2: 追加クリック")
-                time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"プレイヤークリック失敗: {e}")
-            
-            # 方法2: JavaScript APIで再生
-            for attempt in range(3):
-                try:
-                    result = self.driver.execute_script("""
-                        if (typeof player !== 'undefined' && player && player.accessor) {
-                            try {
-                                player.accessor.play();
-                                return 'play() called';
-                            } catch(e) {
-                                return 'play() error: ' + e.toString();
-                            }
-                        }
-                        return 'player not ready';
-                    """)
-                    print(f"Step3: 再生API試行{attempt+1}: {result}")
-                    if 'called' in result:
-                        break
-                except Exception as e:
-                    print(f"再生API例外{attempt+1}: {e}")
-                time.sleep(0.5)
-            
-            # 方法3: video要素を直接操作
-            try:
-                self.driver.execute_script("""
-                    // iframe内のvideo要素を探して再生
-                    var iframe = document.querySelector('#eqPlayer iframe');
-                    if (iframe && iframe.contentDocument) {
-                        var video = iframe.contentDocument.querySelector('video');
-                        if (video) {
-                            video.muted = true;  // ミュートにして再生（オートプレイポリシー回避）
-                            video.play();
-                        }
-                    }
-                """)
-                print("Step4: iframe内video.play()試行")
-            except Exception as e:
-                print(f"iframe操作失敗（クロスオリジンの可能性）: {e}")
-            
-            return True
-        except Exception as e:
-            print(f"再生ボタンエラー: {e}")
-            return False
+        elif data["reason"] == "lesson_done":
+            self.status_label.config(text="受講完了！", fg='#F39C12')
+            self.detail_label.config(text="次の講座を開くと監視を続けます")
     
-    def monitor_loop(self):
-        """監視ループ（ポップアップウィンドウのみ監視）"""
-        while self.monitoring:
-            try:
-                # ポップアップウィンドウがまだ存在するか確認
-                if self.popup_window not in self.driver.window_handles:
-                    # 連続受講モードなら次の講座を開く（二重発火防止）
-                    if self.continuous_mode and len(self.queue_list) > 0:
-                        if self.opening_next:
-                            # open_next_queueが実行中なので待機
-                            print("次の講座を開く処理中... 待機します")
-                            time.sleep(3)
-                            continue
-                        print("ポップアップ閉じ検出 - 次の講座を開く")
-                        self.opening_next = True
-                        self.root.after(1000, self.open_next_queue)
-                        time.sleep(5)
-                        continue
-                    elif self.continuous_mode and len(self.queue_list) == 0:
-                        # 全講座完了
-                        self.continuous_mode = False
-                        self.root.after(0, lambda: self.status_label.config(text="全講座完了！", fg='#F39C12'))
-                        self.root.after(0, lambda: self.detail_label.config(text="予約した講座を全て受講しました"))
-                        print("全講座完了！")
-                        time.sleep(2)
-                        continue
-                    
-                    # ポップアップが閉じられた → 新しいポップアップを探す
-                    self.popup_window = self.find_popup_window()
-                    if self.popup_window is None:
-                        self.update_detail("ポップアップを探しています...")
-                        time.sleep(2)
-                        continue
-                
-                # ポップアップウィンドウに切り替え（1回だけ）
-                current = self.driver.current_window_handle
-                if current != self.popup_window:
-                    self.driver.switch_to.window(self.popup_window)
-                
-                # 「次の学習へ」「テストへ」ボタンを探す
-                try:
-                    btn = self.driver.find_element(By.ID, "btn-next-study")
-                    if btn.is_displayed():
-                        link = self.driver.find_element(By.ID, "btn-next-study-link")
-                        link_text = link.text
-                        self.update_detail(f"検出: {link_text}")
-                        print(f"ボタン検出: {link_text}")
-                        
-                        # クリック
-                        btn.click()
-                        print(f"クリック完了: {link_text}")
-                        self.update_detail(f"クリック: {link_text}")
-                        
-                        # ページ遷移を待機
-                        time.sleep(3)
-                        
-                        # 新しいポップアップを探す（ページ遷移後）
-                        self.popup_window = self.find_popup_window()
-                        if self.popup_window:
-                            self.driver.switch_to.window(self.popup_window)
-                            
-                            # 再生ボタンをクリック
-                            time.sleep(2)  # ページ読み込み待機
-                            self.click_play_button()
-                            self.update_detail("再生開始...")
-                        
-                        continue
-                except:
-                    pass  # 要素が見つからない場合は無視
-                
-                # テスト回答画面の処理（タイトルで判定）
-                try:
-                    page_title = self.driver.title
-                    print(f"現在のページタイトル: {page_title}")
-                    
-                    if "確認テスト" in page_title:
-                        # 答案提出ボタンを探す
-                        submit_btn = self.driver.find_element(By.ID, "ctl00_examBody_lnkExamAnswerSubmit")
-                        print(f"答案提出ボタン発見: displayed={submit_btn.is_displayed()}")
-                        if submit_btn.is_displayed():
-                            self.update_detail("テスト回答中...")
-                            print("テスト回答画面検出 - 自動回答開始")
-                            
-                            # JavaScriptでラジオボタン選択 + 答案提出を一括実行
-                            # checked=trueでポストバックを防ぎ、即座にsubmitクリック
-                            result = self.driver.execute_script("""
-                                // 全てのラジオボタングループを取得
-                                var radioGroups = {};
-                                var radios = document.querySelectorAll('input[type="radio"]');
-                                radios.forEach(function(radio) {
-                                    var name = radio.name;
-                                    if (!radioGroups[name]) {
-                                        radioGroups[name] = [];
-                                    }
-                                    radioGroups[name].push(radio);
-                                });
-                                
-                                // 各グループの最初のラジオボタンを選択（checked=trueでポストバック回避）
-                                var count = 0;
-                                for (var name in radioGroups) {
-                                    if (radioGroups[name].length > 0) {
-                                        radioGroups[name][0].checked = true;
-                                        count++;
-                                    }
-                                }
-                                
-                                // 答案提出ボタンをクリック
-                                var submitBtn = document.getElementById('ctl00_examBody_lnkExamAnswerSubmit');
-                                if (submitBtn) {
-                                    submitBtn.click();
-                                    return count + '問回答 + 答案提出';
-                                }
-                                return count + '問回答（提出ボタン見つからず）';
-                            """)
-                            print(f"テスト処理結果: {result}")
-                            self.update_detail("答案提出完了")
-                            time.sleep(3)
-                            continue
-                except Exception as e:
-                    print(f"テスト回答エラー: {e}")
-                
-                # テスト解説画面の処理（次へボタンがある場合）
-                try:
-                    next_btn = self.driver.find_element(By.ID, "ctl00_examBody_cmdNext")
-                    if next_btn.is_displayed():
-                        self.update_detail("解説画面 - 次へ")
-                        print("解説画面検出 - 次へクリック")
-                        next_btn.click()
-                        time.sleep(3)
-                        continue
-                except:
-                    pass
-                
-                # アンケート画面の処理（終了ボタンをクリック）
-                try:
-                    # タイトルでアンケート画面を判定
-                    if "アンケート" in self.driver.title:
-                        end_label = self.driver.find_element(By.ID, "panel-end-label")
-                        if end_label.is_displayed():
-                            self.update_detail("アンケート画面 - 終了")
-                            print("アンケート画面検出 - 終了クリック")
-                            end_label.click()
-                            time.sleep(2)
-                            continue
-                except:
-                    pass
-                
-                # 動画が停止していたら再生する（強制再生機能）
-                # ただし「次の学習へ」ボタンが表示中は除外（動画終了状態なので）
-                try:
-                    btn_next = self.driver.find_element(By.ID, "btn-next-study")
-                    btn_visible = btn_next.is_displayed()
-                except:
-                    btn_visible = False
-                
-                if not btn_visible:
-                    try:
-                        is_playing = self.driver.execute_script("""
-                            if (typeof player !== 'undefined' && player && player.accessor) {
-                                // プレイヤーが一時停止状態かチェック
-                                var isPaused = player.accessor.isPaused();
-                                if (isPaused === true) {
-                                    player.accessor.play();
-                                    return 'resumed';
-                                }
-                                return 'playing';
-                            }
-                            return 'no_player';
-                        """)
-                        if is_playing == 'resumed':
-                            print("動画を再開しました")
-                            self.update_detail("動画再開...")
-                        elif is_playing == 'playing':
-                            self.update_detail("再生中...")
-                        else:
-                            self.update_detail("ボタン待機中...")
-                    except:
-                        self.update_detail("ボタン待機中...")
-                else:
-                    self.update_detail("動画終了 - ボタン待機中...")
-                
-            except Exception as e:
-                print(f"監視エラー: {e}")
-                self.update_detail(f"エラー: {str(e)[:30]}")
-            
-            # 1秒待機
-            time.sleep(1)
+    def update_queue_display(self):
+        """予約リスト表示を更新"""
+        items = self.engine.lesson_queue.items()
+        self.queue_lesson_ids = [lesson_id for lesson_id, status, attempts in items]
+        self.queue_listbox.delete(0, tk.END)
+        for i, (lesson_id, status, attempts) in enumerate(items):
+            self.queue_listbox.insert(tk.END, f"{i+1}. L={lesson_id}{QUEUE_STATUS_LABELS[status]}")
+        self.queue_count_label.config(text=f"予約: {len(items)}件")
     
     def update_window_count(self):
-        """ウィンドウ数を更新"""
+        """ウィンドウ数を更新（ハンドル一覧は仲介スレッドで取得し、結果だけをTkスレッドで反映）"""
+        engine = self.engine
+        if engine.driver:
+            future = engine.broker.submit(
+                "window_handles", lambda d: d.window_handles,
+                PRIORITY_BACKGROUND, deadline=1, key="window_handles"
+            )
+            future.add_done_callback(lambda f: self.root.after(0, self.show_window_count, f))
+        else:
+            self.window_label.config(text="ウィンドウ数: -")
+        
+        self.root.after(1000, self.update_window_count)
+    
+    def show_window_count(self, future):
+        """取得したウィンドウ数とWebDriverのコマンド数を表示"""
+        engine = self.engine
         try:
-            if self.driver:
-                count = len(self.driver.window_handles)
-                self.window_label.config(text=f"ウィンドウ数: {count}")
-            else:
-                self.window_label.config(text="ウィンドウ数: -")
+            engine.windows.update(future.result())
+            count = engine.windows.count()
+            self.window_label.config(text=f"ウィンドウ数: {count}  通信: {engine.broker.rate_per_minute()}回/分")
+        except CommandDeadlineExceeded:
+            pass  # 他のコマンドが詰まっている間は表示を据え置く
         except:
             self.window_label.config(text="ウィンドウ数: ?")
+    
+    def update_resource_usage(self):
+        """ChromeのCPU使用率とメモリ使用量を表示（プロセスの集計は別スレッドで行い、結果だけをTkスレッドで反映）"""
+        engine = self.engine
+        if engine.resources:
+            future = self.sampler.submit(engine.resources.sample)
+            future.add_done_callback(lambda f: self.root.after(0, self.show_resource_usage, f))
+        if engine.driver:
+            self.metrics_label.config(text=f"{engine.metrics.summary()}  画面遅延最大: {self.ui_lag_max_ms:.0f}ms")
         
-        self.root.after(1000, self.update_window_count)
+        self.root.after(RESOURCE_UPDATE_INTERVAL_MS, self.update_resource_usage)
+    
+    def show_resource_usage(self, future):
+        try:
+            usage = future.result()
+        except Exception:
+            usage = None
+        if usage is not None:
+            cpu, rss_mb = usage
+            self.resource_label.config(text=f"Chrome CPU: {cpu:.0f}%  メモリ: {rss_mb:.0f}MB")
+        elif psutil is None:
+            self.resource_label.config(text="CPU・メモリ表示には psutil が必要です")
+    
+    def toggle_log_pane(self):
+        """ログ欄の表示・非表示を切り替える"""
+        self.log_visible = not self.log_visible
+        if not self.log_visible:
+            self.log_frame.pack_forget()
+            self.log_toggle_button.config(text="ログ表示 ▼")
+            self.root.geometry(WINDOW_SIZE)
+        else:
+            self.log_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+            self.log_toggle_button.config(text="ログ表示 ▲")
+            self.root.geometry(WINDOW_SIZE_WITH_LOG)
+            self.log_version = -1
+            self.refresh_log_pane()
+    
+    def refresh_log_pane(self):
+        """ログ欄が開いている間、新しいログがあれば表示を更新"""
+        if not self.log_visible:
+            return
+        if self.log_ring.version != self.log_version:
+            self.log_version = self.log_ring.version
+            self.log_text.config(state=tk.NORMAL)
+            self.log_text.delete("1.0", tk.END)
+            self.log_text.insert(tk.END, "\n".join(self.log_ring.lines))
+            self.log_text.see(tk.END)
+            self.log_text.config(state=tk.DISABLED)
+        self.root.after(LOG_PANE_REFRESH_MS, self.refresh_log_pane)
     
     def on_closing(self):
         """終了処理"""
-        self.monitoring = False
-        
-        if self.driver:
-            if messagebox.askyesno("確認", "ブラウザも終了しますか？"):
-                try:
-                    self.driver.quit()
-                except:
-                    pass
+        close_browser = True
+        if self.engine.driver and not self.engine.attached:
+            close_browser = messagebox.askyesno("確認", "ブラウザも終了しますか？")
+        self.root.withdraw()  # ブラウザの終了を待つ間、ウィンドウは先に消す
+        self.sampler.shutdown(wait=False, cancel_futures=True)
+        self.engine.shutdown(close_browser)
+        self.log_listener.stop()
         
         self.root.destroy()
     
@@ -777,6 +4373,189 @@ class MPLearningAutoTool:
         self.root.mainloop()
 
 
-if __name__ == "__main__":
+class JsonLinesView:
+    """コマンドライン用の view: 進捗を1行1件のJSONで書き出す"""
+    
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream  # Noneなら書き出さない
+        self.write_lock = threading.Lock()
+        self.finished = threading.Event()  # 予約リストの講座がなくなった
+        self.failed = []  # 開けずに予約リストから外した講座ID
+    
+    def post(self, event, data):
+        if event == "lesson_failed" and data["gave_up"]:
+            self.failed.append(data["lesson_id"])
+        if self.stream is not None:
+            line = json.dumps(dict(time=round(time.time(), 3), event=event, **data), ensure_ascii=False, default=str)
+            with self.write_lock:
+                self.stream.write(line + "\n")
+                self.stream.flush()
+        if event == "queue_empty":
+            self.finished.set()
+    
+    def run(self, timeout=None, tick=None, tick_interval=1.0):
+        """予約リストの講座がなくなるまで待つ（timeout秒で打ち切ったらFalse）
+        
+        受講はエンジンの作業スレッド・監視スレッドで進む。tick を渡すと tick_interval 秒ごとに呼ぶ（計測など）
+        """
+        end = time.monotonic() + timeout if timeout else None
+        while True:
+            wait = tick_interval if end is None else min(tick_interval, end - time.monotonic())
+            if self.finished.wait(max(0, wait)):
+                return True
+            if end is not None and time.monotonic() >= end:
+                return False
+            if tick is not None:
+                tick()
+
+
+def read_lesson_ids(values, path=None):
+    """引数とファイル（"-" なら標準入力）から講座IDを読む
+    
+    空白・カンマ区切りで、講座IDのほかにレッスン画面のURL（L=の値）も書ける。# 以降はコメント
+    """
+    lines = list(values)
+    if path:
+        if path == "-":
+            lines += sys.stdin.read().splitlines()
+        else:
+            with open(path, encoding="utf-8-sig") as f:
+                lines += f.read().splitlines()
+    lesson_ids = []
+    for line in lines:
+        for token in re.split(r"[\s,]+", line.split("#")[0]):
+            if not token:
+                continue
+            lesson_id = token if token.isdigit() else lesson_id_from_url(token)
+            if lesson_id is None:
+                raise ValueError(f"講座IDではありません: {token}")
+            if lesson_id not in lesson_ids:
+                lesson_ids.append(lesson_id)
+    return lesson_ids
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="MPラーニング自動受講ツール（講座IDを指定するとウィンドウなしで連続受講する）"
+    )
+    parser.add_argument("lessons", nargs="*", help="受講する講座ID（レッスン画面のURLでもよい）")
+    parser.add_argument("-f", "--file", help="講座IDを書いたファイル（1行に1件、\"-\" なら標準入力）")
+    parser.add_argument("--resume", action="store_true", help="保存済みの予約リストの残りを受講する")
+    parser.add_argument("--queue", help="予約リストのパス（既定: アプリのデータフォルダ、:memory: なら保存しない）")
+    parser.add_argument("--profile", action="store_true", help="プロファイル保持（ログイン状態を残す）")
+    parser.add_argument("--attach", action="store_true", help="起動中のChromeに接続")
+    parser.add_argument("--background", action="store_true", help="バックグラウンド起動")
+    parser.add_argument("--headless", action="store_true", help="ヘッドレス（バックグラウンド起動・プロファイル保持も有効になる）")
+    parser.add_argument("--cdp", action="store_true", help="CDPイベント監視")
+    parser.add_argument("--refresh-driver", action="store_true", help="chromedriverをダウンロードし直す")
+    parser.add_argument("--pause-check", type=int, default=PAUSE_CHECK_INTERVAL, help="一時停止の確認間隔（秒）")
+    parser.add_argument("--memory-limit", type=int, default=MEMORY_LIMIT_MB,
+                        help="講座の合間にブラウザを作り直すChromeのメモリ使用量（MB、0なら見張らない）")
+    parser.add_argument("--login-timeout", type=float, default=CLI_LOGIN_TIMEOUT, help="ブラウザでのログインを待つ秒数")
+    parser.add_argument("--timeout", type=float, default=None, help="打ち切りまでの秒数（既定: なし）")
+    parser.add_argument("--keep-browser", action="store_true", help="終了時にブラウザを閉じない")
+    parser.add_argument("--verbose", action="store_true", help="詳細ログ（DEBUG）を標準エラーに出す")
+    parser.add_argument("--no-record", action="store_true", help="監視ループの判断を記録しない（フライトレコーダー）")
+    parser.add_argument("--replay", nargs="?", const="", metavar="PATH",
+                        help="記録した監視ループの判断をブラウザなしで再生して確かめる（既定: アプリのデータフォルダの記録）")
+    parser.add_argument("--repeat", type=int, default=1, help="--replay で判断の速さを測るときの繰り返し回数")
+    return parser
+
+
+def run_cli(args):
+    """ウィンドウを作らずに予約リストを連続受講し、終了コードを返す
+    
+    進捗は1行1件のJSONで標準出力に、ログは標準エラーに出す
+    """
+    view = JsonLinesView()
+    try:
+        lesson_ids = read_lesson_ids(args.lessons, args.file)
+    except (OSError, ValueError) as e:
+        view.post("error", {"message": str(e)})
+        return EXIT_STARTUP_FAILED
+    
+    log_listener, _ = setup_logging(args.verbose, console=sys.stderr)
+    recorder = None if args.no_record else open_flight_recorder()
+    engine = LearningEngine(view, EngineOptions(
+        use_cdp=args.cdp,
+        refresh_driver=args.refresh_driver,
+        use_profile=args.profile or args.headless,
+        attach_browser=args.attach,
+        background_mode=args.background or args.headless,
+        headless_mode=args.headless,
+    ), open_lesson_queue(args.queue), recorder)
+    engine.set_pause_check_interval(args.pause_check)
+    engine.set_memory_limit(args.memory_limit)
+    try:
+        if args.resume:
+            # 保存済みの予約リストの残り（未受講・受講中）も受講する
+            requested = [item[0] for item in engine.lesson_queue.items()]
+            requested += [lesson_id for lesson_id in lesson_ids if lesson_id not in requested]
+        else:
+            # 指定した講座だけを受講する（ウィンドウ版で予約した講座には触らない）
+            requested = lesson_ids
+            engine.lesson_queue.restrict(requested)
+        engine.add_lessons(lesson_ids)
+        if len(engine.lesson_queue) == 0:
+            view.post("error", {"message": "受講する講座がありません"})
+            return EXIT_STARTUP_FAILED
+        if not engine.start_browser(resume=False):
+            return EXIT_STARTUP_FAILED
+        if not engine.wait_for_login(args.login_timeout):
+            view.post("error", {"message": "ログインできませんでした"})
+            return EXIT_STARTUP_FAILED
+        engine.submit(engine.start_continuous)
+        if not view.run(args.timeout):
+            view.post("error", {"message": "タイムアウトしました"})
+            return EXIT_TIMEOUT
+        # 終了コードは受講を頼まれた講座だけで決める
+        unfinished = [lesson_id for lesson_id in requested if engine.lesson_queue.status(lesson_id) != QUEUE_DONE]
+        if unfinished:
+            view.post("unfinished", {"lesson_ids": unfinished})
+            return EXIT_LESSONS_FAILED
+        return EXIT_OK
+    except KeyboardInterrupt:
+        view.post("error", {"message": "中断しました"})
+        return EXIT_INTERRUPTED
+    finally:
+        engine.shutdown(close_browser=not args.keep_browser)
+        log_listener.stop()
+
+
+def run_replay(args):
+    """フライトレコーダーの記録を decide に通し、食い違いと止まっていた区間を1行1件のJSONで出す"""
+    path = args.replay or get_app_dir("flight", "monitor.rec")
+    if not os.path.exists(path) and not os.path.exists(path + ".1"):
+        print(json.dumps({"event": "error", "message": f"記録がありません: {path}"}, ensure_ascii=False))
+        return EXIT_STARTUP_FAILED
+    result = replay_trace(FlightRecorder.read(path), repeat=max(1, args.repeat))
+    for mismatch in result.pop("mismatches"):
+        print(json.dumps(dict(event="mismatch", **mismatch), ensure_ascii=False))
+        result["mismatch_count"] = result.get("mismatch_count", 0) + 1
+    for stall in result.pop("stalls"):
+        print(json.dumps(dict(event="stall", **stall), ensure_ascii=False))
+    print(json.dumps(dict(event="replay_summary", path=path, **result), ensure_ascii=False))
+    return EXIT_REPLAY_MISMATCH if result.get("mismatch_count") else EXIT_OK
+
+
+def run_gui():
+    """ウィンドウ版を起動（tkinterはここで初めて読み込む）"""
+    global tk, messagebox
+    import tkinter as tk
+    from tkinter import messagebox
     app = MPLearningAutoTool()
     app.run()
+    return EXIT_OK
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.replay is not None:
+        return run_replay(args)
+    if args.lessons or args.file or args.resume:
+        return run_cli(args)
+    return run_gui()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# -*- mode: python ; coding: utf-8 -*-
+# MPラーニング 自動受講ツールのexe（onedir）
+#
+#   pyinstaller mp_learning_selenium.spec
+#
+# dist\MPLearningAutoTool\ に次の2つのexeと共通のライブラリ（_internal）ができる
+#   MPLearningAutoTool.exe     ウィンドウ版（コンソールなし）
+#   MPLearningAutoToolCLI.exe  コマンドライン版（講座IDを指定してウィンドウなしで連続受講）
+#
+# onefile は起動のたびに一時フォルダへ全部を展開するので使わない（onedir は展開なしで起動する）。
+# UPXで圧縮すると起動のたびに解凍が入るので無効にする。
+
+a = Analysis(
+    ['mp_learning_selenium.py'],
+    pathex=[],
+    binaries=[],
+    datas=[('icon.ico', '.')],
+    # Selenium・webdriver_manager・tkinter は関数の中で読み込むので明示する
+    hiddenimports=[
+        'selenium.webdriver',
+        'selenium.webdriver.chrome.service',
+        'selenium.webdriver.chrome.options',
+        'selenium.webdriver.common.by',
+        'selenium.webdriver.support.expected_conditions',
+        'webdriver_manager.chrome',
+        'tkinter',
+        'tkinter.messagebox',
+    ],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    # 検証用サーバー・ベンチマークは同梱しない
+    excludes=['mp_fixture_server', 'mp_benchmark'],
+    noarchive=False,
+)
+pyz = PYZ(a.pure)
+
+gui = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='MPLearningAutoTool',
+    icon='icon.ico',
+    console=False,
+    upx=False,
+    debug=False,
+    strip=False,
+)
+
+cli = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='MPLearningAutoToolCLI',
+    icon='icon.ico',
+    console=True,
+    upx=False,
+    debug=False,
+    strip=False,
+)
+
+coll = COLLECT(
+    gui,
+    cli,
+    a.binaries,
+    a.datas,
+    upx=False,
+    name='MPLearningAutoTool',
+)
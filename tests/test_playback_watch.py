@@ -0,0 +1,105 @@
+"""PlaybackWatch（再生位置の進み方による停滞の判定）のテスト"""
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mp_learning_selenium as mp
+
+
+def snapshot(position, duration=600.0, paused=False, ended=False, url="https://example.com/lesson"):
+    return {"url": url, "player": {"time": position, "duration": duration, "paused": paused, "ended": ended}}
+
+
+def play(watch, start, seconds, interval=1.0, rate=1.0, quantize=False, position=0.0):
+    """start から seconds 秒、interval 秒ごとにスナップショットを取り込む（rate は経過時間あたりの進み）"""
+    result = None
+    for i in range(1, int(seconds / interval) + 1):
+        now = start + i * interval
+        media = position + i * interval * rate
+        result = watch.update(now, snapshot(math.floor(media) if quantize else media))
+    return result
+
+
+def test_normal_playback_is_playing_without_loss():
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    result = play(watch, 0.0, 60)
+    assert result["status"] == "playing"
+    assert watch.lost == 0
+
+
+def test_command_latency_does_not_count_as_loss():
+    # 経過時間 1.002 秒ごとに 1 秒進む（コマンドの遅れ）
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    result = play(watch, 0.0, 600, rate=1 / 1.002)
+    assert result["status"] == "playing"
+    assert watch.lost == 0
+
+
+def test_whole_second_positions_do_not_count_as_loss():
+    # 秒単位でしか位置を返さないプレイヤーを 0.5 秒ごとに見る
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    result = play(watch, 0.0, 590, interval=0.5, quantize=True)
+    assert result["status"] == "playing"
+    assert watch.lost == 0
+
+
+def test_stall_is_detected_and_counted():
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    play(watch, 0.0, 10)
+    for now in range(11, 11 + mp.STALL_RECOVER_SECONDS):
+        result = watch.update(float(now), snapshot(10.0))
+    assert result["status"] == "stalled"
+    assert result["stalled_for"] >= mp.STALL_RECOVER_SECONDS
+    assert result["lost"] == result["stalled_for"]
+
+
+def test_stall_loss_is_counted_once():
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    play(watch, 0.0, 10)
+    deltas = [watch.update(float(now), snapshot(10.0))["lost_delta"] for now in range(11, 16)]
+    assert sum(deltas) == watch.lost == 5
+    # 再生が進み始めたら停滞は終わり、その後は数えない
+    result = play(watch, 15.0, 30, position=10.0)
+    assert result["status"] == "playing"
+    assert watch.lost == 5
+
+
+def test_recoveries_reset_after_playback_resumes_with_latency():
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    play(watch, 0.0, 10)
+    for now in range(11, 11 + mp.STALL_RECOVER_SECONDS):
+        watch.update(float(now), snapshot(10.0))
+    watch.recovering(18.0)
+    assert watch.recoveries == 1
+    play(watch, 18.0, 60, rate=1 / 1.002, position=10.0)
+    assert watch.recoveries == 0
+
+
+def test_paused_and_ended_are_not_stalls():
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    for now in range(1, 30):
+        result = watch.update(float(now), snapshot(0.0, paused=True))
+    assert result["status"] == "paused"
+    result = watch.update(31.0, snapshot(600.0, ended=True))
+    assert result["status"] == "ended"
+    assert watch.lost == 0
+
+
+def test_new_page_starts_over():
+    watch = mp.PlaybackWatch()
+    watch.update(0.0, snapshot(0.0))
+    for now in range(1, 6):
+        watch.update(float(now), snapshot(0.0))
+    assert watch.lost > 0
+    result = watch.update(6.0, snapshot(0.0, url="https://example.com/next"))
+    assert result["status"] == "playing"
+    assert watch.lost == 0